@@ -0,0 +1,70 @@
+import json
+import time
+from typing import TypedDict
+
+###### Block Events ######
+###### Block Events ######
+###### Block Events ######
+
+# Every process publishes the inbound 429s it receives here, see BlockEventSubscriber
+BLOCK_EVENTS_CHANNEL = "nd_rate_limit_block_events"
+
+
+class BlockEvent(TypedDict):
+    """
+    One inbound 429, as published to every worker.
+    tier is "application", "method", "service" or "unspecified", method is None for the application and service tiers.
+    key is the blocking key that was written and deadline_ms when it expires (Unix time in milliseconds).
+    """
+    tier: str
+    subdomain: str
+    method: str | None
+    key: str
+    deadline_ms: int
+
+
+def encode_block_event(tier: str, subdomain: str, method: str | None, key: str, ttl_ms: int) -> str:
+    event: BlockEvent = {
+        "tier": tier,
+        "subdomain": subdomain,
+        "method": method,
+        "key": key,
+        "deadline_ms": int(time.time() * 1000) + ttl_ms,
+    }
+    return json.dumps(event, separators=(",", ":"))
+
+
+# The tiers a BlockEvent can be published for
+BLOCK_EVENT_TIERS = ("application", "method", "service", "unspecified")
+
+
+def decode_block_event(message: str | bytes) -> BlockEvent | None:
+    """
+    The event in a published message, None if it is not one. Every field is checked, the subscriber acts on
+    whatever comes back and a malformed message (another version, another tool on the channel) must not take it down.
+    """
+    try:
+        event = json.loads(message)
+    except ValueError:
+        return None
+    if not isinstance(event, dict) or event.get("tier") not in BLOCK_EVENT_TIERS:
+        return None
+    if not isinstance(event.get("subdomain"), str) or not isinstance(event.get("key"), str):
+        return None
+    if event.get("method") is not None and not isinstance(event["method"], str):
+        return None
+    # bool is an int too
+    if not isinstance(event.get("deadline_ms"), int) or isinstance(event["deadline_ms"], bool):
+        return None
+    return {
+        "tier": event["tier"],
+        "subdomain": event["subdomain"],
+        "method": event.get("method"),
+        "key": event["key"],
+        "deadline_ms": event["deadline_ms"],
+    }
+
+
+def remaining_ms(event: BlockEvent) -> int:
+    """Milliseconds until the event's blocking key expires, by this host's clock."""
+    return event["deadline_ms"] - int(time.time() * 1000)
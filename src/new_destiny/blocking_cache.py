@@ -0,0 +1,54 @@
+import math
+import time
+import weakref
+
+###### Local Blocking Cache ######
+###### Local Blocking Cache ######
+###### Local Blocking Cache ######
+
+class BlockingKeyCache:
+    """
+    Process-wide record of the blocking keys (inbound 429s) the backend reported, and when they expire.
+    Blocking keys only ever get extended, never cleared early, so until the recorded deadline passes every check of that
+    scope is answered locally instead of asking Redis again just to be told "blocked". Past the deadline the backend
+    is asked again, which also picks up extensions written by other processes in the meantime.
+    Deadlines are kept per backend (see RateLimitBackend.lease_scope) and on time.monotonic().
+    """
+    def __init__(self):
+        # backend scope -> {blocking key: time.monotonic() deadline}. Weak so dropped clients/pools do not leak.
+        self._deadlines: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def block(self, scope, key: str, ttl_ms: int):
+        """Record a blocking key that expires in ttl_ms. Keys without a TTL (-1) or that do not exist (-2) are not recorded."""
+        if ttl_ms <= 0:
+            return
+        deadlines = self._deadlines.get(scope)
+        if deadlines is None:
+            deadlines = {}
+            self._deadlines[scope] = deadlines
+        deadline = time.monotonic() + ttl_ms / 1000
+        if deadline > deadlines.get(key, 0):
+            deadlines[key] = deadline
+
+    def check(self, scope, keys: list[str]) -> tuple[int, int]:
+        """(index of the first key still blocked, milliseconds until it expires), or (-1, 0) when none of them are known to be."""
+        deadlines = self._deadlines.get(scope)
+        if not deadlines:
+            return -1, 0
+        now = time.monotonic()
+        for index, key in enumerate(keys):
+            deadline = deadlines.get(key)
+            if deadline is None:
+                continue
+            if deadline <= now:
+                del deadlines[key]
+                continue
+            return index, max(1, math.ceil((deadline - now) * 1000))
+        return -1, 0
+
+    def clear(self):
+        self._deadlines.clear()
+
+
+# One cache for the whole process, every limiter instance shares it
+BLOCKING_CACHE = BlockingKeyCache()
@@ -1,8 +1,9 @@
 import json
+import math
 import textwrap
 from urllib.parse import urlparse
 from .rate_limit_helpers import derive_riot_method_config, derive_riot_service
-from typing import Optional
+from typing import Optional, TypedDict
 from .json_types import JSONValue, RiotOffendingContext
 
 def format_offending_context(offending_context: RiotOffendingContext) -> str:
@@ -34,6 +35,29 @@ def format_offending_context(offending_context: RiotOffendingContext) -> str:
     return "\n".join(lines)
 
 
+class RateLimitWindow(TypedDict):
+    """
+    One window of an application or method rate limit, shortest first.
+    window_type is "seconds" for the shortest window, "minutes" for the longest and ex. "120_seconds" for any in between.
+    count only exists when internally enforced, it is the window's count stored in Redis.
+    """
+    window_type: str
+    key: str
+    limit: int
+    window: int
+    count: int | None
+
+
+def format_rate_limit_windows(windows: list[RateLimitWindow] | None) -> list[str]:
+    if not windows:
+        return []
+    lines = ["  windows:"]
+    for window in windows:
+        count = window["count"] if window["count"] is not None else "N/A - Riot headers source of truth"
+        lines.append(f"    {window['window_type']}: {count}/{window['limit']} per {window['window']} seconds ({window['key']})")
+    return lines
+
+
 ###### Exception Classes ######
 ###### Exception Classes ######
 ###### Exception Classes ######
@@ -76,6 +100,7 @@ class RiotNetworkError(RiotRelatedException):
 
 class RiotRelatedRateLimitException(Exception):
     retry_after: int
+    retry_after_ms: int
     enforcement_type: str
     subdomain: str
     riot_endpoint: str
@@ -84,14 +109,21 @@ class RiotRelatedRateLimitException(Exception):
     def __init__(
         self,
         *,
-        retry_after: int,
         enforcement_type: str,
         subdomain: str,
         riot_endpoint: str,
+        retry_after: int | None = None,
+        retry_after_ms: int | None = None,
         offending_context: RiotOffendingContext | None = None,
     ) -> None:
         super().__init__()
-        self.retry_after = retry_after
+        # Pass either. retry_after_ms is exact (Redis PTTL), retry_after is whole seconds rounded up for backwards compatibility.
+        if retry_after_ms is None:
+            if retry_after is None:
+                raise TypeError("Either retry_after or retry_after_ms is required.")
+            retry_after_ms = retry_after * 1000
+        self.retry_after_ms = retry_after_ms
+        self.retry_after = max(1, math.ceil(retry_after_ms / 1000)) if retry_after is None else retry_after
         self.enforcement_type = enforcement_type
         self.subdomain = subdomain
         self.riot_endpoint = riot_endpoint
@@ -101,7 +133,8 @@ class ApplicationRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
     def __init__(
         self,
         *,
-        retry_after: int,
+        retry_after: int | None = None,
+        retry_after_ms: int | None = None,
         minutes_key: str,
         seconds_key: str,
         enforcement_type: str,
@@ -114,10 +147,12 @@ class ApplicationRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
         minutes_window: int,
         seconds_count: int | None = None,
         minutes_count: int | None = None,
+        windows: list[RateLimitWindow] | None = None,
         offending_context: RiotOffendingContext | None = None,
     ) -> None:
         super().__init__(
             retry_after=retry_after,
+            retry_after_ms=retry_after_ms,
             enforcement_type=enforcement_type,
             subdomain=subdomain,
             riot_endpoint=riot_endpoint,
@@ -131,12 +166,14 @@ class ApplicationRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
         self.minutes_count = minutes_count # Only exists when internally enforced. This represents the current count of the mintes_key stored in redis.
         self.minutes_limit = minutes_limit
         self.minutes_window = f"{minutes_window} seconds"
+        self.windows = windows # Every window, including any beyond seconds/minutes. Counts only exist when internally enforced.
         self.reason = reason
 
     def __str__(self):
         lines = [
             "ApplicationRateLimitExceeded:",
             f"  retry_after: {self.retry_after}",
+            f"  retry_after_ms: {self.retry_after_ms}",
             f"  seconds_key: {self.seconds_key}",
             f"  seconds_count: {self.seconds_count if self.seconds_count else 'N/A - Riot headers source of truth'}",
             f"  seconds_limit: {self.seconds_limit}",
@@ -149,6 +186,7 @@ class ApplicationRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
             f"  subdomain: {self.subdomain}",
             f"  riot_endpoint: {self.riot_endpoint}",
             f"  reason: {self.reason}",
+            *format_rate_limit_windows(self.windows),
         ]
         if self.offending_context is not None:
             lines.append(format_offending_context(self.offending_context))
@@ -158,6 +196,7 @@ class ApplicationRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
         return {
             "type": "ApplicationRateLimitExceeded",
             "retry_after": self.retry_after,
+            "retry_after_ms": self.retry_after_ms,
             "seconds_key": self.seconds_key,
             "seconds_limit": self.seconds_limit,
             "seconds_count": self.seconds_count,
@@ -170,6 +209,7 @@ class ApplicationRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
             "subdomain": self.subdomain,
             "url": self.riot_endpoint,
             "reason": self.reason,
+            "windows": self.windows,
             "offending_context": self.offending_context
         }
 
@@ -178,7 +218,8 @@ class MethodRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExceptio
     def __init__(
         self,
         *,
-        retry_after: int,
+        retry_after: int | None = None,
+        retry_after_ms: int | None = None,
         method: str,
         enforcement_type: str,
         subdomain: str,
@@ -192,10 +233,12 @@ class MethodRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExceptio
         seconds_window: int | None = None,
         minutes_count: int | None = None,
         minutes_window: int | None = None,
+        windows: list[RateLimitWindow] | None = None,
         offending_context: RiotOffendingContext | None = None,
     ):
         super().__init__(
             retry_after=retry_after,
+            retry_after_ms=retry_after_ms,
             enforcement_type=enforcement_type,
             subdomain=subdomain,
             riot_endpoint=riot_endpoint,
@@ -210,12 +253,14 @@ class MethodRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExceptio
         self.minutes_count = minutes_count # Only exists when internally enforced. This represents the current count of the mintes_key stored in redis.
         self.minutes_limit = minutes_limit
         self.minutes_window = minutes_window
+        self.windows = windows # Every window, including any beyond seconds/minutes. Counts only exist when internally enforced.
         self.reason = reason
 
     def __str__(self):
         lines = [
             "MethodRateLimitExceeded:",
             f"  retry_after: {self.retry_after}",
+            f"  retry_after_ms: {self.retry_after_ms}",
             f"  method: {self.method}",
             f"  seconds_key: {self.seconds_key}",
             f"  seconds_count: {self.seconds_count if self.seconds_count else 'N/A - Riot headers source of truth'}",
@@ -229,6 +274,7 @@ class MethodRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExceptio
             f"  subdomain: {self.subdomain}",
             f"  riot_endpoint: {self.riot_endpoint}",
             f"  reason: {self.reason}",
+            *format_rate_limit_windows(self.windows),
         ]
         if self.offending_context is not None:
             lines.append(format_offending_context(self.offending_context))
@@ -238,6 +284,7 @@ class MethodRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExceptio
         return {
             "type": "MethodRateLimitExceeded",
             "retry_after": self.retry_after,
+            "retry_after_ms": self.retry_after_ms,
             "method": self.method,
             "minutes_key": self.minutes_key,
             "seconds_key": self.seconds_key,
@@ -245,6 +292,7 @@ class MethodRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExceptio
             "subdomain": self.subdomain,
             "riot_endpoint": self.riot_endpoint,
             "reason": self.reason,
+            "windows": self.windows,
             "seconds_limit": self.seconds_limit,
             "minutes_limit": self.minutes_limit,
             "seconds_count": self.seconds_count,
@@ -257,7 +305,8 @@ class ServiceRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExcepti
     def __init__(
         self,
         *,
-        retry_after: int,
+        retry_after: int | None = None,
+        retry_after_ms: int | None = None,
         service: str,
         enforcement_type: str,
         subdomain: str,
@@ -266,6 +315,7 @@ class ServiceRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExcepti
     ):
         super().__init__(
             retry_after=retry_after,
+            retry_after_ms=retry_after_ms,
             enforcement_type=enforcement_type,
             subdomain=subdomain,
             riot_endpoint=riot_endpoint,
@@ -277,6 +327,7 @@ class ServiceRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExcepti
         lines = [
             "ServiceRateLimitExceeded:",
             f"  retry_after: {self.retry_after}",
+            f"  retry_after_ms: {self.retry_after_ms}",
             f"  service: {self.service}",
             f"  enforcement_type: {self.enforcement_type}",
             f"  subdomain: {self.subdomain}",
@@ -290,6 +341,7 @@ class ServiceRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExcepti
         return {
             "type": "ServiceRateLimitExceeded",
             "retry_after": self.retry_after,
+            "retry_after_ms": self.retry_after_ms,
             "service": self.service,
             "enforcement_type": self.enforcement_type,
             "subdomain": self.subdomain,
@@ -306,7 +358,8 @@ class UnspecifiedRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
     def __init__(
         self,
         *,
-        retry_after: int,
+        retry_after: int | None = None,
+        retry_after_ms: int | None = None,
         subdomain: str,
         service: str,
         method: str,
@@ -316,6 +369,7 @@ class UnspecifiedRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
     ):
         super().__init__(
             retry_after=retry_after,
+            retry_after_ms=retry_after_ms,
             enforcement_type=enforcement_type,
             subdomain=subdomain,
             riot_endpoint=riot_endpoint,
@@ -328,6 +382,7 @@ class UnspecifiedRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
         lines = [
             "UnspecifiedRateLimitExceeded:",
             f"  retry_after: {self.retry_after}",
+            f"  retry_after_ms: {self.retry_after_ms}",
             f"  service: {self.service}",
             f"  method: {self.method}",
             f"  enforcement_type: {self.enforcement_type}",
@@ -342,6 +397,7 @@ class UnspecifiedRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
         return {
             "type": "UnspecifiedRateLimitExceeded",
             "retry_after": self.retry_after,
+            "retry_after_ms": self.retry_after_ms,
             "method": self.method,
             "enforcement_type": self.enforcement_type,
             "subdomain": self.subdomain,
@@ -350,6 +406,70 @@ class UnspecifiedRateLimitExceeded(RiotRelatedException, RiotRelatedRateLimitExc
         }
 
 
+class InFlightLimitExceeded(RiotRelatedException, RiotRelatedRateLimitException):
+    """
+    Too many requests to the router (scope="router") or to this method of it (scope="method") are awaiting Riot's response,
+    see ND_MAX_IN_FLIGHT_PER_ROUTER and ND_MAX_IN_FLIGHT_PER_METHOD. Always internally enforced, retry_after_ms is a short poll interval
+    because slots free up as soon as responses arrive.
+    """
+    def __init__(
+        self,
+        *,
+        retry_after: int | None = None,
+        retry_after_ms: int | None = None,
+        scope: str,
+        limit: int,
+        in_flight: int,
+        service: str,
+        method: str,
+        enforcement_type: str,
+        subdomain: str,
+        riot_endpoint: str,
+    ):
+        super().__init__(
+            retry_after=retry_after,
+            retry_after_ms=retry_after_ms,
+            enforcement_type=enforcement_type,
+            subdomain=subdomain,
+            riot_endpoint=riot_endpoint,
+        )
+        self.scope = scope
+        self.limit = limit
+        self.in_flight = in_flight
+        self.service = service
+        self.method = method
+
+    def __str__(self):
+        lines = [
+            "InFlightLimitExceeded:",
+            f"  retry_after: {self.retry_after}",
+            f"  retry_after_ms: {self.retry_after_ms}",
+            f"  scope: {self.scope}",
+            f"  limit: {self.limit}",
+            f"  in_flight: {self.in_flight}",
+            f"  service: {self.service}",
+            f"  method: {self.method}",
+            f"  enforcement_type: {self.enforcement_type}",
+            f"  subdomain: {self.subdomain}",
+            f"  riot_endpoint: {self.riot_endpoint}",
+        ]
+        return f"\033[31m{'\n'.join(lines)}\033[0m"
+
+    def to_dict(self) -> dict:
+        return {
+            "type": "InFlightLimitExceeded",
+            "retry_after": self.retry_after,
+            "retry_after_ms": self.retry_after_ms,
+            "scope": self.scope,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "service": self.service,
+            "method": self.method,
+            "enforcement_type": self.enforcement_type,
+            "subdomain": self.subdomain,
+            "riot_endpoint": self.riot_endpoint,
+        }
+
 class RiotAPIError(RiotRelatedException):
     """
     500 series or non 429 status code errors received from Riot.
@@ -0,0 +1,61 @@
+import os
+import socket
+import uuid
+from .rate_limit_discovery import API_KEY_FINGERPRINT
+
+###### Fleet Membership ######
+###### Fleet Membership ######
+###### Fleet Membership ######
+
+# Every worker sharing an API key heartbeats into this set, see FleetHeartbeat
+FLEET_KEY = f"nd_fleet_workers_{API_KEY_FINGERPRINT}"
+
+
+class FleetMembership:
+    """
+    This process's view of the fleet of workers sharing its API key, as of its last heartbeat.
+    size stays 1 (the whole budget is this worker's) until a FleetHeartbeat runs, after that every worker gets a guaranteed
+    share of every application and method window, see AdmissionRateLimiter.fleet_entries().
+    """
+    def __init__(self):
+        self.members: list[str] = []
+        self._pid: int | None = None
+        self._worker_id: str | None = None
+
+    @property
+    def size(self) -> int:
+        return max(1, len(self.members))
+
+    @property
+    def worker_id(self) -> str:
+        """Unique per process, a fork (ex. a pre-forking web server) gets an id of its own."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._worker_id = f"{socket.gethostname()}-{self._pid}-{uuid.uuid4().hex[:8]}"
+        return self._worker_id
+
+    def shares(self, limit: int) -> dict[str, int]:
+        """
+        {worker: guaranteed share} of a limit for every live worker. The limit is split evenly and what is left over
+        (limit % size) goes one each to the first workers by id, so every worker computes the same split and it adds up to limit.
+        """
+        share, remainder = divmod(limit, self.size)
+        return {member: share + (1 if rank < remainder else 0) for rank, member in enumerate(self.members)}
+
+    def update(self, members: list[str]) -> bool:
+        """Record the live workers reported by a heartbeat. Returns True when a worker joined or left."""
+        members = sorted(members)
+        # Who is in a fleet of one makes no difference, the whole budget is this worker's either way
+        changed = (members if len(members) > 1 else []) != (self.members if self.size > 1 else [])
+        self.members = members
+        return changed
+
+    def reset(self) -> bool:
+        """Back to a fleet of one, ex. once this worker stopped heartbeating. Returns True when it was larger."""
+        changed = self.size != 1
+        self.members = []
+        return changed
+
+
+# One membership for the whole process, every limiter instance shares it
+FLEET = FleetMembership()
@@ -0,0 +1,94 @@
+from typing import TypedDict
+from .settings.config import ND_MAX_HEADROOM
+
+###### Adaptive Headroom ######
+###### Adaptive Headroom ######
+###### Adaptive Headroom ######
+
+
+class HeadroomState(TypedDict):
+    """
+    This process's view of one routing value, see AdaptiveHeadroom.
+    margin is the share of every limit held back after leaks and drift, in_flight and latency_ms (moving average)
+    are the requests awaiting Riot's response, headroom is what the last admission actually held back.
+    """
+    margin: float
+    in_flight: int
+    latency_ms: float
+    headroom: float
+
+
+class AdaptiveHeadroom:
+    """
+    Per routing value safety margin below Riot's limits, for every process that uses it (ND_MAX_HEADROOM caps it, 0 disables it).
+    An inbound application or method 429 costs the full Retry-After, so leaving a few percent of a window unused is far cheaper
+    than a leak. The margin is AIMD: it grows fast when requests leak (a 429 doubles it, Riot counting more than we did adds the
+    drift) and shrinks by CALM_STEP with every response whose counts agree with Riot's, so the limit creeps back up as conditions calm.
+    Requests in flight are a floor on top: they may land in a different window at Riot than the one they were counted in,
+    so the share of the tightest window they could spill over (in flight x latency / window, over its limit) is held back too.
+    """
+    # A leak raises the margin by this much, or doubles it once it is larger
+    LEAK_STEP = 0.05
+    # Given back per response whose counts agree with Riot's, 0.05 is recovered in 25 calm responses
+    CALM_STEP = 0.002
+    # Weight of the newest request in the latency moving average
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, max_headroom: float | None = None):
+        self.max_headroom: float = ND_MAX_HEADROOM if max_headroom is None else max_headroom
+        self._margins: dict[str, float] = {}
+        self._in_flight: dict[str, int] = {}
+        self._latency_ms: dict[str, float] = {}
+        self._headroom: dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_headroom > 0
+
+    def started(self, subdomain: str):
+        """A request to the routing value is about to be sent."""
+        self._in_flight[subdomain] = self._in_flight.get(subdomain, 0) + 1
+
+    def finished(self, subdomain: str, latency_ms: float):
+        """Its response arrived (or it failed) after latency_ms."""
+        self._in_flight[subdomain] = max(0, self._in_flight.get(subdomain, 0) - 1)
+        previous = self._latency_ms.get(subdomain)
+        self._latency_ms[subdomain] = latency_ms if previous is None else previous + self.LATENCY_WEIGHT * (latency_ms - previous)
+
+    def leaked(self, subdomain: str):
+        """Riot answered 429 for an application or method limit we thought had room."""
+        margin = self._margins.get(subdomain, 0)
+        self._margins[subdomain] = min(self.max_headroom, max(margin * 2, margin + self.LEAK_STEP))
+
+    def drifted(self, subdomain: str, drift: int, limit: int):
+        """Riot counted drift more requests than Redis held in a window of this limit (once per response, its worst window)."""
+        margin = self._margins.get(subdomain, 0)
+        self._margins[subdomain] = min(self.max_headroom, margin + drift / limit)
+
+    def calmed(self, subdomain: str):
+        """A response with count headers and no window behind Riot's, responses without count headers say nothing."""
+        margin = self._margins.get(subdomain, 0)
+        if margin > 0:
+            self._margins[subdomain] = max(0, margin - self.CALM_STEP)
+
+    def headroom(self, subdomain: str, limit: int, window_ms: int) -> float:
+        """Share of every limit of the routing value to hold back right now, given its tightest (limit, window)."""
+        if not self.enabled:
+            return 0
+        spill = min(1, self._latency_ms.get(subdomain, 0) / window_ms) if window_ms > 0 else 0
+        pressure = self._in_flight.get(subdomain, 0) * spill / limit if limit > 0 else 0
+        headroom = min(self.max_headroom, max(self._margins.get(subdomain, 0), pressure))
+        self._headroom[subdomain] = headroom
+        return headroom
+
+    def state(self, subdomain: str) -> HeadroomState:
+        return {
+            "margin": self._margins.get(subdomain, 0),
+            "in_flight": self._in_flight.get(subdomain, 0),
+            "latency_ms": self._latency_ms.get(subdomain, 0),
+            "headroom": self._headroom.get(subdomain, 0),
+        }
+
+
+# One controller for the whole process, every limiter instance shares it
+HEADROOM = AdaptiveHeadroom()
@@ -0,0 +1,1334 @@
+import asyncio
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import weakref
+from functools import lru_cache
+from redis.exceptions import NoScriptError
+from .script_registry import SCRIPT_REGISTRY
+from .settings.config import ND_AUTO_PIPELINE
+try:
+    import fcntl
+except ImportError:  # Windows, SharedMemoryBackend is POSIX only
+    fcntl = None
+
+###### Rate Limit Backends ######
+###### Rate Limit Backends ######
+###### Rate Limit Backends ######
+
+# Shared by every limiter: the fused AdmissionRateLimiter and the per-tier Application/Method limiters.
+ADMISSION_SCRIPT = """
+-- Keys: [blocking_key_1 .. blocking_key_n, window_key_1 .. window_key_m]
+-- Args: [n, algorithm_1, limit_1, window_1, .. algorithm_m, limit_m, window_m, (requested, min_lease_ttl, reserve)] (windows in milliseconds)
+-- Returns: {is_allowed, retry_after, blocked_index, reason, granted, lease_ttl, count_1 .. count_m, (stamp_1 .. stamp_m)} (in milliseconds)
+-- When allowed, stamp is where the granted tokens were counted in each window entry, for REFUND_SCRIPT:
+-- fixed (and a tenant's own share) when its counter expires, sliding the bucket number, gcra the TAT they left behind.
+-- Entries that were not incremented (other tenants' shares) get an empty stamp.
+-- requested defaults to 1. More than 1 reserves a lease: as many tokens as every window has room for, up to requested.
+-- lease_ttl is how long the granted tokens stay counted in the windows they were taken from (after that they lapse with the window).
+-- Only 1 token is granted when that would be shorter than min_lease_ttl, the rest could not be used or refunded in time.
+-- When fewer than requested are granted, retry_after is how long until one more request fits every window again.
+-- reserve (0 to 1, default 0) is the share of every limit this request may not use, it is held back for higher priorities.
+-- Window entries whose algorithm is 'share:<window entry>:<own>' are tenant shares of another (application) window entry:
+-- the key counts one tenant's requests in that window and the limit is its guaranteed share. They are work conserving:
+-- a tenant may always use what is left of its own share, and beyond that whatever is not still owed to the other tenants
+-- that are active (counted requests) in the window. Only the requesting (own = 1) tenant's count is incremented.
+-- 'fleet:<window entry>:<own>' entries are the same for the workers sharing an API key, one per live worker, kept apart
+-- from the tenant shares of the same window. A worker blocked by them is blocked with reason "fleet".
+-- Algorithms:
+--   fixed:   INCR a counter that expires one window after its first hit
+--   sliding: a sliding log at sub-bucket resolution, the window is counted in sliding_buckets buckets of window / sliding_buckets
+--            ms keyed off Redis TIME (key .. ':' .. bucket_number). Every bucket that overlaps the window ending now is counted
+--            in full, so no window of any alignment holds more than limit, at the cost of up to one bucket's worth of throughput
+--   gcra:    pure pacing, one theoretical arrival time (TAT) per window (key .. ':tat') that each request pushes
+--            window / limit ms further out, a request fits once the TAT is not ahead of now. Requests are never closer
+--            than window / limit apart, so no window of any alignment holds more than limit (and room is never more than 1).
+--            key .. ':count' counts the requests of the current window like fixed does, for the counts and reconciling
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+-- Same as InMemoryBackend.SLIDING_BUCKETS
+local sliding_buckets = 10
+
+-- Returns the current bucket's key, its number and width,
+-- and how long requests counted in it stay counted (until it stops overlapping the window)
+local function sliding_bucket(key, window)
+    local width = window / sliding_buckets
+    local bucket = math.floor(now / width)
+    return key .. ':' .. bucket, bucket, width, math.ceil((bucket + sliding_buckets + 1) * width - now)
+end
+
+-- Returns the count of every bucket that overlaps the window ending now (oldest first) and their total
+local function sliding_counts(key, window)
+    local _, bucket = sliding_bucket(key, window)
+    local keys = {}
+    for b = bucket - sliding_buckets, bucket do
+        keys[#keys + 1] = key .. ':' .. b
+    end
+    local counts = redis.call('MGET', unpack(keys))
+    local total = 0
+    for i = 1, #counts do
+        counts[i] = tonumber(counts[i] or "0")
+        total = total + counts[i]
+    end
+    return counts, total
+end
+
+-- Returns the TAT (0 once it fell behind and expired) and the emission interval
+local function gcra_schedule(key, limit, window)
+    return tonumber(redis.call('GET', key .. ':tat') or "0"), window / limit
+end
+
+-- Redis keeps a key through its last millisecond (PTTL 0), by then its window has ended at Riot (and in InMemoryBackend)
+local function lapse(key)
+    if redis.call('PTTL', key) == 0 then
+        redis.call('DEL', key)
+    end
+end
+
+local function fixed_count(key, window)
+    lapse(key)
+    local count = tonumber(redis.call('GET', key) or "0")
+    local ttl = window
+    if count > 0 then
+        ttl = redis.call('PTTL', key)
+        if ttl < 0 then
+            ttl = window
+        end
+    end
+    return count, ttl
+end
+
+-- Returns when the counter expires
+local function fixed_take(key, window, granted)
+    lapse(key)
+    redis.call('INCRBY', key, granted)
+    local ttl = redis.call('PTTL', key)
+    if ttl < 0 then
+        redis.call('PEXPIRE', key, window)
+        ttl = window
+    end
+    return string.format('%d', now + ttl)
+end
+
+-- Returns the window's current count, how many more requests fit right now,
+-- how many milliseconds until one more request fits (0 when it fits now)
+-- and how long requests taken now stay counted in this window
+local function inspect(algorithm, key, limit, window, reserve)
+    local reserved = math.floor(limit * reserve)
+    if algorithm == 'gcra' then
+        local tat, interval = gcra_schedule(key, limit, window)
+        local count = fixed_count(key .. ':count', window)
+        -- Lower priorities also leave the reserved requests' share of the pace free: they wait for the TAT
+        -- as if the limit were limit - reserved, while the TAT itself only advances one interval per request
+        local slack = 0
+        if reserved > 0 then
+            slack = window / (limit - reserved) - interval
+        end
+        local wait = math.ceil(tat + slack - now)
+        if wait <= 0 then
+            return count, 1, 0, window
+        end
+        return count, 0, wait, window
+    end
+
+    -- Counters simply stop short of the reserved requests
+    limit = limit - reserved
+
+    if algorithm == 'sliding' then
+        local _, bucket, width, ttl = sliding_bucket(key, window)
+        local buckets, count = sliding_counts(key, window)
+        if count + 1 <= limit then
+            return count, limit - count, 0, ttl
+        end
+        -- Room opens up as the oldest buckets stop overlapping the window, the i-th oldest at (bucket + i) * width
+        local freed = 0
+        for i = 1, #buckets - 1 do
+            freed = freed + buckets[i]
+            if count - freed + 1 <= limit then
+                return count, 0, math.max(1, math.ceil((bucket + i) * width - now)), ttl
+            end
+        end
+        return count, 0, ttl, ttl
+    end
+
+    local count, ttl = fixed_count(key, window)
+    if count + 1 <= limit then
+        return count, limit - count, 0, ttl
+    end
+    return count, 0, ttl, ttl
+end
+
+-- Returns the stamp of the granted tokens
+local function take(algorithm, key, limit, window, granted)
+    if algorithm == 'gcra' then
+        local tat, interval = gcra_schedule(key, limit, window)
+        local next_tat = string.format('%.3f', math.max(tat, now) + granted * interval)
+        -- Kept a window past the TAT, a reserve's slack (less than a window) is still measured from it once it fell behind now
+        redis.call('SET', key .. ':tat', next_tat, 'PX', math.ceil(tonumber(next_tat) - now) + window)
+        fixed_take(key .. ':count', window, granted)
+        return next_tat
+    end
+
+    if algorithm == 'sliding' then
+        local current_key, bucket, _, ttl = sliding_bucket(key, window)
+        fixed_take(current_key, ttl, granted)
+        return string.format('%d', bucket)
+    end
+
+    return fixed_take(key, window, granted)
+end
+
+local blocking_count = tonumber(ARGV[1])
+local requested = tonumber(ARGV[(#KEYS - blocking_count) * 3 + 2] or "1")
+local min_lease_ttl = tonumber(ARGV[(#KEYS - blocking_count) * 3 + 3] or "0")
+local reserve = tonumber(ARGV[(#KEYS - blocking_count) * 3 + 4] or "0")
+
+-- Check every blocking key first (external rate limits that were hit)
+for i = 1, blocking_count do
+    lapse(KEYS[i])
+    local block_ttl = redis.call('PTTL', KEYS[i])
+    if block_ttl ~= -2 then
+        return {0, block_ttl, i, "blocking_key", 0, 0}
+    end
+end
+
+-- Check every window's count against its limit before incrementing anything
+local counts = {}
+local rooms = {}
+local shares = {}
+local share_order = {}
+local blocked_index = 0
+local retry_after = 0
+local reason = "limit"
+local granted = requested
+local lease_ttl = nil
+for i = blocking_count + 1, #KEYS do
+    local j = (i - blocking_count - 1) * 3 + 2
+    local kind, window_entry, own = string.match(ARGV[j], '^(%a+):(%d+):(%d)$')
+    if kind then
+        lapse(KEYS[i])
+        local used = tonumber(redis.call('GET', KEYS[i]) or "0")
+        counts[#counts + 1] = used
+        -- Blamed on the window itself until this tenant's own entry is seen (a tenant with no share only borrows)
+        local share = shares[kind .. window_entry]
+        if share == nil then
+            share = {kind = kind, window_entry = tonumber(window_entry), own_unmet = 0, owed = 0, wait = 0, own_index = blocking_count + tonumber(window_entry)}
+            shares[kind .. window_entry] = share
+            share_order[#share_order + 1] = share
+        end
+        local unmet = math.max(0, tonumber(ARGV[j + 1]) - used)
+        if own == '1' then
+            share.own_unmet = unmet
+            share.own_index = i
+        elseif used > 0 then
+            -- Idle tenants are owed nothing, their share is lent out until they show up
+            share.owed = share.owed + unmet
+        end
+        if used > 0 then
+            -- The share opens up again once any tenant's count of this window expires
+            local ttl = redis.call('PTTL', KEYS[i])
+            if ttl > 0 and (share.wait == 0 or ttl < share.wait) then
+                share.wait = ttl
+            end
+        end
+    else
+        local count, room, wait, ttl = inspect(ARGV[j], KEYS[i], tonumber(ARGV[j + 1]), tonumber(ARGV[j + 2]), reserve)
+        counts[#counts + 1] = count
+        rooms[i - blocking_count] = room
+        granted = math.min(granted, room)
+        if lease_ttl == nil or ttl < lease_ttl then
+            lease_ttl = ttl
+        end
+        if wait > 0 and blocked_index == 0 then
+            blocked_index = i
+            retry_after = wait
+        end
+    end
+end
+
+if blocked_index == 0 then
+    for _, share in ipairs(share_order) do
+        local room = rooms[share.window_entry]
+        share.allowed = math.min(room, math.max(share.own_unmet, room - share.owed))
+        granted = math.min(granted, share.allowed)
+        if share.allowed < 1 and blocked_index == 0 then
+            blocked_index = share.own_index
+            retry_after = math.max(1, share.wait)
+            reason = share.kind
+        end
+    end
+end
+
+if blocked_index > 0 then
+    local result = {0, retry_after, blocked_index, reason, 0, 0}
+    for _, count in ipairs(counts) do
+        result[#result + 1] = count
+    end
+    return result
+end
+
+-- Every tier allows the request, count the granted requests in every window
+lease_ttl = lease_ttl or 0
+if lease_ttl < min_lease_ttl then
+    granted = math.min(granted, 1)
+end
+local result = {1, 0, 0, "allowed", granted, lease_ttl}
+local stamps = {}
+for i = blocking_count + 1, #KEYS do
+    local j = (i - blocking_count - 1) * 3 + 2
+    local kind, _, own = string.match(ARGV[j], '^(%a+):(%d+):(%d)$')
+    local count = counts[i - blocking_count]
+    local stamp = ''
+    if kind == nil then
+        stamp = take(ARGV[j], KEYS[i], tonumber(ARGV[j + 1]), tonumber(ARGV[j + 2]), granted)
+        count = count + granted
+    elseif own == '1' then
+        stamp = take('fixed', KEYS[i], tonumber(ARGV[j + 1]), tonumber(ARGV[j + 2]), granted)
+        count = count + granted
+    end
+    result[#result + 1] = count
+    stamps[#stamps + 1] = stamp
+end
+for _, stamp in ipairs(stamps) do
+    result[#result + 1] = stamp
+end
+
+-- Partial grant, report when the rest can start being admitted
+if granted < requested then
+    for i = blocking_count + 1, #KEYS do
+        local j = (i - blocking_count - 1) * 3 + 2
+        if string.match(ARGV[j], '^%a+:%d+:%d$') == nil then
+            local _, _, wait = inspect(ARGV[j], KEYS[i], tonumber(ARGV[j + 1]), tonumber(ARGV[j + 2]), reserve)
+            result[2] = math.max(result[2], wait)
+        end
+    end
+    for _, share in ipairs(share_order) do
+        if share.allowed <= granted then
+            result[2] = math.max(result[2], share.wait)
+        end
+    end
+end
+
+return result
+"""
+
+
+# Returns tokens that were admitted but never sent (unused lease tokens, requests that never left the process).
+# Only the windows they were counted in are touched (see ADMISSION_SCRIPT's stamps), a window that rolled over
+# since is left alone, the tokens lapsed with it and a newer window must not be lowered for them.
+REFUND_SCRIPT = """
+-- Keys: [window_key_1 .. window_key_m]
+-- Args: [unused, algorithm_1, limit_1, window_1, stamp_1, .. algorithm_m, limit_m, window_m, stamp_m] (windows in milliseconds)
+-- Returns: 1
+-- stamp is what ADMISSION_SCRIPT returned for the window entry when it admitted the tokens, an empty stamp is skipped:
+--   fixed:   when the counter expires, only that counter is lowered (a newer one expires later)
+--   sliding: the bucket the tokens were counted in
+--   gcra:    the TAT they left behind, only pulled back while no later request has pushed it further
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local unused = tonumber(ARGV[1])
+
+for i = 1, #KEYS do
+    local j = (i - 1) * 4 + 2
+    local algorithm, limit, window, stamp = ARGV[j], tonumber(ARGV[j + 1]), tonumber(ARGV[j + 2]), ARGV[j + 3]
+    local key = KEYS[i]
+    local current = false
+    if stamp == '' then
+        -- Never counted in this entry (another tenant's or worker's share)
+    elseif algorithm == 'gcra' then
+        if redis.call('GET', key .. ':tat') == stamp then
+            local refunded_tat = tonumber(stamp) - unused * window / limit
+            if refunded_tat + window <= now then
+                redis.call('DEL', key .. ':tat')
+            else
+                redis.call('SET', key .. ':tat', string.format('%.3f', refunded_tat), 'PX', math.ceil(refunded_tat - now) + window)
+            end
+            key = key .. ':count'
+            current = true
+        end
+    elseif algorithm == 'sliding' then
+        key = key .. ':' .. stamp
+        current = true
+    else
+        current = now < tonumber(stamp)
+    end
+    -- A missing counter means it already expired and the tokens lapsed with it
+    if current then
+        local count = tonumber(redis.call('GET', key) or "0")
+        if count > 0 then
+            redis.call('DECRBY', key, math.min(count, unused))
+        end
+    end
+end
+
+return 1
+"""
+
+
+# Raises window counts that are behind the counts Riot reports in its X-App/X-Method-Rate-Limit-Count headers
+RECONCILE_SCRIPT = """
+-- Keys: [window_key_1 .. window_key_m]
+-- Args: [algorithm_1, limit_1, window_1, riot_count_1, .. algorithm_m, limit_m, window_m, riot_count_m] (windows in milliseconds)
+-- Returns: {count_1 .. count_m} (the counts before reconciling)
+-- Counts are only ever raised, never lowered: being ahead of Riot only costs a little throughput, being behind costs 429s.
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+-- In its last millisecond (PTTL 0) a counter has lapsed, Riot's count is for the next window
+local function lapse(key)
+    if redis.call('PTTL', key) == 0 then
+        redis.call('DEL', key)
+    end
+end
+
+local counts = {}
+for i = 1, #KEYS do
+    local j = (i - 1) * 4 + 1
+    local algorithm, limit, window, riot_count = ARGV[j], tonumber(ARGV[j + 1]), tonumber(ARGV[j + 2]), tonumber(ARGV[j + 3])
+    local key = KEYS[i]
+    local count = 0
+    if algorithm == 'gcra' then
+        -- Pace out the requests Riot counted and we did not, on top of the ones already scheduled,
+        -- then raise the count like fixed does below
+        lapse(key .. ':count')
+        local tat = tonumber(redis.call('GET', key .. ':tat') or "0")
+        local behind = riot_count - tonumber(redis.call('GET', key .. ':count') or "0")
+        if behind > 0 then
+            tat = math.max(tat, now) + behind * window / limit
+            redis.call('SET', key .. ':tat', string.format('%.3f', tat), 'PX', math.ceil(tat - now) + window)
+        end
+        key = key .. ':count'
+    end
+    if algorithm == 'sliding' then
+        -- Buckets of window / 10 like ADMISSION_SCRIPT's, the missing requests are counted in the current one
+        local width = window / 10
+        local bucket = math.floor(now / width)
+        for b = bucket - 10, bucket do
+            count = count + tonumber(redis.call('GET', key .. ':' .. b) or "0")
+        end
+        if riot_count > count then
+            local current_key = key .. ':' .. bucket
+            redis.call('INCRBY', current_key, riot_count - count)
+            if redis.call('PTTL', current_key) < 0 then
+                redis.call('PEXPIRE', current_key, math.ceil((bucket + 11) * width - now))
+            end
+        end
+    else
+        lapse(key)
+        count = tonumber(redis.call('GET', key) or "0")
+        if riot_count > count then
+            if redis.call('PTTL', key) > 0 then
+                redis.call('SET', key, riot_count, 'KEEPTTL')
+            else
+                redis.call('SET', key, riot_count, 'PX', window)
+            end
+        end
+    end
+    counts[#counts + 1] = count
+end
+
+return counts
+"""
+
+
+
+# Window entries that are a tenant's (share) or worker's (fleet) share of another window entry, see ADMISSION_SCRIPT
+SHARE_ALGORITHM = re.compile(r"^(share|fleet):(\d+):(\d)$")
+
+
+# Sets (or extends) an inbound 429's blocking key, shared by the application and method limiters
+BLOCKING_SCRIPT = """
+-- Keys: [blocking_key]
+-- Args: [retry_after] (milliseconds)
+-- Returns: {exists, current_ttl} (milliseconds)
+local blocking_key = KEYS[1]
+local retry_after = tonumber(ARGV[1])
+
+-- Check if key exists and get its TTL
+local exists = redis.call('EXISTS', blocking_key)
+local current_ttl = 0
+
+if exists == 1 then
+    current_ttl = redis.call('PTTL', blocking_key)
+end
+
+-- Only set the key if it doesn't exist OR if new retry_after is longer than remaining TTL
+if exists == 0 or retry_after > current_ttl then
+    redis.call('SET', blocking_key, 1, 'PX', retry_after)
+end
+
+return {exists, current_ttl}
+"""
+
+
+# Registers (or unregisters) one worker in the set of workers sharing an API key, see FleetHeartbeat
+FLEET_SCRIPT = """
+-- Keys: [members] (sorted set of worker ids scored by the time their last heartbeat expires)
+-- Args: [member, ttl_ms] (ttl_ms 0 leaves the fleet)
+-- Returns: the ids of every live worker
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local ttl = tonumber(ARGV[2])
+
+-- Workers that missed their heartbeats are dropped by whoever sends the next one
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if ttl > 0 then
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ttl)
+else
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+
+# Takes one in flight slot of every semaphore (ex. a router's and one of its methods'), or none of them
+IN_FLIGHT_SCRIPT = """
+-- Keys: [semaphore_1 .. semaphore_n] (sorted sets of request tokens scored by the time their lease expires)
+-- Args: [token, lease_ms, limit_1 .. limit_n]
+-- Returns: {acquired, blocked_index, in_flight} (in_flight is the blocking semaphore's count, 0 when acquired)
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local lease_ms = tonumber(ARGV[2])
+
+for i = 1, #KEYS do
+    -- Leases of requests whose worker died without releasing them have expired by now
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    local in_flight = redis.call('ZCARD', KEYS[i])
+    if in_flight >= tonumber(ARGV[i + 2]) then
+        return {0, i, in_flight}
+    end
+end
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], now + lease_ms, ARGV[1])
+    redis.call('PEXPIRE', KEYS[i], lease_ms)
+end
+return {1, 0, 0}
+"""
+
+# Gives an in flight slot back as soon as its response arrived
+IN_FLIGHT_RELEASE_SCRIPT = """
+-- Keys: [semaphore_1 .. semaphore_n]
+-- Args: [token]
+for i = 1, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+return 1
+"""
+
+
+class RateLimitBackend:
+    """
+    Where the limiters keep their windows, blocking keys and discovered limits.
+    Every operation is atomic and takes the same keys and arguments as the Lua script it stands for
+    (ADMISSION_SCRIPT, REFUND_SCRIPT, RECONCILE_SCRIPT, BLOCKING_SCRIPT, FLEET_SCRIPT, IN_FLIGHT_SCRIPT, IN_FLIGHT_RELEASE_SCRIPT),
+    so every backend enforces the exact same semantics.
+    See RedisBackend (shared by every process) and InMemoryBackend (one process, no Redis).
+    """
+    @property
+    def lease_scope(self):
+        """What token leases (and BLOCKING_CACHE deadlines) are shared across: every limiter call that resolves to the same scope shares them."""
+        return self
+
+    async def initialize(self):
+        """Prepare the backend ahead of the first request, ex. load the Lua scripts. Optional."""
+
+    async def admit(self, keys: list[str], args: list[int | str]) -> list:
+        """Check the blocking keys and windows and take the granted requests, see ADMISSION_SCRIPT."""
+        raise NotImplementedError
+
+    async def refund(self, keys: list[str], args: list[int | str]):
+        """Give back requests that were admitted but never sent, see REFUND_SCRIPT."""
+        raise NotImplementedError
+
+    async def reconcile(self, keys: list[str], args: list[int | str]) -> list[int]:
+        """Raise window counts that are behind Riot's, see RECONCILE_SCRIPT. Returns the counts before reconciling."""
+        raise NotImplementedError
+
+    async def extend_block(self, key: str, retry_after_ms: int) -> tuple[int, int]:
+        """Set a blocking key, or extend it if it expires sooner. Returns (existed, its TTL before), see BLOCKING_SCRIPT."""
+        raise NotImplementedError
+
+    async def set_block(self, key: str, ttl_ms: int) -> int:
+        """Set a blocking key unless it is already set. Returns its TTL afterwards (like PTTL)."""
+        raise NotImplementedError
+
+    async def block_ttl(self, key: str) -> int:
+        """Milliseconds until a blocking key expires, -1 if it never does and -2 if it is not set (like PTTL)."""
+        raise NotImplementedError
+
+    async def get_hash(self, key: str) -> dict:
+        """Every field of a hash, empty when it does not exist (like HGETALL)."""
+        raise NotImplementedError
+
+    async def set_hash_field(self, key: str, field: str, value: str):
+        raise NotImplementedError
+
+    async def heartbeat(self, key: str, member: str, ttl_ms: int) -> list[str]:
+        """Keep a worker in a fleet for another ttl_ms (0 removes it). Returns every live worker, see FLEET_SCRIPT."""
+        raise NotImplementedError
+
+    async def acquire_slots(self, keys: list[str], args: list[int | str]) -> list[int]:
+        """Take an in flight slot of every semaphore or none, see IN_FLIGHT_SCRIPT."""
+        raise NotImplementedError
+
+    async def release_slots(self, keys: list[str], token: str):
+        """Give back the in flight slots a request took, see IN_FLIGHT_RELEASE_SCRIPT."""
+        raise NotImplementedError
+
+    async def publish(self, channel: str, message: str):
+        """Tell every other process sharing this backend, see BlockEventSubscriber."""
+        raise NotImplementedError
+
+    async def listen(self, channel: str):
+        """Async iterator of the messages published on a channel. Ending means nothing will ever be published to this process."""
+        raise NotImplementedError
+        yield
+
+
+# Strong references to in flight pipelines, the event loop only keeps weak ones
+_pipeline_tasks: set[asyncio.Task] = set()
+
+
+class RedisBackend(RateLimitBackend):
+    """
+    The default backend: every operation is one Lua script or command against an async Redis client
+    (redis.asyncio.Redis or RedisCluster, created with decode_responses=True), shared by every process that uses it.
+    With auto_pipeline (ND_AUTO_PIPELINE, on by default) every script called in the same event loop tick is sent in one
+    pipeline, so an asyncio.gather of hundreds of requests costs one write and one read instead of hundreds.
+    Each script still runs atomically on its own and every caller gets its own result (or exception) back.
+    """
+    def __init__(self, async_redis_client, auto_pipeline: bool | None = None):
+        self.redis = async_redis_client
+        self.auto_pipeline = bool(ND_AUTO_PIPELINE if auto_pipeline is None else auto_pipeline)
+        # (script, numkeys, keys and args, caller's future) of the scripts waiting for the end of this tick
+        self._pending: list[tuple[str, int, list[int | str], asyncio.Future]] = []
+
+    @property
+    def lease_scope(self):
+        # Clients sharing a connection pool share a Redis server. Clients without one (ex. RedisCluster) are their own scope.
+        return getattr(self.redis, "connection_pool", None) or self.redis
+
+    async def initialize(self):
+        """Load every Lua script on this client's connection pool. Only the first call per pool does round trips."""
+        for script in (ADMISSION_SCRIPT, REFUND_SCRIPT, RECONCILE_SCRIPT, BLOCKING_SCRIPT, FLEET_SCRIPT, IN_FLIGHT_SCRIPT, IN_FLIGHT_RELEASE_SCRIPT):
+            await SCRIPT_REGISTRY.load(self.redis, script)
+
+    async def run_script(self, script: str, keys: list[str], args: list[int | str]):
+        """EVALSHA a script, in the pipeline of the current event loop tick when auto pipelining."""
+        if not self.auto_pipeline:
+            return await SCRIPT_REGISTRY.evalsha(self.redis, script, len(keys), *keys, *args)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((script, len(keys), [*keys, *args], future))
+        if len(self._pending) == 1:
+            # Runs once every coroutine already scheduled for this tick had its turn
+            loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        _pipeline_tasks.add(task)
+        task.add_done_callback(_pipeline_tasks.discard)
+
+    async def _send(self, batch: list[tuple[str, int, list[int | str], asyncio.Future]]):
+        try:
+            if len(batch) == 1:
+                script, numkeys, keys_and_args, _ = batch[0]
+                results = [await SCRIPT_REGISTRY.evalsha(self.redis, script, numkeys, *keys_and_args)]
+            else:
+                results = await self._execute(batch)
+                # Redis lost its script cache (restart, failover): reload what is missing and retry those scripts once
+                missing = [index for index, result in enumerate(results) if isinstance(result, NoScriptError)]
+                if missing:
+                    for script in {batch[index][0] for index in missing}:
+                        SCRIPT_REGISTRY.forget(self.redis, script)
+                    for index, result in zip(missing, await self._execute([batch[index] for index in missing])):
+                        results[index] = result
+        except asyncio.CancelledError:
+            for _, _, _, future in batch:
+                future.cancel()
+            raise
+        except Exception as exc:
+            results = [exc] * len(batch)
+
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():  # The caller was cancelled
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _execute(self, batch: list[tuple[str, int, list[int | str], asyncio.Future]]) -> list:
+        for script in {script for script, _, _, _ in batch}:
+            await SCRIPT_REGISTRY.load(self.redis, script)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for script, numkeys, keys_and_args, _ in batch:
+                pipe.evalsha(SCRIPT_REGISTRY.sha(script), numkeys, *keys_and_args)
+            return await pipe.execute(raise_on_error=False)
+
+    async def admit(self, keys: list[str], args: list[int | str]) -> list:
+        return await self.run_script(ADMISSION_SCRIPT, keys, args)
+
+    async def refund(self, keys: list[str], args: list[int | str]):
+        await self.run_script(REFUND_SCRIPT, keys, args)
+
+    async def reconcile(self, keys: list[str], args: list[int | str]) -> list[int]:
+        return await self.run_script(RECONCILE_SCRIPT, keys, args)
+
+    async def extend_block(self, key: str, retry_after_ms: int) -> tuple[int, int]:
+        exists, current_ttl = await self.run_script(BLOCKING_SCRIPT, [key], [retry_after_ms])
+        return exists, current_ttl
+
+    async def set_block(self, key: str, ttl_ms: int) -> int:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, 1, px=ttl_ms, nx=True)
+            pipe.pttl(key)
+            _, remaining_ttl = await pipe.execute()
+        return remaining_ttl
+
+    async def block_ttl(self, key: str) -> int:
+        return await self.redis.pttl(key)
+
+    async def get_hash(self, key: str) -> dict:
+        return await self.redis.hgetall(key)
+
+    async def set_hash_field(self, key: str, field: str, value: str):
+        await self.redis.hset(key, field, value)
+
+    async def heartbeat(self, key: str, member: str, ttl_ms: int) -> list[str]:
+        return await self.run_script(FLEET_SCRIPT, [key], [member, ttl_ms])
+
+    async def acquire_slots(self, keys: list[str], args: list[int | str]) -> list[int]:
+        return await self.run_script(IN_FLIGHT_SCRIPT, keys, args)
+
+    async def release_slots(self, keys: list[str], token: str):
+        await self.run_script(IN_FLIGHT_RELEASE_SCRIPT, keys, [token])
+
+    async def publish(self, channel: str, message: str):
+        await self.redis.publish(channel, message)
+
+    async def listen(self, channel: str):
+        # RedisCluster clients have no pub/sub, subscribe with a redis.asyncio.Redis client of any node instead
+        pubsub = self.redis.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.aclose()
+
+
+class InMemoryBackend(RateLimitBackend):
+    """
+    Keeps every window, blocking key and discovered limit in this process, for deployments that run as one process
+    (batch jobs, benchmarks, tests) and need no Redis at all. Admission is a dictionary lookup instead of a round trip.
+    Each operation is the Python twin of its Lua script, run against a small keyspace with PTTL-style expiry
+    on the monotonic clock. Operations never await, so they are atomic on the event loop, and a lock keeps them
+    atomic across threads too. Limits are only shared by the limiters that use the same instance.
+    """
+    # Expired keys are swept at most this often, reading a key also drops it once expired
+    SWEEP_INTERVAL_MS = 1000
+    # Sliding windows are counted in this many buckets, same as sliding_buckets in ADMISSION_SCRIPT
+    SLIDING_BUCKETS = 10
+
+    def __init__(self):
+        self._values: dict[str, int | float] = {}
+        self._deadlines: dict[str, int] = {}  # key -> expiry in monotonic milliseconds, keys without one never expire
+        self._hashes: dict[str, dict[str, str]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+
+    ###### Keyspace, mirrors the Redis commands the scripts use ######
+
+    def _now(self) -> int:
+        now = time.monotonic_ns() // 1_000_000
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.SWEEP_INTERVAL_MS
+            self._sweep(now)
+        return now
+
+    def _sweep(self, now: int):
+        for key in [key for key, deadline in self._deadlines.items() if deadline <= now]:
+            self._delete(key)
+
+    def _delete(self, key: str):
+        self._values.pop(key, None)
+        self._deadlines.pop(key, None)
+
+    def _get(self, key: str, now: int) -> int | float | None:
+        deadline = self._deadlines.get(key)
+        if deadline is not None and deadline <= now:
+            self._delete(key)
+            return None
+        return self._values.get(key)
+
+    def _pttl(self, key: str, now: int) -> int:
+        if self._get(key, now) is None:
+            return -2
+        deadline = self._deadlines.get(key)
+        return -1 if deadline is None else deadline - now
+
+    def _set(self, key: str, value: int | float, now: int, px: int | None = None):
+        self._values[key] = value
+        if px is None:
+            self._deadlines.pop(key, None)
+        else:
+            self._deadlines[key] = now + px
+
+    def _replace(self, key: str, value: int | float, now: int):
+        """Set a value and keep its TTL (SET ... KEEPTTL)."""
+        self._values[key] = value
+
+    def _incrby(self, key: str, amount: int, now: int):
+        self._replace(key, (self._get(key, now) or 0) + amount, now)
+
+    def _pexpire(self, key: str, ttl_ms: int, now: int):
+        if key in self._values:
+            self._deadlines[key] = now + ttl_ms
+
+    ###### Algorithms, see ADMISSION_SCRIPT ######
+
+    def _sliding_bucket(self, key: str, window: int, now: int) -> tuple[str, int, float, int]:
+        width = window / self.SLIDING_BUCKETS
+        bucket = math.floor(now / width)
+        return f"{key}:{bucket}", bucket, width, math.ceil((bucket + self.SLIDING_BUCKETS + 1) * width - now)
+
+    def _sliding_counts(self, key: str, window: int, now: int) -> tuple[list[int], int]:
+        bucket = self._sliding_bucket(key, window, now)[1]
+        counts = [self._get(f"{key}:{b}", now) or 0 for b in range(bucket - self.SLIDING_BUCKETS, bucket + 1)]
+        return counts, sum(counts)
+
+    def _gcra_schedule(self, key: str, limit: int, window: int, now: int) -> tuple[float, float]:
+        return self._get(f"{key}:tat", now) or 0, window / limit
+
+    def _fixed_count(self, key: str, window: int, now: int) -> tuple[int, int]:
+        count = self._get(key, now) or 0
+        ttl = window
+        if count > 0:
+            ttl = self._pttl(key, now)
+            if ttl < 0:
+                ttl = window
+        return count, ttl
+
+    def _fixed_take(self, key: str, window: int, granted: int, now: int) -> str:
+        self._incrby(key, granted, now)
+        ttl = self._pttl(key, now)
+        if ttl < 0:
+            self._pexpire(key, window, now)
+            ttl = window
+        return str(now + ttl)
+
+    def _inspect(self, algorithm: str, key: str, limit: int, window: int, now: int, reserve: float = 0) -> tuple[int, int, int, int]:
+        """(count, room, wait, ttl) of one window, like inspect() in ADMISSION_SCRIPT."""
+        reserved = math.floor(limit * reserve)
+        if algorithm == "gcra":
+            tat, interval = self._gcra_schedule(key, limit, window, now)
+            count = self._fixed_count(f"{key}:count", window, now)[0]
+            slack = window / (limit - reserved) - interval if reserved > 0 else 0
+            wait = math.ceil(tat + slack - now)
+            if wait <= 0:
+                return count, 1, 0, window
+            return count, 0, wait, window
+
+        limit -= reserved
+
+        if algorithm == "sliding":
+            _, bucket, width, ttl = self._sliding_bucket(key, window, now)
+            buckets, count = self._sliding_counts(key, window, now)
+            if count + 1 <= limit:
+                return count, limit - count, 0, ttl
+            freed = 0
+            for i, bucket_count in enumerate(buckets[:-1], start=1):
+                freed += bucket_count
+                if count - freed + 1 <= limit:
+                    return count, 0, max(1, math.ceil((bucket + i) * width - now)), ttl
+            return count, 0, ttl, ttl
+
+        count, ttl = self._fixed_count(key, window, now)
+        if count + 1 <= limit:
+            return count, limit - count, 0, ttl
+        return count, 0, ttl, ttl
+
+    def _take(self, algorithm: str, key: str, limit: int, window: int, granted: int, now: int) -> str:
+        """Count the granted tokens, returns their stamp like take() in ADMISSION_SCRIPT."""
+        if algorithm == "gcra":
+            tat, interval = self._gcra_schedule(key, limit, window, now)
+            next_tat = round(max(tat, now) + granted * interval, 3)
+            self._set(f"{key}:tat", next_tat, now, px=math.ceil(next_tat - now) + window)
+            self._fixed_take(f"{key}:count", window, granted, now)
+            return f"{next_tat:.3f}"
+
+        if algorithm == "sliding":
+            current_key, bucket, _, ttl = self._sliding_bucket(key, window, now)
+            self._fixed_take(current_key, ttl, granted, now)
+            return str(bucket)
+        return self._fixed_take(key, window, granted, now)
+
+    @staticmethod
+    def _windows(keys: list[str], args: list[int | str], offset: int, stride: int = 3):
+        """(key, algorithm, limit, window) of every window key, ARGV is laid out like the Lua scripts'."""
+        for i, key in enumerate(keys):
+            j = offset + i * stride
+            yield key, str(args[j]), int(args[j + 1]), int(args[j + 2])
+
+    ###### Operations ######
+
+    async def admit(self, keys: list[str], args: list[int | str]) -> list:
+        with self._lock:
+            now = self._now()
+            blocking_count = int(args[0])
+            extra = args[1 + (len(keys) - blocking_count) * 3:]
+            requested = int(extra[0]) if extra else 1
+            min_lease_ttl = int(extra[1]) if len(extra) > 1 else 0
+            reserve = float(extra[2]) if len(extra) > 2 else 0
+
+            for i, key in enumerate(keys[:blocking_count], start=1):
+                block_ttl = self._pttl(key, now)
+                if block_ttl != -2:
+                    return [0, block_ttl, i, "blocking_key", 0, 0]
+
+            windows = list(self._windows(keys[blocking_count:], args, 1))
+            counts = []
+            rooms = {}
+            shares: dict[tuple[str, str], dict] = {}
+            blocked_index = 0
+            retry_after = 0
+            reason = "limit"
+            granted = requested
+            lease_ttl = None
+            for i, (key, algorithm, limit, window) in enumerate(windows, start=blocking_count + 1):
+                share_of = SHARE_ALGORITHM.match(algorithm)
+                if share_of:
+                    used = self._get(key, now) or 0
+                    counts.append(used)
+                    share = shares.setdefault(share_of.group(1, 2), {
+                        "kind": share_of[1],
+                        "window_entry": int(share_of[2]),
+                        "own_unmet": 0,
+                        "owed": 0,
+                        "wait": 0,
+                        "own_index": blocking_count + int(share_of[2]),
+                    })
+                    unmet = max(0, limit - used)
+                    if share_of[3] == "1":
+                        share["own_unmet"] = unmet
+                        share["own_index"] = i
+                    elif used > 0:
+                        share["owed"] += unmet
+                    if used > 0:
+                        ttl = self._pttl(key, now)
+                        if ttl > 0 and (share["wait"] == 0 or ttl < share["wait"]):
+                            share["wait"] = ttl
+                    continue
+                count, room, wait, ttl = self._inspect(algorithm, key, limit, window, now, reserve)
+                counts.append(count)
+                rooms[i - blocking_count] = room
+                granted = min(granted, room)
+                if lease_ttl is None or ttl < lease_ttl:
+                    lease_ttl = ttl
+                if wait > 0 and blocked_index == 0:
+                    blocked_index = i
+                    retry_after = wait
+
+            if blocked_index == 0:
+                for share in shares.values():
+                    room = rooms[share["window_entry"]]
+                    share["allowed"] = min(room, max(share["own_unmet"], room - share["owed"]))
+                    granted = min(granted, share["allowed"])
+                    if share["allowed"] < 1 and blocked_index == 0:
+                        blocked_index = share["own_index"]
+                        retry_after = max(1, share["wait"])
+                        reason = share["kind"]
+
+            if blocked_index > 0:
+                return [0, retry_after, blocked_index, reason, 0, 0, *counts]
+
+            lease_ttl = lease_ttl or 0
+            if lease_ttl < min_lease_ttl:
+                granted = min(granted, 1)
+            stamps = []
+            for index, (key, algorithm, limit, window) in enumerate(windows):
+                share_of = SHARE_ALGORITHM.match(algorithm)
+                if not share_of:
+                    stamps.append(self._take(algorithm, key, limit, window, granted, now))
+                elif share_of[3] == "1":
+                    stamps.append(self._take("fixed", key, limit, window, granted, now))
+                else:
+                    stamps.append("")
+                    continue
+                counts[index] += granted
+
+            if granted < requested:
+                for key, algorithm, limit, window in windows:
+                    if not SHARE_ALGORITHM.match(algorithm):
+                        retry_after = max(retry_after, self._inspect(algorithm, key, limit, window, now, reserve)[2])
+                for share in shares.values():
+                    if share["allowed"] <= granted:
+                        retry_after = max(retry_after, share["wait"])
+            return [1, retry_after, 0, "allowed", granted, lease_ttl, *counts, *stamps]
+
+    async def refund(self, keys: list[str], args: list[int | str]):
+        with self._lock:
+            now = self._now()
+            unused = int(args[0])
+            for i, (key, algorithm, limit, window) in enumerate(self._windows(keys, args, 1, stride=4)):
+                stamp = str(args[i * 4 + 4])
+                if not stamp:
+                    continue
+                if algorithm == "gcra":
+                    tat = self._get(f"{key}:tat", now)
+                    if tat is None or f"{tat:.3f}" != stamp:
+                        continue  # A later request moved the TAT, or it lapsed
+                    refunded_tat = float(stamp) - unused * window / limit
+                    if refunded_tat + window <= now:
+                        self._delete(f"{key}:tat")
+                    else:
+                        self._set(f"{key}:tat", refunded_tat, now, px=math.ceil(refunded_tat - now) + window)
+                    key = f"{key}:count"
+                elif algorithm == "sliding":
+                    key = f"{key}:{stamp}"
+                elif now >= int(stamp):
+                    continue  # The counter rolled over, the tokens lapsed with it
+                # A missing counter means it already expired and the tokens lapsed with it
+                count = self._get(key, now) or 0
+                if count > 0:
+                    self._replace(key, count - min(count, unused), now)
+
+    async def reconcile(self, keys: list[str], args: list[int | str]) -> list[int]:
+        with self._lock:
+            now = self._now()
+            counts = []
+            for i, (key, algorithm, limit, window) in enumerate(self._windows(keys, args, 0, stride=4)):
+                riot_count = int(args[i * 4 + 3])
+                if algorithm == "gcra":
+                    behind = riot_count - (self._get(f"{key}:count", now) or 0)
+                    if behind > 0:
+                        tat = max(self._get(f"{key}:tat", now) or 0, now) + behind * window / limit
+                        self._set(f"{key}:tat", tat, now, px=math.ceil(tat - now) + window)
+                    key = f"{key}:count"
+                if algorithm == "sliding":
+                    count = self._sliding_counts(key, window, now)[1]
+                    if riot_count > count:
+                        current_key, _, _, ttl = self._sliding_bucket(key, window, now)
+                        self._fixed_take(current_key, ttl, riot_count - count, now)
+                else:
+                    count = self._get(key, now) or 0
+                    if riot_count > count:
+                        if self._pttl(key, now) > 0:
+                            self._replace(key, riot_count, now)
+                        else:
+                            self._set(key, riot_count, now, px=window)
+                counts.append(count)
+            return counts
+
+    async def extend_block(self, key: str, retry_after_ms: int) -> tuple[int, int]:
+        with self._lock:
+            now = self._now()
+            current_ttl = self._pttl(key, now)
+            exists = int(current_ttl != -2)
+            current_ttl = current_ttl if exists else 0
+            if not exists or retry_after_ms > current_ttl:
+                self._set(key, 1, now, px=retry_after_ms)
+            return exists, current_ttl
+
+    async def set_block(self, key: str, ttl_ms: int) -> int:
+        with self._lock:
+            now = self._now()
+            if self._get(key, now) is None:
+                self._set(key, 1, now, px=ttl_ms)
+            return self._pttl(key, now)
+
+    async def block_ttl(self, key: str) -> int:
+        with self._lock:
+            return self._pttl(key, self._now())
+
+    def _read_hash(self, key: str) -> dict[str, str]:
+        return dict(self._hashes.get(key, {}))
+
+    def _write_hash(self, key: str, fields: dict[str, str]):
+        self._hashes[key] = fields
+
+    async def get_hash(self, key: str) -> dict:
+        with self._lock:
+            return self._read_hash(key)
+
+    async def set_hash_field(self, key: str, field: str, value: str):
+        with self._lock:
+            self._write_hash(key, {**self._read_hash(key), field: value})
+
+    async def heartbeat(self, key: str, member: str, ttl_ms: int) -> list[str]:
+        # A hash of worker id -> monotonic deadline instead of FLEET_SCRIPT's sorted set
+        with self._lock:
+            now = self._now()
+            members = {name: deadline for name, deadline in self._read_hash(key).items() if int(deadline) > now}
+            if ttl_ms > 0:
+                members[member] = str(now + ttl_ms)
+            else:
+                members.pop(member, None)
+            self._write_hash(key, members)
+            return sorted(members)
+
+    async def acquire_slots(self, keys: list[str], args: list[int | str]) -> list[int]:
+        # Hashes of request token -> monotonic lease deadline instead of IN_FLIGHT_SCRIPT's sorted sets
+        token, lease_ms, limits = args[0], int(args[1]), args[2:]
+        with self._lock:
+            now = self._now()
+            semaphores = []
+            for i, (key, limit) in enumerate(zip(keys, limits), start=1):
+                leases = {name: deadline for name, deadline in self._read_hash(key).items() if int(deadline) > now}
+                if len(leases) >= int(limit):
+                    return [0, i, len(leases)]
+                semaphores.append((key, leases))
+            for key, leases in semaphores:
+                leases[token] = str(now + lease_ms)
+                self._write_hash(key, leases)
+            return [1, 0, 0]
+
+    async def release_slots(self, keys: list[str], token: str):
+        with self._lock:
+            for key in keys:
+                leases = self._read_hash(key)
+                if leases.pop(token, None) is not None:
+                    self._write_hash(key, leases)
+
+    async def publish(self, channel: str, message: str):
+        """Nothing to tell, every caller of this backend already reads the same keyspace."""
+
+    async def listen(self, channel: str):
+        return
+        yield
+
+
+class _HostLock:
+    """Exclusive across the threads of this process (threading.Lock) and across processes (fcntl.lockf on the table file)."""
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        finally:
+            self.thread_lock.release()
+
+
+class SharedMemoryBackend(InMemoryBackend):
+    """
+    InMemoryBackend whose keyspace lives in a memory mapped file, so every worker process on one host that opens the same path
+    shares one set of windows, blocking keys and discovered limits without a network hop (ex. path="/dev/shm/new_destiny").
+    The keyspace is a fixed size open addressing table of slots (key digest, value, monotonic deadline), in flight requests
+    take two per semaphore (see acquire_slots()), and every operation
+    holds an exclusive fcntl.lockf on the file for the few microseconds it runs, which makes it as atomic as its Lua script.
+    time.monotonic() is one clock for the whole host, so deadlines mean the same thing in every process.
+    Limits are only shared on this host, hosts that share an API key still need RedisBackend.
+    """
+    HEADER = struct.Struct("<8sIIq")  # magic, layout version, slot count, next sweep (monotonic milliseconds)
+    SLOT = struct.Struct("<B7xqd16s")  # state, deadline (0 when it never expires), value, key digest
+    MAGIC = b"NDLIMITS"
+    VERSION = 1
+    EMPTY, USED, DELETED = 0, 1, 2
+
+    def __init__(self, path: str, slots: int = 4096):
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryBackend needs fcntl, which is only available on POSIX systems.")
+        super().__init__()
+        self.path = path
+        self.slots = slots
+        self.hashes_path = f"{path}.hashes.json"  # Discovered limits and fleet heartbeats are rare, variable length writes
+        size = self.HEADER.size + slots * self.SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = _HostLock(self.fd)
+        with self._lock:
+            # The first process to get here lays the table out, the others check they agree with it
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.VERSION, slots, 0), 0)
+            magic, version, existing_slots, _ = self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))
+            if (magic, version, existing_slots) != (self.MAGIC, self.VERSION, slots):
+                raise ValueError(f"{path} is not a New Destiny table with {slots} slots. Delete it or pass the same slots every process uses.")
+        self.table = mmap.mmap(self.fd, size)
+
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def _offset(self, index: int) -> int:
+        return self.HEADER.size + index * self.SLOT.size
+
+    def _probe(self, key: str, now: int) -> tuple[int | None, int | None]:
+        """Offset of the key's live slot (None if absent) and of the first slot a new key could take (None if the table is full)."""
+        digest = self._digest(key)
+        start = int.from_bytes(digest[:8], "little") % self.slots
+        free = None
+        for step in range(self.slots):
+            offset = self._offset((start + step) % self.slots)
+            state, deadline, _, slot_digest = self.SLOT.unpack_from(self.table, offset)
+            if state == self.EMPTY:
+                return None, free if free is not None else offset
+            if state == self.USED and slot_digest == digest:
+                if deadline and deadline <= now:
+                    self.table[offset] = self.DELETED
+                    return None, free if free is not None else offset
+                return offset, None
+            if free is None and (state == self.DELETED or (deadline and deadline <= now)):
+                free = offset
+        return None, free
+
+    def _sweep(self, now: int):
+        """Rebuild the table without expired keys and tombstones, at most once per SWEEP_INTERVAL_MS across every process."""
+        magic, version, slots, next_sweep = self.HEADER.unpack_from(self.table, 0)
+        if now < next_sweep:
+            return
+        self.HEADER.pack_into(self.table, 0, magic, version, slots, now + self.SWEEP_INTERVAL_MS)
+        live = []
+        for index in range(self.slots):
+            state, deadline, value, digest = self.SLOT.unpack_from(self.table, self._offset(index))
+            if state == self.USED and not (deadline and deadline <= now):
+                live.append((deadline, value, digest))
+        self.table[self.HEADER.size:] = bytes(self.slots * self.SLOT.size)
+        for deadline, value, digest in live:
+            index = int.from_bytes(digest[:8], "little") % self.slots
+            while self.table[self._offset(index)] != self.EMPTY:
+                index = (index + 1) % self.slots
+            self.SLOT.pack_into(self.table, self._offset(index), self.USED, deadline, value, digest)
+
+    def _delete(self, key: str):
+        offset, _ = self._probe(key, 0)
+        if offset is not None:
+            self.table[offset] = self.DELETED
+
+    def _get(self, key: str, now: int) -> int | float | None:
+        offset, _ = self._probe(key, now)
+        if offset is None:
+            return None
+        value = self.SLOT.unpack_from(self.table, offset)[2]
+        return int(value) if value.is_integer() else value
+
+    def _pttl(self, key: str, now: int) -> int:
+        offset, _ = self._probe(key, now)
+        if offset is None:
+            return -2
+        deadline = self.SLOT.unpack_from(self.table, offset)[1]
+        return -1 if not deadline else deadline - now
+
+    def _write(self, key: str, value: int | float, now: int, deadline: int | None):
+        """Write a key's value, deadline=None keeps the one it has."""
+        offset, free = self._probe(key, now)
+        if offset is None:
+            if free is None:
+                raise RuntimeError(f"{self.path} is full. Create it with more slots (currently {self.slots}).")
+            offset, deadline = free, deadline or 0
+        elif deadline is None:
+            deadline = self.SLOT.unpack_from(self.table, offset)[1]
+        self.SLOT.pack_into(self.table, offset, self.USED, deadline, value, self._digest(key))
+
+    def _set(self, key: str, value: int | float, now: int, px: int | None = None):
+        self._write(key, value, now, 0 if px is None else now + px)
+
+    def _replace(self, key: str, value: int | float, now: int):
+        self._write(key, value, now, None)
+
+    def _pexpire(self, key: str, ttl_ms: int, now: int):
+        offset, _ = self._probe(key, now)
+        if offset is not None:
+            state, _, value, digest = self.SLOT.unpack_from(self.table, offset)
+            self.SLOT.pack_into(self.table, offset, state, now + ttl_ms, value, digest)
+
+    def _read_hashes(self) -> dict[str, dict[str, str]]:
+        try:
+            with open(self.hashes_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _read_hash(self, key: str) -> dict[str, str]:
+        return self._read_hashes().get(key, {})
+
+    def _write_hash(self, key: str, fields: dict[str, str]):
+        hashes = self._read_hashes()
+        hashes[key] = fields
+        # Written aside and renamed, so a crash never leaves half a file behind
+        with open(f"{self.hashes_path}.tmp", "w") as file:
+            json.dump(hashes, file)
+        os.replace(f"{self.hashes_path}.tmp", self.hashes_path)
+
+    @classmethod
+    def _token_id(cls, token: str) -> int:
+        # 48 bits of the token's digest, which a slot's double holds exactly
+        return int.from_bytes(cls._digest(token)[:6], "little")
+
+    async def acquire_slots(self, keys: list[str], args: list[int | str]) -> list[int]:
+        # Fixed size slots in the table instead of a hash rewritten per request: "{semaphore}:{i}" holds the id of the token
+        # leasing the i-th slot until the lease expires, "{semaphore}:{token}" which slot that is, for release_slots()
+        token, lease_ms, limits = args[0], int(args[1]), args[2:]
+        with self._lock:
+            now = self._now()
+            free = []
+            for i, (key, limit) in enumerate(zip(keys, limits), start=1):
+                index = next((index for index in range(int(limit)) if self._get(f"{key}:{index}", now) is None), None)
+                if index is None:
+                    return [0, i, int(limit)]
+                free.append((key, index))
+            token_id = self._token_id(token)
+            for key, index in free:
+                self._set(f"{key}:{index}", token_id, now, px=lease_ms)
+                self._set(f"{key}:{token}", index, now, px=lease_ms)
+            return [1, 0, 0]
+
+    async def release_slots(self, keys: list[str], token: str):
+        with self._lock:
+            now = self._now()
+            token_id = self._token_id(token)
+            for key in keys:
+                index = self._get(f"{key}:{token}", now)
+                if index is None:
+                    continue  # Never taken, or its lease expired
+                if self._get(f"{key}:{index}", now) == token_id:
+                    self._delete(f"{key}:{index}")
+                self._delete(f"{key}:{token}")
+
+    def close(self):
+        self.table.close()
+        os.close(self.fd)
+
+
+# async Redis client -> its RedisBackend, built once per client
+_redis_backends: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_rate_limit_backend(async_redis_client) -> RateLimitBackend:
+    """
+    The backend behind whatever was passed as async_redis_client: a RateLimitBackend is used as is,
+    anything else is taken for an async Redis client and wrapped in a RedisBackend.
+    """
+    if isinstance(async_redis_client, RateLimitBackend):
+        return async_redis_client
+    backend = _redis_backends.get(async_redis_client)
+    if backend is None:
+        backend = RedisBackend(async_redis_client)
+        _redis_backends[async_redis_client] = backend
+    return backend
@@ -0,0 +1,68 @@
+import hashlib
+from .rate_limit_helpers import parse_riot_rate_limit_header
+from .settings.config import ND_RIOT_API_KEY
+
+###### Rate Limit Discovery ######
+###### Rate Limit Discovery ######
+###### Rate Limit Discovery ######
+
+# Limits belong to an API key, so keys sharing one Redis instance do not overwrite each other's. The key itself never leaves the process.
+API_KEY_FINGERPRINT = hashlib.sha1(ND_RIOT_API_KEY.encode("utf-8")).hexdigest()[:12]
+
+
+class RateLimitDiscovery:
+    """
+    Process-wide record of the method limits Riot actually granted, learned from the X-Method-Rate-Limit header of its responses.
+    Discovered limits are persisted in one hash per API key and router in the RateLimitBackend, so every process (and every restart) uses them
+    ahead of the hard-coded RATE_LIMITS_BY_SERVICE_BY_METHOD table, which is only the cold-start fallback.
+    Limits are stored as {window in seconds: limit}, every window Riot reports is kept.
+    """
+    def __init__(self):
+        self._limits: dict[tuple[str, str], dict[int, int]] = {}
+        self._loaded: set[str] = set()
+
+    def redis_key(self, subdomain: str) -> str:
+        return f"nd_discovered_method_rate_limits_{API_KEY_FINGERPRINT}_{{{subdomain}}}"
+
+    @staticmethod
+    def normalize(limits: dict[int, int]) -> dict[int, int]:
+        """Shortest window first, so limits compare equal no matter the order Riot listed them in."""
+        return dict(sorted(limits.items()))
+
+    @staticmethod
+    def serialize(limits: dict[int, int]) -> str:
+        """Same limit:window format Riot's headers use, ex. "2000:10,60000:600"."""
+        return ",".join(f"{limit}:{window}" for window, limit in limits.items())
+
+    def get(self, subdomain: str, method: str) -> dict[int, int] | None:
+        return self._limits.get((subdomain, method))
+
+    def is_loaded(self, subdomain: str) -> bool:
+        return subdomain in self._loaded
+
+    async def load(self, subdomain: str, backend) -> list[str]:
+        """Read every method limit discovered for this router so far (by any process). Returns the methods whose limits changed."""
+        stored = await backend.get_hash(self.redis_key(subdomain))
+        self._loaded.add(subdomain)
+        changed = []
+        for method, header_value in stored.items():
+            method = method.decode() if isinstance(method, bytes) else method
+            header_value = header_value.decode() if isinstance(header_value, bytes) else header_value
+            limits = self.normalize(parse_riot_rate_limit_header(header_value))
+            if limits and self._limits.get((subdomain, method)) != limits:
+                self._limits[(subdomain, method)] = limits
+                changed.append(method)
+        return changed
+
+    async def observe(self, subdomain: str, method: str, limits: dict[int, int], backend) -> bool:
+        """Record limits Riot reported for a method. Returns True (and persists them) only when they are new."""
+        limits = self.normalize(limits)
+        if not limits or self._limits.get((subdomain, method)) == limits:
+            return False
+        self._limits[(subdomain, method)] = limits
+        await backend.set_hash_field(self.redis_key(subdomain), method, self.serialize(limits))
+        return True
+
+
+# One record for the whole process, every limiter instance shares it
+DISCOVERED_RATE_LIMITS = RateLimitDiscovery()
@@ -1,4 +1,5 @@
-from urllib.parse import urlparse, unquote
+from urllib.parse import urlparse, unquote, ParseResult
+from functools import lru_cache
 import re
 import json
 import gzip
@@ -6,38 +7,25 @@ import gzip
 ###### Helper Functions ######
 ###### Helper Functions ######
 ###### Helper Functions ######
-def derive_riot_service(riot_endpoint: str) -> str:
+def derive_riot_service(riot_endpoint: str | ParseResult) -> str:
+    """Return the Riot service (ex. "MATCH-V5") a URL belongs to. Resolved by the compiled endpoint router."""
     if isinstance(riot_endpoint, str):
-        path = urlparse(riot_endpoint).path.lower()
+        path = urlparse(riot_endpoint).path
     elif isinstance(riot_endpoint, ParseResult):
-        path = riot_endpoint.path.lower()    
+        path = riot_endpoint.path
     else:
         raise TypeError(f"Expected a str or ParseResult, got {type(riot_endpoint)}")
-    
-    if "/lol/summoner/v4" in path or "/fulfillment/v1" in path:
-        return "SUMMONER-V4"
-    elif "/lol/platform/v3" in path:
-        return "CHAMPION-V3"
-    elif '/lol/league/v4' in path:
-        return "LEAGUE-V4"
-    elif "/lol/league-exp/v4" in path:
-        return 'LEAGUE-EXP-V4'
-    elif "/lol/clash/v1" in path:
-        return "CLASH-V1"
-    elif "/riot/account/v1" in path:
-        return "ACCOUNT-V1"
-    elif "/lol/match/v5/" in path:
-        return "MATCH-V5"
-    elif "/lol/status/v4" in path:
-        return "LOL-STATUS-V4"
-    elif "/lol/challenges/v1" in path:
-        return "LOL-CHALLENGES-V1"
-    elif "lol/champion-mastery/v4" in path:
-        return "CHAMPION-MASTERY-V4"
-    elif "/lol/spectator/v5" in path:
-        return "SPECTATOR-V5"
-    else:
-        raise TypeError("No appropriate Riot Service could be determined.")
+
+    match = _match_riot_path(_normalize_path(path, riot_endpoint if isinstance(riot_endpoint, str) else ""))
+    if match is not None:
+        return match[0]
+
+    # Not a supported method, but the path may still belong to a known service. Keep the prefix check for that case.
+    path = path.lower()
+    for prefix, service in SERVICE_PATH_PREFIXES:
+        if prefix in path:
+            return service
+    raise TypeError("No appropriate Riot Service could be determined.")
 
 def derive_riot_method_config(
     riot_endpoint: str,
@@ -59,43 +47,138 @@ def derive_riot_method_config(
 
     Raises ValueError if service/method/router is unknown.
     """
-    rate_limits = RATE_LIMITS_BY_SERVICE_BY_METHOD
+    # look up service
+    if service not in RATE_LIMITS_BY_SERVICE_BY_METHOD:
+        raise ValueError(f"Unknown service: {service}")
+
+    path = _normalize_path(urlparse(riot_endpoint).path, riot_endpoint)
+    match = _match_riot_path(path)
+    if match is None or match[0] != service:
+        raise ValueError(f"No matching method for URL: {path} in service: {service}")
+
+    return _method_config_for_router(match[1], router)
+
+
+def resolve_riot_route(riot_endpoint: str) -> dict:
+    """
+    Resolve subdomain, service, method and the router's method limits of a Riot API URL in one pass.
+    Backed by one combined regex compiled at import from RATE_LIMITS_BY_SERVICE_BY_METHOD and an LRU of recently seen URLs,
+    so classifying an endpoint costs the same no matter how many methods the table grows to.
 
-    # normalize path
+    Returns a dict (shared by every caller of the same URL, do not mutate it):
+        {
+          "subdomain": "<your router>",
+          "service":   ...,
+          "method":    ...,
+          "pattern":   ...,
+          "router":    "<your router>",
+          "seconds":   {"limit": X, "window": Y},
+          "minutes":   {"limit": A, "window": B},
+        }
+
+    Raises the same errors as derive_riot_service() and derive_riot_method_config().
+    """
+    return _resolve_riot_route(riot_endpoint)
+
+
+@lru_cache(maxsize=8192)
+def _resolve_riot_route(riot_endpoint: str) -> dict:
     parsed = urlparse(riot_endpoint)
-    path = unquote(parsed.path or riot_endpoint)
+    hostname = parsed.hostname  # Ex. "na1.api.riotgames.com"
+    if not hostname:
+        raise ValueError(f"Invalid URL: No hostname found. Subdomain (what Riot docs inaccurately calls per 'region' for per-region enforcement) cannot be determined from {riot_endpoint}")
+    subdomain = hostname.split(".")[0].lower()  # Extracts "na1" from "na1.api.riotgames.com"
+
+    match = _match_riot_path(_normalize_path(parsed.path, riot_endpoint))
+    if match is None:
+        # Raise exactly what the per-step helpers would have raised
+        service = derive_riot_service(parsed)
+        derive_riot_method_config(riot_endpoint, subdomain, service)
+        raise ValueError(f"No matching method for URL: {parsed.path} in service: {service}")
+
+    service, method_cfg = match
+    return {"subdomain": subdomain, "service": service, **_method_config_for_router(method_cfg, subdomain)}
+
+
+def _normalize_path(path: str, riot_endpoint: str) -> str:
+    path = unquote(path or riot_endpoint)
     if not path.startswith("/"):
         path = "/" + path
+    return path
 
-    # look up service
-    if service not in rate_limits:
-        raise ValueError(f"Unknown service: {service}")
 
-    # find matching method
-    for method_cfg in rate_limits[service]:
-        if re.match(method_cfg["pattern"], path):
-            routers_cfg = method_cfg.get("routers", {})
+def _match_riot_path(path: str) -> tuple[str, dict] | None:
+    """Return (service, method_cfg) of the first method in table order whose pattern matches the path."""
+    # First trie level: the literal "/lol/match/v5" style prefix picks the handful of methods that can possibly match
+    regex = _ROUTER_REGEX_BY_PREFIX.get(tuple(path.split("/", 4)[1:4]))
+    if regex is None:
+        return None
+    match = regex.match(path)
+    if match is None:
+        return None
+    return _ROUTER_TARGETS[match.lastgroup]
 
-            # pick your router's limits or fallback to default
-            if router in routers_cfg:
-                limit_cfg = routers_cfg[router]
-            elif "default" in routers_cfg:
-                limit_cfg = routers_cfg["default"]
-            else:
-                raise ValueError(
-                    f"No rate‐limit entry for router '{router}' "
-                    f"in method {method_cfg['method']}"
-                )
 
-            return {
-                "method":  method_cfg["method"],
-                "pattern": method_cfg["pattern"],
-                "router":  router,
-                "seconds": limit_cfg.get("seconds", {}),
-                "minutes": limit_cfg.get("minutes", {}),
-            }
+def _method_config_for_router(method_cfg: dict, router: str) -> dict:
+    routers_cfg = method_cfg.get("routers", {})
+
+    # pick your router's limits or fallback to default
+    if router in routers_cfg:
+        limit_cfg = routers_cfg[router]
+    elif "default" in routers_cfg:
+        limit_cfg = routers_cfg["default"]
+    else:
+        raise ValueError(
+            f"No rate‐limit entry for router '{router}' "
+            f"in method {method_cfg['method']}"
+        )
+
+    return {
+        "method":  method_cfg["method"],
+        "pattern": method_cfg["pattern"],
+        "router":  router,
+        "seconds": limit_cfg.get("seconds", {}),
+        "minutes": limit_cfg.get("minutes", {}),
+    }
 
-    raise ValueError(f"No matching method for URL: {path} in service: {service}")
+
+def compile_riot_router(rate_limits: dict) -> tuple[dict[tuple[str, ...], re.Pattern], dict[str, tuple[str, dict]]]:
+    """
+    Compile the rate limit table into a small routing engine:
+    methods are bucketed by the first three literal path segments of their pattern (ex. ("lol", "match", "v5")),
+    and every bucket is one regex with a named group per method. Alternation is tried in table order,
+    so the first matching method wins exactly like the old linear re.match scan.
+    """
+    alternatives_by_prefix: dict[tuple[str, ...], list[str]] = {}
+    targets = {}
+    for service, method_cfgs in rate_limits.items():
+        for method_cfg in method_cfgs:
+            group = f"m{len(targets)}"
+            literal_path = method_cfg["pattern"].lstrip("^").replace("\\/", "/")
+            prefix = tuple(literal_path.split("/", 4)[1:4])
+            if any(not segment or "(" in segment or "$" in segment for segment in prefix):
+                raise ValueError(f"Method pattern needs a three segment literal prefix to be routed: {method_cfg['pattern']}")
+            # Inner capture groups stay as they are, only the named wrapper group is used to identify the method
+            alternatives_by_prefix.setdefault(prefix, []).append(f"(?P<{group}>{method_cfg['pattern']})")
+            targets[group] = (service, method_cfg)
+    regex_by_prefix = {prefix: re.compile("|".join(alternatives)) for prefix, alternatives in alternatives_by_prefix.items()}
+    return regex_by_prefix, targets
+
+
+def parse_riot_rate_limit_header(header_value: str | None) -> dict[int, int]:
+    """
+    Parse a Riot rate limit header into {window in seconds: value}.
+    Works for both the limit headers (X-App-Rate-Limit: "20:1,100:120", limit:window)
+    and the count headers (X-App-Rate-Limit-Count: "1:1,1:120", count:window). Malformed entries are skipped.
+    """
+    parsed: dict[int, int] = {}
+    if not header_value:
+        return parsed
+    for entry in header_value.split(","):
+        value, _, window = entry.strip().partition(":")
+        if value.isdigit() and window.isdigit():
+            parsed[int(window)] = int(value)
+    return parsed
 
 
 LOL_PLATFORM_ROUTERS = (
@@ -1429,3 +1512,23 @@ RATE_LIMITS_BY_SERVICE_BY_METHOD = {
         },
     ],
 }
+
+
+# Substring prefixes, only used to name the service of a URL that matches no supported method
+SERVICE_PATH_PREFIXES = (
+    ("/lol/summoner/v4", "SUMMONER-V4"),
+    ("/fulfillment/v1", "SUMMONER-V4"),
+    ("/lol/platform/v3", "CHAMPION-V3"),
+    ("/lol/league/v4", "LEAGUE-V4"),
+    ("/lol/league-exp/v4", "LEAGUE-EXP-V4"),
+    ("/lol/clash/v1", "CLASH-V1"),
+    ("/riot/account/v1", "ACCOUNT-V1"),
+    ("/lol/match/v5/", "MATCH-V5"),
+    ("/lol/status/v4", "LOL-STATUS-V4"),
+    ("/lol/challenges/v1", "LOL-CHALLENGES-V1"),
+    ("lol/champion-mastery/v4", "CHAMPION-MASTERY-V4"),
+    ("/lol/spectator/v5", "SPECTATOR-V5"),
+)
+
+# Compiled once at import
+_ROUTER_REGEX_BY_PREFIX, _ROUTER_TARGETS = compile_riot_router(RATE_LIMITS_BY_SERVICE_BY_METHOD)
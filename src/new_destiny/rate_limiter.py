@@ -1,8 +1,22 @@
+import asyncio
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Awaitable, Callable, TypedDict
 from urllib.parse import urlparse
-from .rate_limit_helpers import derive_riot_service, derive_riot_method_config
-from .exceptions import ApplicationRateLimitExceeded, MethodRateLimitExceeded, ServiceRateLimitExceeded, UnspecifiedRateLimitExceeded
-from .settings.config import ND_CUSTOM_MINUTES_LIMIT, ND_CUSTOM_MINUTES_WINDOW, ND_CUSTOM_SECONDS_LIMIT, ND_CUSTOM_SECONDS_WINDOW, ND_PRODUCTION
+from .rate_limit_helpers import derive_riot_service, derive_riot_method_config, resolve_riot_route, parse_riot_rate_limit_header
+from .exceptions import ApplicationRateLimitExceeded, MethodRateLimitExceeded, ServiceRateLimitExceeded, UnspecifiedRateLimitExceeded, InFlightLimitExceeded, RiotRelatedRateLimitException, RateLimitWindow
+from .settings.config import ND_CUSTOM_APPLICATION_LIMITS, ND_CUSTOM_MINUTES_LIMIT, ND_CUSTOM_MINUTES_WINDOW, ND_CUSTOM_SECONDS_LIMIT, ND_CUSTOM_SECONDS_WINDOW, ND_PRODUCTION, ND_RATE_LIMIT_ALGORITHM, RATE_LIMIT_ALGORITHMS, ND_LEASE_SIZE, ND_LEASE_TTL_MS, PRIORITY_CLASSES, ND_INTERACTIVE_RESERVE, ND_APPLICATION_SHARES, ND_FLEET_HEARTBEAT_MS, FLEET_MISSED_HEARTBEATS, ND_MAX_IN_FLIGHT_PER_ROUTER, ND_MAX_IN_FLIGHT_PER_METHOD, ND_IN_FLIGHT_LEASE_MS
 from .json_types import RiotOffendingContext
+from .script_registry import SCRIPT_REGISTRY
+from .rate_limit_backends import ADMISSION_SCRIPT, BLOCKING_SCRIPT, RateLimitBackend, get_rate_limit_backend
+from .rate_limit_discovery import DISCOVERED_RATE_LIMITS
+from .blocking_cache import BLOCKING_CACHE
+from .block_events import BLOCK_EVENTS_CHANNEL, BlockEvent, encode_block_event, decode_block_event, remaining_ms
+from .fleet import FLEET, FLEET_KEY
+from .headroom import HEADROOM
+from redis.exceptions import RedisError
 
 ###### Rate Limier Classes ###########
 ###### Rate Limier Classes ###########
@@ -10,13 +24,144 @@ from .json_types import RiotOffendingContext
 ###### All time units are seconds ####
 ###### ex. minutes_windows = 600 is ##
 ###### == 10 minutes #################
+###### Redis TTLs, Lua script ########
+###### windows and retry_after_ms ####
+###### are milliseconds ##############
+
+# event loop -> {waiter scope: FIFO lock}. asyncio.Lock wakes waiters in the order they called acquire().
+_waiter_locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _waiter_lock(scope: tuple) -> asyncio.Lock:
+    locks = _waiter_locks.setdefault(asyncio.get_running_loop(), {})
+    lock = locks.get(scope)
+    if lock is None:
+        lock = asyncio.Lock()
+        locks[scope] = lock
+    return lock
+
+
+async def wait_for_admission(scope: tuple, attempt: Callable[[], Awaitable[bool]], timeout: float | None = None) -> bool:
+    """
+    Park the calling coroutine until attempt() stops raising a RiotRelatedRateLimitException, instead of raising on a full window.
+    Waiters of the same scope are admitted in FIFO order: only the head of the line talks to Redis,
+    sleeps exactly the retry_after_ms it was told and tries again. Everyone else waits their turn without any round trips.
+    timeout is the total number of seconds the caller is willing to wait (None waits indefinitely).
+    Raises the last rate limit exception when the next slot opens after the timeout, also when the caller is still waiting in line.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    try:
+        async with asyncio.timeout_at(deadline):
+            await _waiter_lock(scope).acquire()
+    except TimeoutError:
+        # Out of time before its turn came: one attempt out of turn raises the scope's exception with its retry_after_ms
+        return await attempt()
+    try:
+        while True:
+            try:
+                return await attempt()
+            except RiotRelatedRateLimitException as exc:
+                retry_after = exc.retry_after_ms / 1000
+                if deadline is not None and loop.time() + retry_after > deadline:
+                    raise
+                await asyncio.sleep(retry_after)
+    finally:
+        _waiter_lock(scope).release()
+
+
+def validate_rate_limit_algorithm(algorithm: str) -> str:
+    if algorithm not in RATE_LIMIT_ALGORITHMS:
+        raise ValueError(f"Unknown rate limit algorithm '{algorithm}'. Choose one of {', '.join(RATE_LIMIT_ALGORITHMS)}.")
+    return algorithm
+
+
+def validate_priority(priority: str) -> str:
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority '{priority}'. Choose one of {', '.join(PRIORITY_CLASSES)}.")
+    return priority
+
+
+def priority_reserve(priority: str) -> float:
+    """Share of every application and method limit a priority class may not use, it is held back for the classes above it."""
+    return ND_INTERACTIVE_RESERVE if priority == "batch" else 0
+
+
+class RateLimitDrift(TypedDict):
+    """
+    How far New Destiny's window counts fell behind the counts Riot reports on its responses, see get_rate_limit_drift().
+    Drift is Riot's count minus ours when Riot saw requests we did not count (ex. another service sharing the key),
+    responses whose counts were not behind are not samples.
+    """
+    samples: int
+    last: int
+    max: int
+    total: int
+
+
+# (subdomain, tier, method or None for the application tier, window in seconds) -> drift
+_rate_limit_drift: dict[tuple[str, str, str | None, int], RateLimitDrift] = {}
+
+
+def record_rate_limit_drift(key: tuple[str, str, str | None, int], drift: int):
+    stats = _rate_limit_drift.get(key)
+    if stats is None:
+        _rate_limit_drift[key] = {"samples": 1, "last": drift, "max": drift, "total": drift}
+        return
+    stats["samples"] += 1
+    stats["last"] = drift
+    stats["max"] = max(stats["max"], drift)
+    stats["total"] += drift
+
+
+def get_rate_limit_drift() -> dict[tuple[str, str, str | None, int], RateLimitDrift]:
+    """
+    Snapshot of how far this process's window counts drifted from Riot's, keyed by (subdomain, tier, method, window in seconds).
+    method is None for the application tier. Average drift is total / samples.
+    """
+    return {key: dict(stats) for key, stats in _rate_limit_drift.items()}
+
+
+class SlotReservation(TypedDict):
+    """
+    Result of a check_and_increment_many(n) call (or admit_one(), a reservation of 1).
+    granted is how many of the requested slots were reserved (at least 1, otherwise the rate limit exception is raised).
+    retry_after_ms is how long until the rest can start being admitted, 0 when everything was granted.
+    counts is every window's count with the granted requests in it, see AdmissionVerdict.
+    stamps is where the granted requests were counted in every window, see AdmissionVerdict.
+    """
+    requested: int
+    granted: int
+    retry_after_ms: int
+    counts: list[int]
+    stamps: list[str]
+
+
+class WindowReservation(SlotReservation):
+    """
+    Result of a WindowedRateLimitingLogic.reserve(n) call, which may reserve nothing: allowed is False and granted 0 then.
+    retry_after_ms is then how long until the next request fits, and reason is "blocking_key" or the violated window type.
+    """
+    allowed: bool
+    reason: str
+
+
+def _one_slot(counts: list[int], stamps: list[str]) -> SlotReservation:
+    return {"requested": 1, "granted": 1, "retry_after_ms": 0, "counts": counts, "stamps": stamps}
+
 
 class BaseRateLimitingLogic:
-    """Base class for rate limiting logic using Redis."""
+    """
+    Base class for rate limiting logic using Redis.
+    async_redis_client is an async Redis client or any RateLimitBackend (ex. InMemoryBackend), see get_rate_limit_backend().
+    """
     def __init__(self, riot_endpoint: str, async_redis_client):
         self.riot_endpoint = riot_endpoint
         self.subdomain = self.get_subdomain(riot_endpoint)
-        self.redis = async_redis_client
+        self.backend: RateLimitBackend | None = get_rate_limit_backend(async_redis_client) if async_redis_client is not None else None
+        # Redis Cluster hash tag: every key of a subdomain lands in the same slot, so the multi-key Lua scripts never hit CROSSSLOT.
+        # Different subdomains (routers) spread across shards.
+        self.key_tag = f"{{{self.subdomain}}}"
 
     def get_subdomain(self, riot_endpoint: str):
         parsed_url = urlparse(riot_endpoint)
@@ -28,44 +173,131 @@ class BaseRateLimitingLogic:
         subdomain = hostname.split(".")[0]  # Extracts "na1" from "na1.api.riotgames.com"
         return subdomain.lower()
 
+    def backend_for(self, async_redis_client=None) -> RateLimitBackend:
+        """The backend of a per call client override, or the one this limiter was built with."""
+        return self.backend if async_redis_client is None else get_rate_limit_backend(async_redis_client)
 
-class ApplicationRateLimiter(BaseRateLimitingLogic):
-    """Rate limiter for app-wide rate limits per subdomain (what Riot incorrectly calls region)."""
-    def __init__(self, riot_endpoint: str, async_redis_client):
-        super().__init__(riot_endpoint, async_redis_client)
-        if ND_PRODUCTION:
-            # Limit / max count for the two types of rate limits
-            self.seconds_limit: int = ND_CUSTOM_SECONDS_LIMIT or 500
-            self.minutes_limit: int = ND_CUSTOM_MINUTES_LIMIT or 30000
-            # Validity windows in seconds for the two types of rate limits
-            self.seconds_window: int = ND_CUSTOM_SECONDS_WINDOW or 10
-            self.minutes_window: int = ND_CUSTOM_MINUTES_WINDOW or 600
+    async def announce_block(self, tier: str, key: str, ttl_ms: int, method: str | None = None):
+        """Remember an inbound 429's blocking key locally and publish it to every other process, see BlockEventSubscriber."""
+        BLOCKING_CACHE.block(self.backend.lease_scope, key, ttl_ms)
+        if ttl_ms > 0:
+            await self.backend.publish(BLOCK_EVENTS_CHANNEL, encode_block_event(tier, self.subdomain, method, key, ttl_ms))
+
+
+def window_types_for(windows: list[int]) -> list[str]:
+    """
+    Names of a limiter's windows, shortest first. The shortest and longest keep their historical "seconds" and "minutes"
+    names (and Redis keys), any window in between is named after its length, ex. "120_seconds".
+    """
+    if len(windows) == 1:
+        return ["seconds"]
+    return ["seconds", *(f"{window}_seconds" for window in windows[1:-1]), "minutes"]
+
+
+class WindowedRateLimitingLogic(BaseRateLimitingLogic):
+    """
+    Base class for the counting rate limiters (application and method) which enforce any number of (limit, window) pairs.
+    Every window is checked and incremented atomically in one call of the shared ADMISSION_SCRIPT.
+    seconds_* and minutes_* describe the shortest and longest window, minutes_* are None when there is only one.
+    """
+    def set_limits(self, limits: list[tuple[int, int]]):
+        """(limit, window in seconds) pairs, in any order."""
+        if not limits:
+            raise TypeError("Logical mistake was made. A rate limit must have at least one (limit, window) pair.")
+        self.limits: list[tuple[int, int]] = sorted(limits, key=lambda pair: pair[1])
+        self.window_types: list[str] = window_types_for([window for _, window in self.limits])
+        self.window_keys: list[str] = [self.generate_key(window_type) for window_type in self.window_types]
+
+        (self.seconds_limit, self.seconds_window), self.seconds_key = self.limits[0], self.window_keys[0]
+        if len(self.limits) > 1:
+            (self.minutes_limit, self.minutes_window), self.minutes_key = self.limits[-1], self.window_keys[-1]
         else:
-            # Limit / max count for the two types of rate limits
-            self.seconds_limit: int = 20
-            self.minutes_limit:int = 100
-            # Validity windows in seconds for the two types of rate limits
-            self.seconds_window: int = 1
-            self.minutes_window: int = 120
+            self.minutes_limit = self.minutes_window = self.minutes_key = None
+
+    def window_states(self, counts: list[int] | None = None) -> list[RateLimitWindow]:
+        """Every window's type, key, limit and window, with its count when known (internally enforced)."""
+        counts = counts or [None] * len(self.limits)
+        return [
+            {"window_type": window_type, "key": key, "limit": limit, "window": window, "count": count}
+            for window_type, key, (limit, window), count in zip(self.window_types, self.window_keys, self.limits, counts)
+        ]
+
+    async def reserve(self, n: int) -> WindowReservation:
+        """
+        Run the admission script over the blocking key and every window, reserving up to n requests.
+        A blocking key already known to be set is answered locally, see BLOCKING_CACHE.
+        """
+        _, blocked_ms = BLOCKING_CACHE.check(self.backend.lease_scope, [self.blocking_key])
+        if blocked_ms:
+            return {
+                "allowed": False,
+                "reason": "blocking_key",
+                "requested": n,
+                "granted": 0,
+                "retry_after_ms": blocked_ms,
+                "counts": [],
+                "stamps": [],
+            }
+
+        args: list[int | str] = [1]  # number of blocking keys
+        for limit, window in self.limits:
+            args.extend((self.algorithm, limit, window * 1000))
+
+        args.append(n)  # requested
+        result = await self.backend.admit([self.blocking_key, *self.window_keys], args)
+
+        is_allowed, retry_after, blocked_index, reason, granted, _, *counts = result
+        counts, stamps = counts[:len(self.window_keys)], counts[len(self.window_keys):]
+        if reason == "blocking_key":
+            BLOCKING_CACHE.block(self.backend.lease_scope, self.blocking_key, int(retry_after))
+        elif reason == "limit":
+            reason = self.window_types[blocked_index - 2]  # Lua is 1-indexed and the blocking key comes first
+        return {
+            "allowed": is_allowed == 1,
+            "reason": reason,
+            "requested": n,
+            "granted": int(granted),
+            "retry_after_ms": int(retry_after),
+            "counts": [int(count) for count in counts],
+            "stamps": stamps,
+        }
+
+
+class ApplicationRateLimiter(WindowedRateLimitingLogic):
+    """
+    Rate limiter for app-wide rate limits per subdomain (what Riot incorrectly calls region).
+    algorithm picks how windows are counted, see RATE_LIMIT_ALGORITHMS. Defaults to ND_RATE_LIMIT_ALGORITHM.
+    limits overrides the configured (limit, window in seconds) pairs, any number of windows is enforced.
+    """
+    def __init__(self, riot_endpoint: str, async_redis_client, algorithm: str | None = None, limits: list[tuple[int, int]] | None = None):
+        super().__init__(riot_endpoint, async_redis_client)
+        self.algorithm: str = validate_rate_limit_algorithm(algorithm or ND_RATE_LIMIT_ALGORITHM)
+        if limits is None and ND_PRODUCTION:
+            # (limit / max count, validity window in seconds) for every application rate limit
+            limits = ND_CUSTOM_APPLICATION_LIMITS or [
+                (ND_CUSTOM_SECONDS_LIMIT or 500, ND_CUSTOM_SECONDS_WINDOW or 10),
+                (ND_CUSTOM_MINUTES_LIMIT or 30000, ND_CUSTOM_MINUTES_WINDOW or 600),
+            ]
+        elif limits is None:
+            limits = [(20, 1), (100, 120)]
         # Redis keys that will identify what application rate limit we are checking
-        self.seconds_key: str = self.generate_key("seconds")
-        self.minutes_key: str = self.generate_key("minutes")
+        self.set_limits(limits)
         self.blocking_key: str = self.generate_blocking_key()
 
-        # Initialize script content but don't load yet
+        # Script content is loaded lazily, once per Redis connection pool, by the process-wide SCRIPT_REGISTRY
         self.check_and_increment_script_content = self.get_check_and_increment_script()
         self.blocking_script_content = self.get_blocking_script()
         
-        # SHA values will be set during initialization
-        self.check_and_increment_sha = None
-        self.blocking_script_sha = None
+        # SHA values are computed locally and cached for the life of the process
+        self.check_and_increment_sha = SCRIPT_REGISTRY.sha(self.check_and_increment_script_content)
+        self.blocking_script_sha = SCRIPT_REGISTRY.sha(self.blocking_script_content)
 
     def generate_key(self, window_type):
         """
         Generate application rate limit keys.
         This holds an integer count value that gets incremented by 1 per request. One half of what is_allowed() checks.
         """
-        return f"nd_application_rate_limit_{self.subdomain}_key_for_{window_type}"
+        return f"nd_application_rate_limit_{self.key_tag}_key_for_{window_type}"
     
     def generate_blocking_key(self):
         """
@@ -75,122 +307,41 @@ class ApplicationRateLimiter(BaseRateLimitingLogic):
         then we use this blocking key with a TTL set to the "Retry-After" header's integer value so we respect the timeout
         for as long as it is valid whether or not our internal counts hit their limit.
         """
-        return f"nd_blocking_key_for_application_rate_limit_{self.subdomain}"
+        return f"nd_blocking_key_for_application_rate_limit_{self.key_tag}"
 
 
     def get_check_and_increment_script(self):
-        """Returns the Lua script content for atomic check and increment operations."""
-        return """
-        -- Keys: [seconds_key, minutes_key, blocking_key]
-        -- Args: [seconds_limit, minutes_limit, seconds_window, minutes_window]
-        
-        local seconds_key = KEYS[1]
-        local minutes_key = KEYS[2]
-        local blocking_key = KEYS[3]
-        
-        local seconds_limit = tonumber(ARGV[1])
-        local minutes_limit = tonumber(ARGV[2])
-        local seconds_window = tonumber(ARGV[3])
-        local minutes_window = tonumber(ARGV[4])
-        
-        -- Check if blocking key exists (external rate limit was hit)
-        local is_blocked = redis.call('EXISTS', blocking_key)
-        if is_blocked == 1 then
-            local block_ttl = redis.call('TTL', blocking_key)
-            return {0, block_ttl, 0, 0, "blocking_key"}
-        end
-        
-        -- Get current counts
-        local seconds_count = tonumber(redis.call('GET', seconds_key) or "0")
-        local minutes_count = tonumber(redis.call('GET', minutes_key) or "0")
-        
-        -- Check if limits exceeded
-        if seconds_count >= seconds_limit then
-            local seconds_ttl = redis.call('TTL', seconds_key)
-            return {0, seconds_ttl, seconds_count, minutes_count, "seconds"}
-        end
-        
-        if minutes_count >= minutes_limit then
-            local minutes_ttl = redis.call('TTL', minutes_key)
-            return {0, minutes_ttl, seconds_count, minutes_count, "minutes"}
-        end
-        
-        -- Increment counts and set expiry if needed
-        -- Handle seconds key
-        local seconds_exists = redis.call('EXISTS', seconds_key)
-        redis.call('INCR', seconds_key)
-        if seconds_exists == 0 then
-            redis.call('EXPIRE', seconds_key, seconds_window)
-        end
-        
-        -- Handle minutes key
-        local minutes_exists = redis.call('EXISTS', minutes_key)
-        redis.call('INCR', minutes_key)
-        if minutes_exists == 0 then
-            redis.call('EXPIRE', minutes_key, minutes_window)
-        end
-        
-        -- Return success and new counts
-        return {1, 0, seconds_count + 1, minutes_count + 1, "allowed"}
-        """
+        """Returns the Lua script content for atomic check and increment operations. Shared by every limiter, see ADMISSION_SCRIPT."""
+        return ADMISSION_SCRIPT
     
     def get_blocking_script(self):
-        """Returns the Lua script content for handling blocking keys."""
-        return """
-        local blocking_key = KEYS[1]
-        local retry_after = tonumber(ARGV[1])
-        
-        -- Check if key exists and get its TTL
-        local exists = redis.call('EXISTS', blocking_key)
-        local current_ttl = 0
-        
-        if exists == 1 then
-            current_ttl = redis.call('TTL', blocking_key)
-        end
-        
-        -- Only set the key if it doesn't exist OR if new retry_after is longer than remaining TTL
-        if exists == 0 or retry_after > current_ttl then
-            redis.call('SET', blocking_key, 1, 'EX', retry_after)
-        end
-        
-        return {exists, current_ttl}
-        """
+        """Returns the Lua script content for handling blocking keys. Shared by every limiter, see BLOCKING_SCRIPT."""
+        return BLOCKING_SCRIPT
     
     async def initialize_scripts(self):
-        """Initialize the Lua scripts and store their SHA values."""
-        if self.check_and_increment_sha is None:
-            self.check_and_increment_sha = await self.redis.script_load(self.check_and_increment_script_content)
-        
-        if self.blocking_script_sha is None:
-            self.blocking_script_sha = await self.redis.script_load(self.blocking_script_content)
+        """Make sure the Lua scripts are loaded on this Redis connection pool. Only the first call per pool does a round trip."""
+        await self.backend.initialize()
     
     async def check_and_increment(self):
         """
         Atomically check if the request is allowed and increment counters if it is.
         Returns True if allowed, raises exception otherwise.
         """
-        # Make sure scripts are initialized
-        if self.check_and_increment_sha is None:
-            await self.initialize_scripts()
-        
-        # Execute the Lua script using the stored SHA
-        result = await self.redis.evalsha(
-            self.check_and_increment_sha,
-            3,  # number of keys
-            self.seconds_key, 
-            self.minutes_key, 
-            self.blocking_key,
-            self.seconds_limit, 
-            self.minutes_limit, 
-            self.seconds_window, 
-            self.minutes_window
-        )
-        
-        is_allowed, retry_after, seconds_count, minutes_count, reason = result
+        await self.check_and_increment_many(1)
+        return True
+
+    async def check_and_increment_many(self, n: int) -> SlotReservation:
+        """
+        Atomically reserve up to n requests, as many as every window has room for, in one round trip.
+        Returns how many were granted and how long until the rest can start being admitted, raises exception if none were.
+        """
+        reservation = await self.reserve(n)
+        counts = reservation["counts"]
         
-        if is_allowed == 0:  # Request not allowed
+        if not reservation["allowed"]:  # Request not allowed
+            seconds_count, minutes_count = (counts[0], counts[-1] if len(counts) > 1 else None) if counts else (None, None)
             raise ApplicationRateLimitExceeded(
-                retry_after=retry_after if retry_after >= 1 else 1,
+                retry_after_ms=max(1, reservation["retry_after_ms"]),
                 minutes_key=self.minutes_key,
                 seconds_key=self.seconds_key,
                 seconds_window=self.seconds_window,
@@ -202,10 +353,24 @@ class ApplicationRateLimiter(BaseRateLimitingLogic):
                 seconds_limit=self.seconds_limit,
                 minutes_count=minutes_count,
                 minutes_limit=self.minutes_limit,
-                reason=f"The '{reason}' key count/limit/existence was violated."
+                windows=self.window_states(counts or None),
+                reason=f"The '{reservation['reason']}' key count/limit/existence was violated."
             )
         
-        return True
+        return {
+            "requested": n,
+            "granted": reservation["granted"],
+            "retry_after_ms": reservation["retry_after_ms"],
+            "counts": counts,
+            "stamps": reservation["stamps"],
+        }
+
+    async def acquire(self, timeout: float | None = None):
+        """
+        Like check_and_increment() but waits for the next open slot instead of raising, see wait_for_admission().
+        Waiters for this subdomain's application limit are admitted in FIFO order.
+        """
+        return await wait_for_admission(("application", self.subdomain), self.check_and_increment, timeout)
 
     async def write_inbound_application_rate_limit(self, retry_after: int, offending_context: RiotOffendingContext):
         """
@@ -216,25 +381,15 @@ class ApplicationRateLimiter(BaseRateLimitingLogic):
         if not retry_after:
             retry_after = 68
             
-        # Make sure scripts are initialized
-        if self.blocking_script_sha is None:
-            await self.initialize_scripts()
-        
-        # Execute the blocking script using the stored SHA
-        result = await self.redis.evalsha(
-            self.blocking_script_sha,
-            1,  # number of keys
-            self.blocking_key,
-            retry_after
-        )
-        
-        exists, current_ttl = result
+        # Set or extend the blocking key, atomically
+        exists, current_ttl = await self.backend.extend_block(self.blocking_key, retry_after * 1000)
         
         # Use the max of the existing TTL and new retry_after to ensure we respect the longest timeout
-        effective_retry_after = max(retry_after, current_ttl) if exists else retry_after
+        effective_retry_after_ms = max(retry_after * 1000, current_ttl) if exists else retry_after * 1000
+        await self.announce_block("application", self.blocking_key, effective_retry_after_ms)
         
         raise ApplicationRateLimitExceeded(
-            retry_after=effective_retry_after,
+            retry_after_ms=effective_retry_after_ms,
             minutes_key=self.minutes_key,
             seconds_key=self.seconds_key,
             seconds_window=self.seconds_window,
@@ -245,44 +400,53 @@ class ApplicationRateLimiter(BaseRateLimitingLogic):
             offending_context=offending_context,
             seconds_limit=self.seconds_limit,
             minutes_limit=self.minutes_limit,
+            windows=self.window_states(),
             reason="Inbound 429 actually experienced. Did not prevent Riot from serving a 429."
         )
 
 
-class MethodRateLimiter(BaseRateLimitingLogic):
+class MethodRateLimiter(WindowedRateLimitingLogic):
     """
     Rate limiter that respects method (i.e. endpoint) based rate limits per subdomain
     (A subdomain is what Riot incorrectly calls 'region' in their docs or what the 3rd Party Developer community calls a 'platform router').
+    algorithm picks how windows are counted, see RATE_LIMIT_ALGORITHMS. Defaults to ND_RATE_LIMIT_ALGORITHM.
+    limits overrides the (limit, window in seconds) pairs of the method, any number of windows is enforced.
     """
 
-    def __init__(self, riot_endpoint: str, async_redis_client):
+    def __init__(self, riot_endpoint: str, async_redis_client, algorithm: str | None = None, limits: list[tuple[int, int]] | None = None):
         super().__init__(riot_endpoint, async_redis_client)
+        self.algorithm: str = validate_rate_limit_algorithm(algorithm or ND_RATE_LIMIT_ALGORITHM)
         self.service = derive_riot_service(riot_endpoint)
         self.config = derive_riot_method_config(riot_endpoint, self.subdomain, self.service)
 
         self.method = self.config["method"]
-        self.seconds_limit: int | None = self.config["seconds"]["limit"]
-        self.seconds_window: int | None = self.config["seconds"]["window"]
-
-        self.minutes_limit: int | None = self.config["minutes"]["limit"]
-        self.minutes_window: int | None = self.config["minutes"]["window"]
+        if limits is None:
+            # Limits Riot reported for this method take precedence over the hard-coded table, see RateLimitDiscovery
+            discovered = DISCOVERED_RATE_LIMITS.get(self.subdomain, self.method)
+            if discovered is not None:
+                limits = [(limit, window) for window, limit in discovered.items()]
+            else:
+                limits = [
+                    (window_cfg["limit"], window_cfg["window"])
+                    for window_cfg in (self.config["seconds"], self.config["minutes"])
+                    if window_cfg.get("limit") is not None
+                ]
 
         # Generate Redis keys.
-        self.seconds_key = self.generate_key("seconds") if self.seconds_limit is not None else None
-        self.minutes_key = self.generate_key("minutes") if self.minutes_limit is not None else None
+        self.set_limits(limits)
         self.blocking_key: str = self.generate_blocking_key()
 
-        # Initialize script content but don't load yet
+        # Script content is loaded lazily, once per Redis connection pool, by the process-wide SCRIPT_REGISTRY
         self.check_and_increment_script_content = self.get_check_and_increment_script()
         self.blocking_script_content = self.get_blocking_script()
         
-        # SHA values will be set during initialization
-        self.check_and_increment_sha = None
-        self.blocking_script_sha = None
+        # SHA values are computed locally and cached for the life of the process
+        self.check_and_increment_sha = SCRIPT_REGISTRY.sha(self.check_and_increment_script_content)
+        self.blocking_script_sha = SCRIPT_REGISTRY.sha(self.blocking_script_content)
 
 
     def generate_key(self, window_type: str) -> str:
-        return f"nd_method_rate_limit_key_for_{self.subdomain}_{self.method}_{window_type}"
+        return f"nd_method_rate_limit_key_for_{self.key_tag}_{self.method}_{window_type}"
 
     def generate_blocking_key(self):
         """
@@ -292,149 +456,40 @@ class MethodRateLimiter(BaseRateLimitingLogic):
         then we use this blocking key with a TTL set to the "Retry-After" header so we respect the timeout
         for as long as it is valid whether or not our internal counts hit their limit.
         """
-        return f"nd_blocking_method_rate_limit_key_for_{self.method}_{self.subdomain}"
+        return f"nd_blocking_method_rate_limit_key_for_{self.key_tag}_{self.method}"
 
     def get_check_and_increment_script(self):
-        """Returns the Lua script content for atomic check and increment operations."""
-        return """
-        -- Keys: [seconds_key, minutes_key, blocking_key]
-        -- Args: [seconds_limit, minutes_limit, seconds_window, minutes_window, has_seconds, has_minutes]
-        
-        local seconds_key = KEYS[1]
-        local minutes_key = KEYS[2]
-        local blocking_key = KEYS[3]
-        
-        local seconds_limit = tonumber(ARGV[1])
-        local minutes_limit = tonumber(ARGV[2])
-        local seconds_window = tonumber(ARGV[3])
-        local minutes_window = tonumber(ARGV[4])
-        local has_seconds = tonumber(ARGV[5])
-        local has_minutes = tonumber(ARGV[6])
-        
-        -- Check if blocking key exists (external rate limit was hit)
-        local block_exists = redis.call('EXISTS', blocking_key)
-        if block_exists == 1 then
-            local block_ttl = redis.call('TTL', blocking_key)
-            return {0, block_ttl, 0, 0, "blocking_key"}
-        end
-        
-        -- Check seconds limit if it exists
-        local seconds_count = 0
-        local seconds_ttl = 0
-        if has_seconds == 1 then
-            seconds_count = tonumber(redis.call('GET', seconds_key) or "0")
-            if seconds_count >= seconds_limit then
-                seconds_ttl = redis.call('TTL', seconds_key)
-                return {0, seconds_ttl, seconds_count, 0, "seconds"}
-            end
-        end
-        
-        -- Check minutes limit if it exists
-        local minutes_count = 0
-        local minutes_ttl = 0
-        if has_minutes == 1 then
-            minutes_count = tonumber(redis.call('GET', minutes_key) or "0")
-            if minutes_count >= minutes_limit then
-                minutes_ttl = redis.call('TTL', minutes_key)
-                return {0, minutes_ttl, seconds_count, minutes_count, "minutes"}
-            end
-        end
-        
-        -- Increment counts and set expiry if needed
-        -- Handle seconds key if it exists
-        if has_seconds == 1 then
-            local seconds_exists = redis.call('EXISTS', seconds_key)
-            redis.call('INCR', seconds_key)
-            if seconds_exists == 0 then
-                redis.call('EXPIRE', seconds_key, seconds_window)
-            end
-            seconds_count = seconds_count + 1
-        end
-        
-        -- Handle minutes key if it exists
-        if has_minutes == 1 then
-            local minutes_exists = redis.call('EXISTS', minutes_key)
-            redis.call('INCR', minutes_key)
-            if minutes_exists == 0 then
-                redis.call('EXPIRE', minutes_key, minutes_window)
-            end
-            minutes_count = minutes_count + 1
-        end
-        
-        -- Return success and new counts
-        return {1, 0, seconds_count, minutes_count, "allowed"}
-        """
+        """Returns the Lua script content for atomic check and increment operations. Shared by every limiter, see ADMISSION_SCRIPT."""
+        return ADMISSION_SCRIPT
 
     def get_blocking_script(self):
-        """Returns the Lua script content for handling blocking keys."""
-        return """
-        local blocking_key = KEYS[1]
-        local retry_after = tonumber(ARGV[1])
-        
-        -- Check if key exists and get its TTL
-        local exists = redis.call('EXISTS', blocking_key)
-        local current_ttl = 0
-        
-        if exists == 1 then
-            current_ttl = redis.call('TTL', blocking_key)
-        end
-        
-        -- Only set the key if it doesn't exist OR if new retry_after is longer than remaining TTL
-        if exists == 0 or retry_after > current_ttl then
-            redis.call('SET', blocking_key, 1, 'EX', retry_after)
-        end
-        
-        return {exists, current_ttl}
-        """
+        """Returns the Lua script content for handling blocking keys. Shared by every limiter, see BLOCKING_SCRIPT."""
+        return BLOCKING_SCRIPT
 
     async def initialize_scripts(self):
-        """Initialize the Lua scripts and store their SHA values."""
-        if self.check_and_increment_sha is None:
-            self.check_and_increment_sha = await self.redis.script_load(self.check_and_increment_script_content)
-        
-        if self.blocking_script_sha is None:
-            self.blocking_script_sha = await self.redis.script_load(self.blocking_script_content)
+        """Make sure the Lua scripts are loaded on this Redis connection pool. Only the first call per pool does a round trip."""
+        await self.backend.initialize()
 
     async def check_and_increment(self):
         """
         Atomically check if the request is allowed and increment counters if it is.
         Returns True if allowed, raises exception otherwise.
         """
-        if self.seconds_key is None and self.minutes_key is None:
-            raise TypeError("Logical mistake was made. A rate limit must have either a seconds key and/or a minutes key. They cannot both be null.")
-        
-        # Make sure scripts are initialized
-        if self.check_and_increment_sha is None:
-            await self.initialize_scripts()
-        
-        # Convert None values to empty strings for Redis keys
-        seconds_key = self.seconds_key or ""
-        minutes_key = self.minutes_key or ""
-        
-        # Prepare arguments
-        has_seconds = 1 if self.seconds_key is not None else 0
-        has_minutes = 1 if self.minutes_key is not None else 0
-        
-        # Execute the Lua script atomically
-        result = await self.redis.evalsha(
-            self.check_and_increment_sha,
-            3,  # number of keys
-            seconds_key, 
-            minutes_key, 
-            self.blocking_key,
-            self.seconds_limit or 0, 
-            self.minutes_limit or 0, 
-            self.seconds_window or 0, 
-            self.minutes_window or 0,
-            has_seconds,
-            has_minutes
-        )
-        
-        is_allowed, retry_after, seconds_count, minutes_count, reason = result
+        await self.check_and_increment_many(1)
+        return True
 
-        if is_allowed == 0:  # Request not allowed
+    async def check_and_increment_many(self, n: int) -> SlotReservation:
+        """
+        Atomically reserve up to n requests, as many as every window of this method has room for, in one round trip.
+        Returns how many were granted and how long until the rest can start being admitted, raises exception if none were.
+        """
+        reservation = await self.reserve(n)
+        counts = reservation["counts"]
+
+        if not reservation["allowed"]:  # Request not allowed
+            seconds_count, minutes_count = (counts[0], counts[-1] if len(counts) > 1 else None) if counts else (None, None)
             raise MethodRateLimitExceeded(
-                retry_after=retry_after if retry_after >= 1 else 1,
+                retry_after_ms=max(1, reservation["retry_after_ms"]),
                 method=self.method,
                 minutes_key=self.minutes_key,
                 seconds_key=self.seconds_key,
@@ -447,11 +502,25 @@ class MethodRateLimiter(BaseRateLimitingLogic):
                 seconds_limit=self.seconds_limit,
                 minutes_count=minutes_count,
                 minutes_limit=self.minutes_limit,
-                reason=f"The '{reason}' key count/limit/existence was violated."
+                windows=self.window_states(counts or None),
+                reason=f"The '{reservation['reason']}' key count/limit/existence was violated."
             )
         
-        return True
+        return {
+            "requested": n,
+            "granted": reservation["granted"],
+            "retry_after_ms": reservation["retry_after_ms"],
+            "counts": counts,
+            "stamps": reservation["stamps"],
+        }
     
+    async def acquire(self, timeout: float | None = None):
+        """
+        Like check_and_increment() but waits for the next open slot instead of raising, see wait_for_admission().
+        Waiters for this subdomain's method limit are admitted in FIFO order.
+        """
+        return await wait_for_admission(("method", self.subdomain, self.method), self.check_and_increment, timeout)
+
     async def write_inbound_method_rate_limit(self, retry_after: int, offending_context: RiotOffendingContext):
         """
         Set the method rate limit blocking key in Redis with a TTL. This is only for when we actually experience a
@@ -460,25 +529,15 @@ class MethodRateLimiter(BaseRateLimitingLogic):
         if not retry_after:
             retry_after = 68
         
-        # Make sure scripts are initialized
-        if self.blocking_script_sha is None:
-            await self.initialize_scripts()
-        
-        # Execute the blocking script using the stored SHA
-        result = await self.redis.evalsha(
-            self.blocking_script_sha,
-            1,  # number of keys
-            self.blocking_key,
-            retry_after
-        )
-        
-        exists, current_ttl = result
+        # Set or extend the blocking key, atomically
+        exists, current_ttl = await self.backend.extend_block(self.blocking_key, retry_after * 1000)
         
         # Use the max of the existing TTL and new retry_after to ensure we respect the longest timeout
-        effective_retry_after = max(retry_after, current_ttl) if exists else retry_after
+        effective_retry_after_ms = max(retry_after * 1000, current_ttl) if exists else retry_after * 1000
+        await self.announce_block("method", self.blocking_key, effective_retry_after_ms, self.method)
         
         raise MethodRateLimitExceeded(
-            retry_after=effective_retry_after,
+            retry_after_ms=effective_retry_after_ms,
             minutes_key=self.minutes_key,
             seconds_key=self.seconds_key,
             seconds_window=self.seconds_window,
@@ -490,6 +549,7 @@ class MethodRateLimiter(BaseRateLimitingLogic):
             offending_context=offending_context,
             seconds_limit=self.seconds_limit,
             minutes_limit=self.minutes_limit,
+            windows=self.window_states(),
             reason="Inbound 429 actually experienced. Did not prevent Riot from serving a 429."
         )
 
@@ -507,13 +567,17 @@ class ServiceRateLimiter(BaseRateLimitingLogic):
 
     def generate_key(self) -> str:
         """Generate a unique key for the service rate limit."""
-        return f"nd_blocking_key_for_service_rate_limit_{self.service}_{self.subdomain}"
+        return f"nd_blocking_key_for_service_rate_limit_{self.service}_{self.key_tag}"
 
     async def is_allowed(self):
         """Check if the request is allowed under the service rate limit."""
-        if await self.redis.exists(self.service_key):
+        _, remaining_ttl = BLOCKING_CACHE.check(self.backend.lease_scope, [self.service_key])
+        if not remaining_ttl:
+            remaining_ttl = await self.backend.block_ttl(self.service_key)
+            BLOCKING_CACHE.block(self.backend.lease_scope, self.service_key, remaining_ttl)
+        if remaining_ttl != -2:  # -2 means the key does not exist
             raise ServiceRateLimitExceeded(
-                retry_after=self.__class__.SERVICE_BLOCK_DURATION,
+                retry_after_ms=remaining_ttl if remaining_ttl > 0 else self.__class__.SERVICE_BLOCK_DURATION * 1000,
                 service=self.service,
                 enforcement_type="internal",
                 subdomain=self.subdomain,
@@ -524,7 +588,8 @@ class ServiceRateLimiter(BaseRateLimitingLogic):
     async def write_inbound_service_rate_limit(self, offending_context: RiotOffendingContext):
         """Set the service rate limit key in Redis with a TTL."""
         # Create the key with a 68-second TTL if it doesn't already exist (NX)
-        await self.redis.set(self.service_key, 1, ex=self.__class__.SERVICE_BLOCK_DURATION, nx=True)
+        remaining_ttl = await self.backend.set_block(self.service_key, self.__class__.SERVICE_BLOCK_DURATION * 1000)
+        await self.announce_block("service", self.service_key, remaining_ttl)
 
         raise ServiceRateLimitExceeded(
             retry_after=self.__class__.SERVICE_BLOCK_DURATION, # this will always be a default value for Service limits because Riot does not provide a time
@@ -542,24 +607,20 @@ class UnspecifiedRiotRateLimiter(BaseRateLimitingLogic):
         self.service = derive_riot_service(riot_endpoint)
         self.config = derive_riot_method_config(riot_endpoint, self.subdomain, self.service)
         self.method = self.config["method"]
-        self.blocking_key = f"blocking_key_for_unspecified_rate_limit_for_{self.subdomain}"
+        self.blocking_key = f"blocking_key_for_unspecified_rate_limit_for_{self.key_tag}"
 
     async def is_allowed(self):
         """Check if the request is allowed under the experienced but unspecified rate limit."""
-        # Use a pipeline to execute both commands in a single transaction
-        async with self.redis.pipeline() as pipe:
-            # Queue both commands
-            await pipe.exists(self.blocking_key)
-            await pipe.ttl(self.blocking_key)
-            # Execute the pipeline and get results
-            exists, remaining_ttl = await pipe.execute()
-        
-        if exists:
+        _, remaining_ttl = BLOCKING_CACHE.check(self.backend.lease_scope, [self.blocking_key])
+        if not remaining_ttl:
+            remaining_ttl = await self.backend.block_ttl(self.blocking_key)
+            BLOCKING_CACHE.block(self.backend.lease_scope, self.blocking_key, remaining_ttl)
+        if remaining_ttl != -2:  # -2 means the key does not exist
             # Ensure non-negative TTL value
             remaining_ttl = max(1, remaining_ttl)
             
             raise UnspecifiedRateLimitExceeded(
-                retry_after=remaining_ttl,
+                retry_after_ms=remaining_ttl,
                 service=self.service,
                 method=self.method,
                 enforcement_type="internal",
@@ -577,7 +638,8 @@ class UnspecifiedRiotRateLimiter(BaseRateLimitingLogic):
         if not retry_after:
             retry_after = 68
         # Create the key with a 68-second TTL if it doesn't already exist (NX)
-        await self.redis.set(self.blocking_key, 1, ex=retry_after, nx=True)
+        remaining_ttl = await self.backend.set_block(self.blocking_key, retry_after * 1000)
+        await self.announce_block("unspecified", self.blocking_key, remaining_ttl, self.method)
         raise UnspecifiedRateLimitExceeded(
             retry_after=retry_after,
             enforcement_type="external",
@@ -587,3 +649,850 @@ class UnspecifiedRiotRateLimiter(BaseRateLimitingLogic):
             service=self.service,
             method=self.method
         )
+
+
+class InFlightLimiter(BaseRateLimitingLogic):
+    """
+    Caps how many requests to a router (ND_MAX_IN_FLIGHT_PER_ROUTER) and to one method of it (ND_MAX_IN_FLIGHT_PER_METHOD)
+    are awaiting Riot's response at once, across every process. The windows bound how many requests start per window,
+    this bounds how many are outstanding, so a large concurrent batch cannot pile up on Riot (or on the connection pool).
+    Every request holds a slot: its token in a sorted set scored by when its lease (ND_IN_FLIGHT_LEASE_MS) expires,
+    so the slots of a worker that crashed mid request free themselves. Without either cap nothing is sent to Redis.
+    """
+    # Slots free up the moment a response arrives, so a full semaphore is polled this often rather than waited out
+    RETRY_AFTER_MS = 25
+
+    def __init__(self, riot_endpoint: str, async_redis_client, router_limit: int | None = None, method_limit: int | None = None, lease_ms: int | None = None):
+        super().__init__(riot_endpoint, async_redis_client)
+        route = resolve_riot_route(riot_endpoint)
+        self.service = route["service"]
+        self.method = route["method"]
+        self.lease_ms: int = lease_ms or ND_IN_FLIGHT_LEASE_MS
+        router_limit = router_limit or ND_MAX_IN_FLIGHT_PER_ROUTER
+        method_limit = method_limit or ND_MAX_IN_FLIGHT_PER_METHOD
+
+        # (scope, key, limit) of every cap in place, both keys carry the subdomain's hash tag so one script takes both
+        self.semaphores: list[tuple[str, str, int]] = []
+        if router_limit:
+            self.semaphores.append(("router", f"nd_in_flight_{self.key_tag}", router_limit))
+        if method_limit:
+            self.semaphores.append(("method", f"nd_in_flight_{self.key_tag}_{self.method}", method_limit))
+        self.keys: list[str] = [key for _, key, _ in self.semaphores]
+        self.limits: list[int] = [limit for _, _, limit in self.semaphores]
+
+    async def try_acquire(self, riot_endpoint: str | None = None, async_redis_client=None) -> str | None:
+        """Take a slot of every cap in one round trip. Returns the token to release(), raises InFlightLimitExceeded when one is full."""
+        if not self.semaphores:
+            return None
+        token = uuid.uuid4().hex
+        acquired, blocked_index, in_flight = await self.backend_for(async_redis_client).acquire_slots(self.keys, [token, self.lease_ms, *self.limits])
+        if acquired:
+            return token
+        scope, _, limit = self.semaphores[int(blocked_index) - 1]  # Lua is 1-indexed
+        raise InFlightLimitExceeded(
+            retry_after_ms=self.RETRY_AFTER_MS,
+            scope=scope,
+            limit=limit,
+            in_flight=int(in_flight),
+            service=self.service,
+            method=self.method,
+            enforcement_type="internal",
+            subdomain=self.subdomain,
+            riot_endpoint=riot_endpoint or self.riot_endpoint,
+        )
+
+    async def acquire(self, riot_endpoint: str | None = None, async_redis_client=None, wait: bool = False, timeout: float | None = None) -> str | None:
+        """try_acquire(), or with wait=True queue for the next free slot (FIFO per subdomain and method), see wait_for_admission()."""
+        if not self.semaphores or not wait:
+            return await self.try_acquire(riot_endpoint, async_redis_client)
+        return await wait_for_admission(
+            ("in_flight", self.subdomain, self.method),
+            lambda: self.try_acquire(riot_endpoint, async_redis_client),
+            timeout
+        )
+
+    async def release(self, token: str | None, async_redis_client=None):
+        """Give the slot back once the response arrived (or the request failed)."""
+        if token is None:
+            return
+        try:
+            await self.backend_for(async_redis_client).release_slots(self.keys, token)
+        except (RedisError, OSError):
+            pass  # The lease expires on its own after lease_ms
+
+
+class AdmissionVerdict(TypedDict):
+    """
+    Structured result of one AdmissionRateLimiter.admit() call.
+    tier is which rate limit tier blocked the request ("application", "method", "service", "unspecified") or None when allowed.
+    reason is "allowed", "blocking_key" or the window type ("seconds"/"minutes") whose count/limit was violated.
+    retry_after_ms is exactly how long until the blocking key or window expires. When allowed it is 0,
+    or how long until one more request fits if fewer were granted than requested.
+    granted is how many requests were admitted (more than 1 only when a lease was requested), 0 when blocked.
+    lease_ttl_ms is how long the granted requests stay counted in their windows, 0 when blocked.
+    counts holds the counts of every application and method window key, in the same order as AdmissionRateLimiter.windows.
+    stamps is where the granted requests were counted in every window entry (see ADMISSION_SCRIPT), so refund() only
+    gives them back to those windows and never to a newer one. Empty when blocked.
+    """
+    allowed: bool
+    tier: str | None
+    reason: str
+    retry_after_ms: int
+    granted: int
+    lease_ttl_ms: int
+    counts: list[int]
+    stamps: list[str]
+
+
+class TokenLease:
+    """
+    Requests reserved from Redis by one admission and handed out locally, without a round trip, until they run out or expire.
+    Tokens still unused at expires_at are refunded as long as their windows have not rolled over yet (refund_deadline).
+    counts and stamps are the admission's window counts (every leased token included) and where it counted them, see AdmissionVerdict.
+    """
+    def __init__(self, remaining: int, expires_at: float, refund_deadline: float, counts: list[int], stamps: list[str]):
+        self.remaining = remaining
+        self.expires_at = expires_at  # time.monotonic()
+        self.refund_deadline = refund_deadline  # time.monotonic()
+        self.counts = counts
+        self.stamps = stamps
+        self.expiry_handle: asyncio.TimerHandle | None = None
+
+    def take(self) -> bool:
+        if self.remaining <= 0 or time.monotonic() >= self.expires_at:
+            return False
+        self.remaining -= 1
+        return True
+
+    def release(self) -> int:
+        """Stop handing out tokens. Returns how many were never used."""
+        unused, self.remaining = self.remaining, 0
+        if self.expiry_handle is not None:
+            self.expiry_handle.cancel()
+        return unused
+
+
+# A lease expires this long before its tokens' windows roll over, so a refund never lands in the next window
+LEASE_REFUND_MARGIN_MS = 50
+# A lease reserves at most this share of the tightest window's remaining room, so leases shrink as a window fills up
+LEASE_ROOM_SHARE = 0.25
+# Strong references to in flight lease refunds, the event loop only keeps weak ones
+_lease_refund_tasks: set[asyncio.Task] = set()
+
+
+def _forget_lease_refund(task: asyncio.Task):
+    _lease_refund_tasks.discard(task)
+    if not task.cancelled():
+        task.exception()  # A failed refund leaves the tokens counted until their window expires, which errs on the safe side
+
+
+class AdmissionRateLimiter(BaseRateLimitingLogic):
+    """
+    Fused rate limiter that checks every tier in a single atomic Lua script, i.e. one Redis round trip per request.
+    The application, method, service and unspecified blocking keys are checked first, then the application and method
+    counters, and only if every tier allows the request are the application and method counters incremented.
+    A tier can therefore never be incremented for a request that a later tier rejects.
+    Instances hold no per-request state once built, so perform_riot_request() reuses one per (subdomain, service, method, priority),
+    see get_admission_rate_limiter(). The endpoint and Redis client are then passed per call.
+    priority is the class of the requests admitted, see PRIORITY_CLASSES: "batch" requests stop short of the share of every
+    window held back for "interactive" ones (ND_INTERACTIVE_RESERVE), and each class has its own waiters and leases.
+    shares ({tenant: weight}, defaults to ND_APPLICATION_SHARES) splits every application window between tenants, tenant is
+    who these requests are counted for (defaults to the service when it has a share, "default" otherwise), see share_entries().
+    Once a FleetHeartbeat runs, this worker is also held to its share of every window among the live workers, see fleet_entries().
+    """
+    def __init__(
+        self,
+        riot_endpoint: str,
+        async_redis_client,
+        algorithm: str | None = None,
+        lease_size: int | None = None,
+        application_limits: list[tuple[int, int]] | None = None,
+        method_limits: list[tuple[int, int]] | None = None,
+        priority: str = "interactive",
+        tenant: str | None = None,
+        shares: dict[str, int] | None = None,
+    ):
+        super().__init__(riot_endpoint, async_redis_client)
+        self.priority: str = validate_priority(priority)
+        self.reserve: float = priority_reserve(priority)
+        self.application_rate_limiter = ApplicationRateLimiter(riot_endpoint, async_redis_client, algorithm, application_limits)
+        self.method_rate_limiter = MethodRateLimiter(riot_endpoint, async_redis_client, algorithm, method_limits)
+        self.service_rate_limiter = ServiceRateLimiter(riot_endpoint, async_redis_client)
+        self.unspecified_rate_limiter = UnspecifiedRiotRateLimiter(riot_endpoint, async_redis_client)
+        self.in_flight_limiter = InFlightLimiter(riot_endpoint, async_redis_client)
+        self.service = self.method_rate_limiter.service
+        self.method = self.method_rate_limiter.method
+
+        # Order matters, the script reports the index of whatever key blocked the request
+        self.blocking_tiers: list[str] = ["application", "method", "service", "unspecified"]
+        self.blocking_keys: list[str] = [
+            self.application_rate_limiter.blocking_key,
+            self.method_rate_limiter.blocking_key,
+            self.service_rate_limiter.service_key,
+            self.unspecified_rate_limiter.blocking_key,
+        ]
+
+        # (tier, window_type, key, limit, window) for every counter the script checks and increments
+        self.windows: list[tuple[str, str, str, int, int]] = []
+        self.window_algorithms: list[str] = []
+        for limiter, tier in ((self.application_rate_limiter, "application"), (self.method_rate_limiter, "method")):
+            for window_type, key, (limit, window) in zip(limiter.window_types, limiter.window_keys, limiter.limits):
+                self.windows.append((tier, window_type, key, limit, window))
+                self.window_algorithms.append(limiter.algorithm)
+
+        # Tenant shares of the application windows, checked after (and counted along with) the windows themselves
+        shares = shares if shares is not None else ND_APPLICATION_SHARES
+        self.tenant: str | None = None
+        if shares:
+            # Tenants without a weight of their own are counted in the "default" share
+            tenant = tenant or self.service
+            self.tenant = tenant if tenant in shares else "default"
+        # (tenant, window_type, key, guaranteed share, window, algorithm) for every tenant of every application window
+        self.shares: list[tuple[str, str, str, int, int, str]] = self.share_entries(shares) if shares else []
+
+        # Every live worker's counter of every window while this one shares the API key with others, checked after the shares
+        # (worker, tier, window_type, key, guaranteed share, window, algorithm)
+        self.fleet: list[tuple[str, str, str, str, int, int, str]] = self.fleet_entries() if FLEET.size > 1 else []
+
+        # Built once, the keys and ARGV only change when a route's limits or the fleet do (the cached limiter is rebuilt)
+        self.admission_keys: list[str] = [
+            *self.blocking_keys,
+            *(key for _, _, key, _, _ in self.windows),
+            *(key for _, _, key, _, _, _ in self.shares),
+            *(key for _, _, _, key, _, _, _ in self.fleet),
+        ]
+        self.admission_args: list[int | str] = [len(self.blocking_keys)]
+        for (_, _, _, limit, window), algorithm in zip(self.windows, self.window_algorithms):
+            self.admission_args.extend((algorithm, limit, window * 1000))
+        for _, _, _, guaranteed, window, algorithm in self.shares:
+            self.admission_args.extend((algorithm, guaranteed, window * 1000))
+        for _, _, _, _, guaranteed, window, algorithm in self.fleet:
+            self.admission_args.extend((algorithm, guaranteed, window * 1000))
+
+        self.admission_script_content = self.get_admission_script()
+        self.admission_sha = SCRIPT_REGISTRY.sha(self.admission_script_content)
+
+        # Token leasing, see check_and_increment_leased(). Leases are per Redis connection pool.
+        self.max_lease_size: int = lease_size or ND_LEASE_SIZE or 1
+        self.lease_size: int = 1  # Adapts to how full the windows are after every admission
+        self.leases: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # Refunds go back to the windows, this tenant's shares (never another tenant's) and this worker's counters (never another worker's)
+        own_shares = [entry for entry in self.shares if entry[0] == self.tenant]
+        self.window_keys: list[str] = [key for _, _, key, _, _ in self.windows] + [key for _, _, key, _, _, _ in own_shares]
+        self.window_args: list[int | str] = self.admission_args[1:1 + len(self.windows) * 3]
+        for _, _, _, guaranteed, window, algorithm in own_shares:
+            self.window_args.extend((algorithm, guaranteed, window * 1000))
+        own_fleet = [entry for entry in self.fleet if entry[0] == FLEET.worker_id]
+        self.window_keys.extend(key for _, _, _, key, _, _, _ in own_fleet)
+        for _, _, _, _, guaranteed, window, algorithm in own_fleet:
+            self.window_args.extend((algorithm, guaranteed, window * 1000))
+        # Index of every refunded entry among the admission's window entries, to pick its stamp
+        self.refund_entries: list[int] = [
+            *range(len(self.windows)),
+            *(len(self.windows) + index for index, entry in enumerate(self.shares) if entry[0] == self.tenant),
+            *(len(self.windows) + len(self.shares) + index for index, entry in enumerate(self.fleet) if entry[0] == FLEET.worker_id),
+        ]
+
+        # {window: limit} of the method windows, compared against Riot's X-Method-Rate-Limit header by discover_limits()
+        self.method_limits: dict[int, int] = {window: limit for tier, _, _, limit, window in self.windows if tier == "method"}
+        # (limit, window) of the shortest window, the one requests in flight are most likely to spill over, see AdaptiveHeadroom
+        _, _, _, limit, window = min(self.windows, key=lambda entry: entry[4])
+        self.tightest_window: tuple[int, int] = (limit, window * 1000)
+
+    def effective_reserve(self) -> float:
+        """The priority class's reserve plus the routing value's adaptive headroom, as one share of every limit."""
+        headroom = HEADROOM.headroom(self.subdomain, *self.tightest_window)
+        # Headroom applies to what the priority class may use, i.e. 1 - (1 - reserve) * (1 - headroom)
+        return self.reserve + headroom * (1 - self.reserve)
+
+    def get_admission_script(self):
+        """Returns the Lua script content that checks all four tiers and increments the application and method counters."""
+        return ADMISSION_SCRIPT
+
+    def share_entries(self, shares: dict[str, int]) -> list[tuple[str, str, str, int, int, str]]:
+        """
+        Every tenant's guaranteed share of every application window, weight / total weight of its limit (rounded down).
+        Tenants that are not listed share the "default" weight, 1 unless listed. A tenant may always use what is left of its
+        own share and borrow whatever the tenants active in the window do not need, see ADMISSION_SCRIPT.
+        """
+        weights = {"default": 1, **shares}
+        total_weight = sum(weights.values())
+        entries = []
+        for entry, (tier, window_type, _, limit, window) in enumerate(self.windows, start=1):
+            if tier != "application":
+                continue
+            for tenant, weight in weights.items():
+                key = f"nd_application_share_{self.key_tag}_{tenant}_{window_type}"
+                algorithm = f"share:{entry}:{1 if tenant == self.tenant else 0}"
+                entries.append((tenant, window_type, key, limit * weight // total_weight, window, algorithm))
+        return entries
+
+    def fleet_entries(self) -> list[tuple[str, str, str, str, int, int, str]]:
+        """
+        Every live worker's (FLEET) guaranteed share of every application and method window, see FleetMembership.shares().
+        Without them whichever worker polls fastest wins most of every window. Like tenant shares they are work conserving:
+        a worker may always use what is left of its own share and borrow whatever the workers active in the window do not need.
+        The counters expire with their windows, so a worker that died leaves nothing behind.
+        """
+        entries = []
+        for entry, (tier, window_type, key, limit, window) in enumerate(self.windows, start=1):
+            for worker, guaranteed in FLEET.shares(limit).items():
+                algorithm = f"fleet:{entry}:{1 if worker == FLEET.worker_id else 0}"
+                entries.append((worker, tier, window_type, f"{key}_worker_{worker}", guaranteed, window, algorithm))
+        return entries
+
+    async def initialize_scripts(self, async_redis_client=None):
+        """Make sure the Lua script is loaded on this Redis connection pool. Only the first call per pool does a round trip."""
+        await self.backend_for(async_redis_client).initialize()
+
+    async def admit(self, async_redis_client=None, requested: int = 1, min_lease_ttl_ms: int = 0) -> AdmissionVerdict:
+        """
+        Atomically check every tier and increment the application and method counters if all of them allow the request.
+        Returns a structured verdict rather than raising, see check_and_increment() for the raising version.
+        async_redis_client overrides the client this limiter was built with (shared, cached instances are built without one).
+        requested > 1 reserves up to that many requests at once, as many as every window has room for, see verdict["granted"].
+        Only 1 is granted if the reserved requests would stay counted for less than min_lease_ttl_ms.
+        Blocking keys already known to be set are answered locally without a round trip, see BLOCKING_CACHE.
+        """
+        backend = self.backend_for(async_redis_client)
+        blocked_index, blocked_ms = BLOCKING_CACHE.check(backend.lease_scope, self.blocking_keys)
+        if blocked_ms:
+            return {
+                "allowed": False,
+                "tier": self.blocking_tiers[blocked_index],
+                "reason": "blocking_key",
+                "retry_after_ms": blocked_ms,
+                "granted": 0,
+                "lease_ttl_ms": 0,
+                "counts": [],
+                "stamps": [],
+            }
+
+        result = await backend.admit(self.admission_keys, [*self.admission_args, requested, min_lease_ttl_ms, self.effective_reserve()])
+
+        is_allowed, retry_after, blocked_index, reason, granted, lease_ttl, *counts = result
+        entries = len(self.admission_keys) - len(self.blocking_keys)
+        stamps = counts[entries:]
+        counts = [int(count) for count in counts[:len(self.windows)]]  # Tenant share counts are internal to the script
+
+        if is_allowed == 1:
+            return {
+                "allowed": True,
+                "tier": None,
+                "reason": "allowed",
+                "retry_after_ms": int(retry_after),
+                "granted": int(granted),
+                "lease_ttl_ms": int(lease_ttl),
+                "counts": counts,
+                "stamps": stamps,
+            }
+
+        blocked_index = int(blocked_index) - 1  # Lua is 1-indexed
+        if blocked_index < len(self.blocking_keys):
+            tier = self.blocking_tiers[blocked_index]
+            BLOCKING_CACHE.block(backend.lease_scope, self.blocking_keys[blocked_index], int(retry_after))
+        elif blocked_index < len(self.blocking_keys) + len(self.windows):
+            tier, reason, _, _, _ = self.windows[blocked_index - len(self.blocking_keys)]
+        elif blocked_index < len(self.blocking_keys) + len(self.windows) + len(self.shares):
+            tier, reason = "application", "share"  # This tenant's share is used up and the rest is owed to active tenants
+        else:
+            _, tier, _, _, _, _, _ = self.fleet[blocked_index - len(self.blocking_keys) - len(self.windows) - len(self.shares)]
+            reason = "fleet"  # This worker's share of the window is used up and the rest is owed to active workers
+
+        return {
+            "allowed": False,
+            "tier": tier,
+            "reason": reason,
+            "retry_after_ms": max(1, retry_after),
+            "granted": 0,
+            "lease_ttl_ms": 0,
+            "counts": counts,
+            "stamps": [],
+        }
+
+    def window_counts(self, tier: str, counts: list[int]) -> dict[str, int]:
+        """Map the verdict counts of a tier back to their window type, ex. {"seconds": 3, "120_seconds": 9, "minutes": 17}."""
+        return {window_type: count for (window_tier, window_type, _, _, _), count in zip(self.windows, counts) if window_tier == tier}
+
+    async def check_and_increment(self, riot_endpoint: str | None = None, async_redis_client=None):
+        """
+        Atomically check every tier and increment the application and method counters in one round trip.
+        Returns True if allowed, raises the exception of the tier that blocked the request otherwise.
+        riot_endpoint and async_redis_client override the ones this limiter was built with, see get_admission_rate_limiter().
+        With leasing enabled (ND_LEASE_SIZE) most calls are answered from a local lease instead, see check_and_increment_leased().
+        """
+        await self.admit_one(riot_endpoint, async_redis_client)
+        return True
+
+    async def admit_one(self, riot_endpoint: str | None = None, async_redis_client=None) -> SlotReservation:
+        """
+        check_and_increment(), but returns the reservation of the one request: where it was counted (its stamps,
+        see AdmissionVerdict) so it can be given back to exactly those windows (see give_back()), and the counts it saw.
+        """
+        if self.max_lease_size > 1:
+            return await self.take_leased(riot_endpoint, async_redis_client)
+        verdict = await self.admit(async_redis_client)
+        if verdict["allowed"]:
+            return _one_slot(verdict["counts"], verdict["stamps"])
+        self.raise_for_verdict(verdict, riot_endpoint)
+
+    async def check_and_increment_many(self, n: int, riot_endpoint: str | None = None, async_redis_client=None) -> SlotReservation:
+        """
+        Atomically reserve up to n requests across every tier in one round trip, as many as every window has room for.
+        Returns how many were granted and how long until the rest can start being admitted,
+        raises the exception of the tier that blocked the request if none were. Leases are bypassed.
+        """
+        verdict = await self.admit(async_redis_client, n)
+        if not verdict["allowed"]:
+            self.raise_for_verdict(verdict, riot_endpoint)
+        return {
+            "requested": n,
+            "granted": verdict["granted"],
+            "retry_after_ms": verdict["retry_after_ms"],
+            "counts": verdict["counts"],
+            "stamps": verdict["stamps"],
+        }
+
+    async def check_and_increment_leased(self, riot_endpoint: str | None = None, async_redis_client=None):
+        """
+        Like check_and_increment() but reserves a block of requests per round trip and hands them out locally.
+        The lease size adapts to how full the windows are: up to max_lease_size while they are empty, shrinking to 1 near a limit.
+        Unused tokens are refunded when the lease expires, which is at most ND_LEASE_TTL_MS and never after a window rolls over.
+        Blocking keys are only checked when a lease is taken out, so they are noticed up to ND_LEASE_TTL_MS late.
+        """
+        await self.take_leased(riot_endpoint, async_redis_client)
+        return True
+
+    async def take_leased(self, riot_endpoint: str | None = None, async_redis_client=None) -> SlotReservation:
+        """check_and_increment_leased(), but returns the token as a reservation of 1 with the counts and stamps of its admission."""
+        backend = self.backend_for(async_redis_client)
+        pool = backend.lease_scope
+        lease = self.leases.get(pool)
+        if lease is not None and lease.take():
+            return _one_slot(lease.counts, lease.stamps)
+
+        # One coroutine takes out the next lease, the others wait for it rather than all going to Redis
+        async with _waiter_lock(("lease", self.subdomain, self.method, self.priority)):
+            lease = self.leases.get(pool)
+            if lease is not None and lease.take():
+                return _one_slot(lease.counts, lease.stamps)
+
+            # A shorter lease would have to be refunded before it could be used
+            verdict = await self.admit(backend, self.lease_size, LEASE_REFUND_MARGIN_MS * 2)
+            if not verdict["allowed"]:
+                self.lease_size = 1
+                self.raise_for_verdict(verdict, riot_endpoint)
+
+            self.lease_size = self.next_lease_size(verdict["counts"])
+            if verdict["granted"] > 1:
+                self.start_lease(pool, backend, verdict["granted"] - 1, verdict["lease_ttl_ms"], verdict["counts"], verdict["stamps"])
+        return _one_slot(verdict["counts"], verdict["stamps"])
+
+    def next_lease_size(self, counts: list[int]) -> int:
+        """Size of the next lease: a share of the tightest window's remaining room, between 1 and max_lease_size."""
+        room = min(limit - count for (_, _, _, limit, _), count in zip(self.windows, counts))
+        return max(1, min(self.max_lease_size, int(room * LEASE_ROOM_SHARE)))
+
+    def start_lease(self, pool, async_redis_client, remaining: int, lease_ttl_ms: int, counts: list[int], stamps: list[str]):
+        now = time.monotonic()
+        refund_deadline = now + (lease_ttl_ms - LEASE_REFUND_MARGIN_MS) / 1000
+        lease = TokenLease(remaining, min(now + ND_LEASE_TTL_MS / 1000, refund_deadline), refund_deadline, counts, stamps)
+        previous = self.leases.get(pool)
+        if previous is not None:
+            previous.release()  # Only replaced once it ran out, nothing to refund
+        self.leases[pool] = lease
+        lease.expiry_handle = asyncio.get_running_loop().call_later(
+            lease.expires_at - now, self.expire_lease, pool, lease, async_redis_client
+        )
+
+    def expire_lease(self, pool, lease: TokenLease, async_redis_client):
+        """Stop handing out the lease and refund whatever it did not hand out while its windows are still current."""
+        if self.leases.get(pool) is lease:
+            del self.leases[pool]
+        lease.expiry_handle = None
+        unused = lease.release()
+        if unused > 0 and time.monotonic() < lease.refund_deadline:
+            task = asyncio.get_running_loop().create_task(self.refund(unused, lease.stamps, async_redis_client))
+            _lease_refund_tasks.add(task)
+            task.add_done_callback(_forget_lease_refund)
+
+    def drop_leases(self):
+        """Stop handing out every lease without refunding them, ex. after Riot answered 429."""
+        for lease in list(self.leases.values()):
+            lease.release()
+        self.leases.clear()
+
+    async def refund(self, unused: int, stamps: list[str], async_redis_client=None):
+        """
+        Give back requests that were counted by admit() but never sent, straight to the Redis windows.
+        stamps is the admission's (see AdmissionVerdict), windows that rolled over since are left alone.
+        Without stamps there is no telling which windows they were counted in, so nothing is refunded.
+        """
+        if not stamps:
+            return
+        args: list[int | str] = [unused]
+        for entry, index in enumerate(self.refund_entries):
+            args.extend((*self.window_args[entry * 3:entry * 3 + 3], stamps[index]))
+        await self.backend_for(async_redis_client).refund(self.window_keys, args)
+
+    async def give_back(self, tokens: int, stamps: list[str], async_redis_client=None):
+        """
+        Give back requests that were admitted but never sent. Tokens of the live lease's own admission go back to it,
+        which refunds whatever it does not hand out when it expires. Otherwise they are refunded in Redis right away,
+        to the windows they were counted in (a lease must not hand out tokens counted in a window that has rolled over).
+        """
+        backend = self.backend_for(async_redis_client)
+        lease = self.leases.get(backend.lease_scope)
+        if lease is not None and lease.stamps == stamps and time.monotonic() < lease.expires_at:
+            lease.remaining += tokens
+            return
+        await self.refund(tokens, stamps, backend)
+
+    async def admit_request(
+        self,
+        riot_endpoint: str | None = None,
+        async_redis_client=None,
+        *,
+        wait: bool = False,
+        timeout: float | None = None,
+    ) -> "AdmissionHandle":
+        """
+        Admit one request like check_and_increment() (or acquire() with wait=True) and return a handle to settle it with:
+        commit() once the request may have reached Riot, rollback() to give its tokens back if it provably never left the process.
+        """
+        if wait:
+            reservation = await self.acquire(timeout, riot_endpoint, async_redis_client)
+        else:
+            reservation = await self.admit_one(riot_endpoint, async_redis_client)
+        return AdmissionHandle(self, self.backend_for(async_redis_client), counts=reservation["counts"], stamps=reservation["stamps"])
+
+    async def calibrate(self, headers, async_redis_client=None, counts: list[int] | None = None):
+        """
+        Reconcile the window counts with the X-App-Rate-Limit-Count and X-Method-Rate-Limit-Count headers of a Riot response.
+        Every window whose length matches one Riot reports is raised to Riot's count in one round trip if it is behind,
+        so requests made with the same key elsewhere (other services, other tools) are accounted for.
+        The counts are compared as they are in Redis right then (see RECONCILE_SCRIPT), not as this process last saw them,
+        so requests admitted concurrently are not mistaken for drift. Only windows that were actually behind record their drift,
+        see get_rate_limit_drift(), and the routing value's adaptive headroom learns from it.
+        counts are the window counts the request was admitted with (see AdmissionHandle). A window only grows until it rolls over,
+        so while Riot counts no more than the admission did in every window nothing can be behind and the round trip is skipped.
+        """
+        riot_counts = {
+            "application": parse_riot_rate_limit_header(headers.get("x-app-rate-limit-count")),
+            "method": parse_riot_rate_limit_header(headers.get("x-method-rate-limit-count")),
+        }
+        reported: list[tuple[int, int]] = []
+        keys = []
+        args = []
+        for index, (tier, _, key, limit, window) in enumerate(self.windows):
+            riot_count = riot_counts[tier].get(window)
+            if riot_count is None:
+                continue
+            reported.append((index, riot_count))
+            keys.append(key)
+            args.extend((self.window_algorithms[index], limit, window * 1000, riot_count))
+        if not reported:
+            return  # No count headers, nothing agreed or disagreed with Riot
+        if counts and all(riot_count <= counts[index] for index, riot_count in reported):
+            HEADROOM.calmed(self.subdomain)
+            return
+
+        counts = await self.backend_for(async_redis_client).reconcile(keys, args)
+        worst: tuple[int, int] | None = None  # (drift, limit) of the window furthest behind, relative to its limit
+        for (index, riot_count), count in zip(reported, counts):
+            drift = riot_count - int(count)
+            if drift <= 0:
+                continue
+            tier, _, _, limit, window = self.windows[index]
+            record_rate_limit_drift((self.subdomain, tier, self.method if tier == "method" else None, window), drift)
+            if worst is None or drift / limit > worst[0] / worst[1]:
+                worst = (drift, limit)
+        # One response moves the margin once, by its worst window, however many windows were behind
+        if worst is None:
+            HEADROOM.calmed(self.subdomain)
+        else:
+            HEADROOM.drifted(self.subdomain, *worst)
+
+    async def discover_limits(self, headers, async_redis_client=None) -> bool:
+        """
+        Compare the method limits in use with the X-Method-Rate-Limit header of a Riot response.
+        When Riot reports different limits they are persisted for every process (see RateLimitDiscovery)
+        and this route's cached limiters are rebuilt with them. Returns True when the limits changed.
+        """
+        riot_limits = DISCOVERED_RATE_LIMITS.normalize(parse_riot_rate_limit_header(headers.get("x-method-rate-limit")))
+        if not riot_limits or riot_limits == self.method_limits:
+            return False
+        await DISCOVERED_RATE_LIMITS.observe(self.subdomain, self.method, riot_limits, self.backend_for(async_redis_client))
+        invalidate_admission_rate_limiters(self.subdomain, self.method)
+        return True
+
+    def raise_for_verdict(self, verdict: AdmissionVerdict, riot_endpoint: str | None = None):
+        """Raise the RiotRelatedRateLimitException subclass of the tier that blocked a verdict."""
+        riot_endpoint = riot_endpoint or self.riot_endpoint
+        tier = verdict["tier"]
+        retry_after_ms = verdict["retry_after_ms"]
+        reason = f"The '{verdict['reason']}' key count/limit/existence was violated."
+
+        counts = self.window_counts(tier, verdict["counts"])
+        tier_counts = [count for (window_tier, _, _, _, _), count in zip(self.windows, verdict["counts"]) if window_tier == tier]
+
+        if tier == "application":
+            limiter = self.application_rate_limiter
+            raise ApplicationRateLimitExceeded(
+                retry_after_ms=retry_after_ms,
+                minutes_key=limiter.minutes_key,
+                seconds_key=limiter.seconds_key,
+                seconds_window=limiter.seconds_window,
+                minutes_window=limiter.minutes_window,
+                subdomain=self.subdomain,
+                enforcement_type="internal",
+                riot_endpoint=riot_endpoint,
+                seconds_count=counts.get("seconds"),
+                seconds_limit=limiter.seconds_limit,
+                minutes_count=counts.get("minutes"),
+                minutes_limit=limiter.minutes_limit,
+                windows=limiter.window_states(tier_counts or None),
+                reason=reason
+            )
+        elif tier == "method":
+            limiter = self.method_rate_limiter
+            raise MethodRateLimitExceeded(
+                retry_after_ms=retry_after_ms,
+                method=self.method,
+                minutes_key=limiter.minutes_key,
+                seconds_key=limiter.seconds_key,
+                seconds_window=limiter.seconds_window,
+                minutes_window=limiter.minutes_window,
+                enforcement_type="internal",
+                subdomain=self.subdomain,
+                riot_endpoint=riot_endpoint,
+                seconds_count=counts.get("seconds"),
+                seconds_limit=limiter.seconds_limit,
+                minutes_count=counts.get("minutes"),
+                minutes_limit=limiter.minutes_limit,
+                windows=limiter.window_states(tier_counts or None),
+                reason=reason
+            )
+        elif tier == "service":
+            raise ServiceRateLimitExceeded(
+                retry_after_ms=retry_after_ms,
+                service=self.service,
+                enforcement_type="internal",
+                subdomain=self.subdomain,
+                riot_endpoint=riot_endpoint
+            )
+        else:
+            raise UnspecifiedRateLimitExceeded(
+                retry_after_ms=retry_after_ms,
+                service=self.service,
+                method=self.method,
+                enforcement_type="internal",
+                subdomain=self.subdomain,
+                riot_endpoint=riot_endpoint,
+                offending_context=None
+            )
+
+
+    async def acquire(self, timeout: float | None = None, riot_endpoint: str | None = None, async_redis_client=None):
+        """
+        Like check_and_increment() but waits for the next open slot instead of raising, see wait_for_admission().
+        Waiters for this (subdomain, method) are admitted in FIFO order, every priority class has its own line.
+        Returns the reservation of the request, see admit_one().
+        """
+        return await wait_for_admission(
+            ("admission", self.subdomain, self.method, self.priority),
+            lambda: self.admit_one(riot_endpoint, async_redis_client),
+            timeout
+        )
+
+class AdmissionHandle:
+    """
+    One admitted request, see AdmissionRateLimiter.admit_request().
+    Settled exactly once: commit() when the request may have reached Riot (it counts against Riot's limits as well),
+    or rollback() when it provably never left the process (connect failures, cancelled before it was sent)
+    so its tokens are not lost for the rest of the window.
+    stamps is where the admission counted the tokens (see AdmissionVerdict), a rollback never lowers a newer window.
+    counts is what the windows held with the tokens in them, see AdmissionRateLimiter.calibrate().
+    """
+    def __init__(
+        self,
+        admission_rate_limiter: AdmissionRateLimiter,
+        async_redis_client,
+        tokens: int = 1,
+        stamps: list[str] | None = None,
+        counts: list[int] | None = None,
+    ):
+        self.admission_rate_limiter = admission_rate_limiter
+        self.backend = get_rate_limit_backend(async_redis_client)
+        self.tokens = tokens
+        self.stamps: list[str] = stamps or []
+        self.counts: list[int] | None = counts
+        self.settled = False
+
+    def commit(self):
+        self.settled = True
+
+    async def rollback(self) -> bool:
+        """Give the tokens back. Returns False if the handle was already settled."""
+        if self.settled:
+            return False
+        self.settled = True
+        await self.admission_rate_limiter.give_back(self.tokens, self.stamps, self.backend)
+        return True
+
+
+# Bounded LRU of prebuilt admission limiters. 15 platform + 4 regional routers times every supported method fits comfortably.
+ADMISSION_CACHE_SIZE = 2048
+_admission_cache: OrderedDict[tuple[str, str, str, str, str | None], AdmissionRateLimiter] = OrderedDict()
+
+
+def get_admission_rate_limiter(riot_endpoint: str, priority: str = "interactive", tenant: str | None = None) -> AdmissionRateLimiter:
+    """
+    Return the shared AdmissionRateLimiter for the endpoint's (subdomain, service, method), priority class and tenant.
+    The keys, limits and Lua script of a route never change, so they are built once and reused by every request
+    instead of constructing four limiter objects per call. Pass the endpoint and Redis client to check_and_increment().
+    """
+    route = resolve_riot_route(riot_endpoint)
+    cache_key = (route["subdomain"], route["service"], route["method"], priority, tenant)
+    admission_rate_limiter = _admission_cache.get(cache_key)
+    if admission_rate_limiter is not None:
+        _admission_cache.move_to_end(cache_key)
+        return admission_rate_limiter
+
+    admission_rate_limiter = AdmissionRateLimiter(riot_endpoint, None, priority=priority, tenant=tenant)
+    _admission_cache[cache_key] = admission_rate_limiter
+    if len(_admission_cache) > ADMISSION_CACHE_SIZE:
+        _, evicted = _admission_cache.popitem(last=False)
+        evicted.drop_leases()
+    return admission_rate_limiter
+
+
+def invalidate_admission_rate_limiters(subdomain: str | None, method: str | None = None):
+    """
+    Forget the cached admission limiters of a subdomain (or one of its methods) so they are rebuilt with current limits.
+    subdomain None forgets every cached limiter, ex. after a worker joined or left the fleet.
+    """
+    for cache_key in [cache_key for cache_key in _admission_cache if subdomain in (None, cache_key[0]) and method in (None, cache_key[2])]:
+        _admission_cache.pop(cache_key).drop_leases()
+
+
+async def load_discovered_rate_limits(riot_endpoint: str, async_redis_client):
+    """
+    Load the method limits discovered by any process for the endpoint's subdomain, once per process and subdomain.
+    Cached admission limiters of methods whose limits changed are rebuilt on their next use.
+    """
+    subdomain = resolve_riot_route(riot_endpoint)["subdomain"]
+    if DISCOVERED_RATE_LIMITS.is_loaded(subdomain):
+        return
+    for method in await DISCOVERED_RATE_LIMITS.load(subdomain, get_rate_limit_backend(async_redis_client)):
+        invalidate_admission_rate_limiters(subdomain, method)
+
+
+def drop_admission_leases(subdomain: str):
+    """Stop handing out every lease for a subdomain, so the next request re-checks the blocking keys in Redis."""
+    for admission_rate_limiter in list(_admission_cache.values()):
+        if admission_rate_limiter.subdomain == subdomain:
+            admission_rate_limiter.drop_leases()
+
+
+def apply_block_event(event: BlockEvent, scope):
+    """Act on another process's inbound 429 as if it were our own: remember the blocking key and drop the subdomain's leases."""
+    ttl_ms = remaining_ms(event)
+    if ttl_ms <= 0:
+        return
+    BLOCKING_CACHE.block(scope, event["key"], ttl_ms)
+    drop_admission_leases(event["subdomain"])
+
+
+class BlockEventSubscriber:
+    """
+    Listens to the inbound 429s every other process publishes (BLOCK_EVENTS_CHANNEL) and applies them to this process
+    right away, so workers stop sending to a blocked scope one pub/sub hop after the first 429 instead of after their own.
+    Run one per process: start() runs it as a background task of the running event loop, stop() cancels it.
+    Lost connections are retried every RECONNECT_DELAY seconds, until then blocking keys are still found on the next admission.
+    Redis Cluster: pass a redis.asyncio.Redis client of any node, RedisCluster clients cannot subscribe.
+    """
+    RECONNECT_DELAY = 1
+
+    def __init__(self, async_redis_client, admission_redis_client=None):
+        self.backend = get_rate_limit_backend(async_redis_client)
+        # Deadlines are recorded for the backend admissions go through, which is not the subscribing client on a cluster
+        self.scope = get_rate_limit_backend(admission_redis_client or async_redis_client).lease_scope
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> "BlockEventSubscriber":
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                async for message in self.backend.listen(BLOCK_EVENTS_CHANNEL):
+                    event = decode_block_event(message)
+                    if event is not None:
+                        apply_block_event(event, self.scope)
+                return  # The backend has nothing to publish to this process
+            except (RedisError, OSError):
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+
+class FleetHeartbeat:
+    """
+    Registers this worker in the fleet of workers sharing its API key (FLEET_KEY) every ND_FLEET_HEARTBEAT_MS
+    and gives every live worker a share of every application and method window, see AdmissionRateLimiter.fleet_entries().
+    A worker that misses FLEET_MISSED_HEARTBEATS in a row is dropped, and stop() leaves the fleet right away.
+    Every other worker notices the change on its next heartbeat and rebuilds its cached limiters (and drops its leases)
+    with the new share, so capacity moves to the workers that are left within one ND_FLEET_HEARTBEAT_MS.
+    Run one per process: start() runs it as a background task of the running event loop, stop() cancels it.
+    Combined with leasing (ND_LEASE_SIZE) each worker then admits its share locally instead of racing the others to Redis.
+    """
+    def __init__(self, async_redis_client, heartbeat_ms: int | None = None):
+        self.backend = get_rate_limit_backend(async_redis_client)
+        self.heartbeat_ms: int = heartbeat_ms or ND_FLEET_HEARTBEAT_MS
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> "FleetHeartbeat":
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        try:
+            await self.backend.heartbeat(FLEET_KEY, FLEET.worker_id, 0)
+        except (RedisError, OSError):
+            pass  # Dropped once its last heartbeat expires instead
+        if FLEET.reset():
+            invalidate_admission_rate_limiters(None)
+
+    async def beat(self):
+        """Renew this worker's membership and rebuild the cached limiters when a worker joined or left."""
+        members = await self.backend.heartbeat(FLEET_KEY, FLEET.worker_id, self.heartbeat_ms * FLEET_MISSED_HEARTBEATS)
+        if FLEET.update(members):
+            invalidate_admission_rate_limiters(None)
+
+    async def run(self):
+        while True:
+            try:
+                await self.beat()
+            except (RedisError, OSError):
+                pass  # The last known share holds until the next heartbeat gets through
+            await asyncio.sleep(self.heartbeat_ms / 1000)
@@ -1,5 +1,8 @@
-from .rate_limiter import ApplicationRateLimiter, MethodRateLimiter, ServiceRateLimiter, UnspecifiedRiotRateLimiter
-from .exceptions import RiotAPIError, RiotNetworkError
+from .rate_limiter import AdmissionHandle, AdmissionRateLimiter, ApplicationRateLimiter, MethodRateLimiter, ServiceRateLimiter, UnspecifiedRiotRateLimiter, get_admission_rate_limiter, drop_admission_leases, load_discovered_rate_limits
+from .exceptions import RiotAPIError, RiotNetworkError, RiotRelatedRateLimitException
+from redis.exceptions import RedisError
+import asyncio
+import time
 from .json_types import JSONValue, RiotResponse
 import httpx
 from dotenv import load_dotenv
@@ -7,6 +10,7 @@ from .utilities import custom_print
 from typing import Any, cast
 from json import JSONDecodeError
 from .settings.config import ND_RIOT_API_KEY, ND_DEBUG
+from .headroom import HEADROOM
 load_dotenv()
 
 riot_key = ND_RIOT_API_KEY
@@ -22,6 +26,12 @@ async def perform_riot_request(
     riot_endpoint: str, 
     client: httpx.AsyncClient, 
     async_redis_client: Any,
+    *,
+    wait: bool = False,
+    timeout: float | None = None,
+    priority: str = "interactive",
+    tenant: str | None = None,
+    in_flight_timeout: float | None = None,
 ) -> RiotResponse:
     """
     Performs a GET request to the Riot API while respecting their rate limiting.
@@ -31,25 +41,158 @@ async def perform_riot_request(
     or an exception from the RiotRelatedRateLimitException classes where a rate limit is hit and New Destiny caught it.
     Note that some 5XX errors are transient network related issues. You may want to catch httpx.RequestError (catch all),
     httpx.ConnectionError, or httpx.TimeoutException errors in your application. These will buble up.
+
+    wait=True parks the coroutine until the next rate limit slot opens instead of raising an internally enforced
+    RiotRelatedRateLimitException. Waiters for the same (subdomain, method) are admitted in FIFO order.
+    timeout caps how many seconds to wait in all (None waits as long as it takes), past it the rate limit exception is raised as usual.
+    Useful for background crawlers that should run at the configured limit. Inbound 429s are still raised.
+    With ND_MAX_IN_FLIGHT_PER_ROUTER or ND_MAX_IN_FLIGHT_PER_METHOD set the request also holds an in flight slot while it awaits
+    Riot's response. A full cap raises InFlightLimitExceeded (after refunding the admission), or with wait=True waits for a slot.
+    in_flight_timeout waits up to that many seconds for a slot without wait=True, so only the admission raises right away.
+    priority="batch" leaves ND_INTERACTIVE_RESERVE of every application and method window to "interactive" requests (the default),
+    so backfills only use the budget user facing lookups leave over.
+    tenant is whose share of the application limit the request is counted against (ND_APPLICATION_SHARES),
+    by default the endpoint's service when it has a share of its own.
     """
-    # Instantiate the rate limiters
-    application_rate_limiter = ApplicationRateLimiter(riot_endpoint, async_redis_client)
-    method_rate_limiter = MethodRateLimiter(riot_endpoint, async_redis_client)
-    service_rate_limiter = ServiceRateLimiter(riot_endpoint, async_redis_client)
-    unspecified_rate_limiter = UnspecifiedRiotRateLimiter(riot_endpoint, async_redis_client)
-
-    # Check if any limit is currently hit and increment
-    await application_rate_limiter.check_and_increment()
-    await method_rate_limiter.check_and_increment()
-    await service_rate_limiter.is_allowed()
-    await unspecified_rate_limiter.is_allowed()
+    # timeout covers the wait for an admission and for an in flight slot together
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+
+    # Look up the prebuilt rate limiter for this route, nothing is constructed per request
+    await load_discovered_rate_limits(riot_endpoint, async_redis_client)
+    admission_rate_limiter = get_admission_rate_limiter(riot_endpoint, priority, tenant)
+
+    # Check if any limit is currently hit and increment, all four tiers in one atomic round trip
+    admission = await admission_rate_limiter.admit_request(riot_endpoint, async_redis_client, wait=wait, timeout=timeout)
     if debug: custom_print("rate limiter checks passed", color="black")
 
+    if not wait and in_flight_timeout is not None:
+        return await _send_riot_request(riot_endpoint, client, async_redis_client, admission, wait=True, timeout=in_flight_timeout)
+    remaining = None if deadline is None else max(0, deadline - loop.time())
+    return await _send_riot_request(riot_endpoint, client, async_redis_client, admission, wait=wait, timeout=remaining)
+
+
+async def perform_riot_requests(
+    riot_endpoints: list[str],
+    client: httpx.AsyncClient,
+    async_redis_client: Any,
+    *,
+    wait: bool = False,
+    timeout: float | None = None,
+    return_exceptions: bool = False,
+    priority: str = "interactive",
+    tenant: str | None = None,
+) -> list[RiotResponse | BaseException]:
+    """
+    Performs a batch of GET requests to the Riot API, reserving their rate limit slots in bulk instead of one by one.
+    Endpoints are grouped by (subdomain, method) and every group reserves as many slots as the application and method
+    windows have room for in one atomic round trip, so a batch of 100 match URLs costs one Redis call and never reserves more
+    than the windows have room for (Riot's own windows can still disagree with ours, see calibrate()).
+    Returns the results in the same order as riot_endpoints, like asyncio.gather().
+    Endpoints that did not get a slot raise the internally enforced RiotRelatedRateLimitException of the tier that blocked them,
+    unless wait=True: then the rest of the group is reserved as soon as the windows have room again, timeout caps the wait in seconds.
+    return_exceptions=True returns exceptions in place of results instead of raising the first one.
+    Any other error while reserving (ex. redis.exceptions.RedisError) cancels the requests already launched and is raised.
+    priority and tenant apply to every request of the batch, see perform_riot_request().
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    outcomes: list[asyncio.Future | None] = [None] * len(riot_endpoints)
+
+    groups: dict[AdmissionRateLimiter, list[int]] = {}
+    for index, riot_endpoint in enumerate(riot_endpoints):
+        await load_discovered_rate_limits(riot_endpoint, async_redis_client)
+        groups.setdefault(get_admission_rate_limiter(riot_endpoint, priority, tenant), []).append(index)
+
+    async def reserve(admission_rate_limiter: AdmissionRateLimiter, pending: list[int]):
+        while pending:
+            try:
+                reservation = await admission_rate_limiter.check_and_increment_many(len(pending), riot_endpoints[pending[0]], async_redis_client)
+            except RiotRelatedRateLimitException as exc:
+                retry_after = exc.retry_after_ms / 1000
+                if not wait or (deadline is not None and loop.time() + retry_after > deadline):
+                    for index in pending:
+                        outcomes[index] = loop.create_future()
+                        outcomes[index].set_exception(exc)
+                    return
+                await asyncio.sleep(retry_after)
+                continue
+
+            granted, pending = pending[:reservation["granted"]], pending[reservation["granted"]:]
+            if debug: custom_print(f"reserved {len(granted)} slots, {len(pending)} pending", color="black")
+            for index in granted:
+                admission = AdmissionHandle(admission_rate_limiter, async_redis_client, stamps=reservation["stamps"], counts=reservation["counts"])
+                remaining = None if deadline is None else max(0, deadline - loop.time())
+                outcomes[index] = asyncio.ensure_future(
+                    _send_riot_request(riot_endpoints[index], client, async_redis_client, admission, wait=wait, timeout=remaining)
+                )
+            # Without waiting the next reservation raises the exception for whatever is left
+            if pending and wait and reservation["retry_after_ms"] > 0:
+                retry_after = reservation["retry_after_ms"] / 1000
+                if deadline is None or loop.time() + retry_after <= deadline:
+                    await asyncio.sleep(retry_after)
+
+    reservations = [asyncio.ensure_future(reserve(admission_rate_limiter, indices)) for admission_rate_limiter, indices in groups.items()]
+    try:
+        await asyncio.gather(*reservations)
+    except BaseException:
+        # A group could not reserve for another reason than a rate limit (ex. Redis is unreachable) or the batch was cancelled:
+        # stop the other groups and the requests already launched rather than leave them running with nobody awaiting them
+        launched = [outcome for outcome in outcomes if outcome is not None]
+        for task in (*reservations, *launched):
+            task.cancel()
+        await asyncio.gather(*reservations, *launched, return_exceptions=True)
+        raise
+    return await asyncio.gather(*outcomes, return_exceptions=return_exceptions)
+
+
+async def _send_riot_request(
+    riot_endpoint: str,
+    client: httpx.AsyncClient,
+    async_redis_client: Any,
+    admission: AdmissionHandle,
+    *,
+    wait: bool = False,
+    timeout: float | None = None,
+) -> RiotResponse:
+    """
+    Sends a GET request that was already admitted by the rate limiter and handles Riot's response.
+    The admission is rolled back (its tokens refunded) when the request provably never left the process:
+    connect failures, pool timeouts and cancellation before the request headers started being written.
+    The GET holds an in flight slot (see InFlightLimiter) from before it is sent until its response arrived,
+    wait and timeout apply to getting one.
+    """
+    admission_rate_limiter = admission.admission_rate_limiter
+    in_flight_limiter = admission_rate_limiter.in_flight_limiter
+    request_sent = False
+
+    try:
+        in_flight_token = await in_flight_limiter.acquire(riot_endpoint, async_redis_client, wait=wait, timeout=timeout)
+    except BaseException:
+        # Never sent, whatever went wrong (a full cap, a timeout, cancellation, Redis being unreachable).
+        # Shielded so the refund still completes while a cancellation propagates
+        await asyncio.shield(admission.rollback())
+        raise
+
+    async def trace(event_name: str, info: dict):
+        nonlocal request_sent
+        if event_name.endswith("send_request_headers.started"):  # http11. or http2.
+            request_sent = True
+
     # Perform the GET request with network error handling
+    HEADROOM.started(admission_rate_limiter.subdomain)
+    started_at = time.monotonic()
     try:
         if debug: custom_print(riot_endpoint, color="black")
-        response = await client.get(riot_endpoint, headers=auth_headers)
+        response = await client.get(riot_endpoint, headers=auth_headers, extensions={"trace": trace})
+    except asyncio.CancelledError:
+        if not request_sent:
+            # Shielded so the refund still completes while the cancellation propagates
+            await asyncio.shield(admission.rollback())
+        raise
     except httpx.TimeoutException as e:
+        if isinstance(e, (httpx.ConnectTimeout, httpx.PoolTimeout)):
+            await admission.rollback()  # No connection was ever available to send on
         raise RiotNetworkError(
             error_type="timeout",
             message=f"Request timed out: {str(e)}",
@@ -57,6 +200,7 @@ async def perform_riot_request(
             original_exception=e
         )
     except httpx.ConnectError as e:
+        await admission.rollback()  # Failed before a connection existed, nothing was sent
         raise RiotNetworkError(
             error_type="connection",
             message=f"Failed to connect: {str(e)}",
@@ -71,7 +215,22 @@ async def perform_riot_request(
             riot_endpoint=riot_endpoint,
             original_exception=e
         )
+    finally:
+        HEADROOM.finished(admission_rate_limiter.subdomain, (time.monotonic() - started_at) * 1000)
+        # The response is read in full (or the request failed), the slot is free for the next request
+        await asyncio.shield(in_flight_limiter.release(in_flight_token, async_redis_client))
+    admission.commit()
     status = response.status_code
+
+    # Both are bookkeeping for the next requests, Riot already answered this one and it is returned either way
+    try:
+        # Every response but a 429 carries Riot's view of the application and method counts, catch up if ours are behind
+        if status != 429:
+            await admission_rate_limiter.calibrate(response.headers, async_redis_client, admission.counts)
+        # And the method limits Riot actually granted this key, which replace the hard-coded ones when they differ
+        await admission_rate_limiter.discover_limits(response.headers, async_redis_client)
+    except (RedisError, OSError) as e:
+        if debug: custom_print(f"Skipped calibrating with Riot's rate limit headers: {e!r}", color="yellow")
     
     # 200 OK
     if status == 200:
@@ -81,10 +240,10 @@ async def perform_riot_request(
     elif status == 204: # No Content - this happens mostly when LEAGUE-EXP-V4 Apex tiers are empty in the early season
         return None
 
-    elif service_rate_limiter.service == 'MATCH-V5' and status == 403:
+    elif admission_rate_limiter.service == 'MATCH-V5' and status == 403:
         # This means the game mode was the new BRAWL game mode and the Riot API does not support it by their design choice
         # https://x.com/RiotGamesDevRel/status/1922373887599489163
-        if debug: custom_print(f"Riot API returned 403 for {service_rate_limiter.service} with URL: {riot_endpoint}", color="cyan")
+        if debug: custom_print(f"Riot API returned 403 for {admission_rate_limiter.service} with URL: {riot_endpoint}", color="cyan")
         return None
 
     # Rate limited by Riot
@@ -96,13 +255,23 @@ async def perform_riot_request(
         if debug: 
             custom_print(rate_limit_type, color="yellow")
             custom_print(headers, color="yellow")
+        # Leased tokens skip the blocking keys written below, stop handing them out
+        drop_admission_leases(admission_rate_limiter.subdomain)
+        # Our counts said there was room, hold more of every window back until responses agree with Riot's again
+        if rate_limit_type in ("application", "method"):
+            HEADROOM.leaked(admission_rate_limiter.subdomain)
+        # Only an inbound 429 needs endpoint-bound limiters, so they are built here rather than on every request
         if rate_limit_type == "application":
+            application_rate_limiter = ApplicationRateLimiter(riot_endpoint, async_redis_client)
             await application_rate_limiter.write_inbound_application_rate_limit(retry_after=retry_after, offending_context={"headers": headers, "body": body})
         elif rate_limit_type == "method":
+            method_rate_limiter = MethodRateLimiter(riot_endpoint, async_redis_client)
             await method_rate_limiter.write_inbound_method_rate_limit(retry_after=retry_after, offending_context={"headers": headers, "body": body})
         elif rate_limit_type == "service":
+            service_rate_limiter = ServiceRateLimiter(riot_endpoint, async_redis_client)
             await service_rate_limiter.write_inbound_service_rate_limit(offending_context={"headers": headers, "body": body}) # Note this takes a default value defined in the ServiceRateLimiter class
         else: # If Riot failed to provide the X-Rate-Limit-Type header which is a bug that has rarely been observed...write a block-all to be respectful
+            unspecified_rate_limiter = UnspecifiedRiotRateLimiter(riot_endpoint, async_redis_client)
             await unspecified_rate_limiter.write_inbound_unspecified_rate_limit(retry_after=retry_after, offending_context={"headers": headers, "body": body})
 
     # Transient gateway/proxy errors - treat as network errors (can be retried)
@@ -9,7 +9,7 @@ import httpx
 import random
 from functools import wraps
 from typing import Any, Awaitable, Callable, Mapping, ParamSpec, TypeVar, cast
-from .settings.config import ND_DEBUG
+from .settings.config import ND_DEBUG, ND_IN_FLIGHT_LEASE_MS
 
 """
 Note: the retry logic is currently only meant for background processes. 
@@ -21,6 +21,9 @@ Background jobs can happily wait.
 P = ParamSpec("P")
 R = TypeVar("R")
 
+# Added to every rate limit sleep so timer jitter never wakes us before Redis has expired the violated key
+RETRY_AFTER_MARGIN_MS = 5
+
 
 def _exp_backoff_with_jitter(*, attempt: int, base: float = 1.0, cap: float = 20.0) -> float:
     """
@@ -45,7 +48,7 @@ def retry_on_riot_rate_limited_or_network_error(
 ) -> Callable[[Callable[P, Awaitable[R]]], Callable[P, Awaitable[R]]]:
     """
     Retry decorator for Riot API requests that handles:
-      - RiotRelatedRateLimitException: Sleep retry_after + 1 seconds then retry
+      - RiotRelatedRateLimitException: Sleep exactly retry_after_ms (plus a small margin) then retry
       - RiotNetworkError: Exponential backoff with jitter (transient network/infrastructure issues)
       - All other exceptions (RiotAPIError): Raised immediately without retry
 
@@ -58,9 +61,8 @@ def retry_on_riot_rate_limited_or_network_error(
         network_tolerance: int
 
     Note:
-        Adds +1 second to retry_after for rate limits to ensure Redis has time to expire keys.
-        If we sleep the exact amount and retry instantly, Redis may not have expired the violated key yet,
-        causing a 0 second retry_after loop that exhausts attempts immediately.
+        Sleeps retry_after_ms plus RETRY_AFTER_MARGIN_MS. Limiter TTLs are millisecond precise (PTTL) so the window
+        has reopened by then, the margin only absorbs timer jitter so we never wake a hair before Redis expires the key.
     """
     if default_rate_limit_attempts < 1:
         raise ValueError("default_rate_limit_attempts must be >= 1. If you do not want retries do not use this function.")
@@ -111,11 +113,11 @@ def retry_on_riot_rate_limited_or_network_error(
                         # Exhausted RL budget
                         raise
 
-                    sleep_s = int(exc.retry_after) + 1
+                    sleep_s = (exc.retry_after_ms + RETRY_AFTER_MARGIN_MS) / 1000
                     if ND_DEBUG:
                         custom_print(
                             f"[Riot RL] {exc.__class__.__name__}, enforcement_type={exc.enforcement_type} "
-                            f"retry_after={exc.retry_after} sleep={sleep_s}s "
+                            f"retry_after_ms={exc.retry_after_ms} sleep={sleep_s:.3f}s "
                             f"rate_limit_failures_seen={rl_failures_seen} max_rate_limit_failures={attempts}",
                             color="yellow",
                         )
@@ -156,6 +158,8 @@ async def riot_request_with_retry(
     async_redis_client: Any,
     attempts: int | None = None,
     network_tolerance: int | None = None,
+    priority: str = "interactive",
+    tenant: str | None = None,
 ) -> RiotResponse:
     """
     Performs a Riot API request with automatic retry logic for rate limit failures and transient network failures.
@@ -172,11 +176,21 @@ async def riot_request_with_retry(
             Some amount of this is unavoidable. If you run a job long enough you will see this.
             Sometimes a well foramtted request will just run into network issues.
             1 means no retry. Bubble on first encounter--or just do not use this retry function.
+      - priority: str
+            Default "interactive"
+            The priority class the request is admitted as, "batch" leaves ND_INTERACTIVE_RESERVE of every window to interactive requests.
+      - tenant: str | None
+            Default None (the endpoint's service when it has a share, "default" otherwise)
+            Whose share of the application limit the request is counted against, see ND_APPLICATION_SHARES.
 
     Retries on:
-      - RiotRelatedRateLimitException: Sleeps retry_after + 1 seconds, then retries (RL budget)
+      - RiotRelatedRateLimitException: Sleeps retry_after_ms (plus a small margin), then retries (RL budget)
       - RiotNetworkError: Uses exponential backoff with jitter (NET budget)
 
+    A full in flight cap (ND_MAX_IN_FLIGHT_PER_ROUTER, ND_MAX_IN_FLIGHT_PER_METHOD) is waited out instead, for up to
+    ND_IN_FLIGHT_LEASE_MS: a slot frees up as soon as any response arrives, and within one lease even when its worker crashed.
+    Only then does InFlightLimitExceeded count against the RL budget.
+
     Does NOT retry on:
       - RiotAPIError: Real API errors (4XX client errors, 500 server errors) - raised immediately
       - Other exceptions: Unknown errors that should bubble up
@@ -190,4 +204,7 @@ async def riot_request_with_retry(
         riot_endpoint=riot_endpoint,
         client=client,
         async_redis_client=async_redis_client,
+        priority=priority,
+        tenant=tenant,
+        in_flight_timeout=ND_IN_FLIGHT_LEASE_MS / 1000,
     )
@@ -0,0 +1,63 @@
+import hashlib
+import weakref
+from redis.exceptions import NoScriptError
+
+###### Lua Script Registry ######
+###### Lua Script Registry ######
+###### Lua Script Registry ######
+
+class LuaScriptRegistry:
+    """
+    Process-wide registry of the Lua scripts New Destiny runs against Redis.
+    SHA1 digests are computed locally once per script for the life of the process, and each script is sent with
+    SCRIPT LOAD at most once per Redis connection pool. If Redis answers NOSCRIPT (ex. it restarted or failed over
+    and lost its script cache) the script is transparently reloaded and the call retried once.
+    """
+    def __init__(self):
+        self._shas: dict[str, str] = {}
+        # connection pool -> SHAs known to be loaded on it. Weak so dropped clients/pools do not leak.
+        self._loaded: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def sha(self, script: str) -> str:
+        """Return the SHA1 digest Redis uses to identify the script, without a round trip."""
+        sha = self._shas.get(script)
+        if sha is None:
+            sha = hashlib.sha1(script.encode("utf-8")).hexdigest()
+            self._shas[script] = sha
+        return sha
+
+    def _loaded_shas(self, async_redis_client) -> set[str]:
+        # Clients sharing a connection pool share a Redis server. Clients without one (ex. RedisCluster) are their own key.
+        pool = getattr(async_redis_client, "connection_pool", None) or async_redis_client
+        loaded = self._loaded.get(pool)
+        if loaded is None:
+            loaded = set()
+            self._loaded[pool] = loaded
+        return loaded
+
+    async def load(self, async_redis_client, script: str) -> str:
+        """SCRIPT LOAD the script if it has not been loaded on this client's connection pool yet. Returns its SHA."""
+        sha = self.sha(script)
+        loaded = self._loaded_shas(async_redis_client)
+        if sha not in loaded:
+            await async_redis_client.script_load(script)
+            loaded.add(sha)
+        return sha
+
+    def forget(self, async_redis_client, script: str):
+        """Mark the script as no longer loaded on this client's connection pool, ex. after a NOSCRIPT reply."""
+        self._loaded_shas(async_redis_client).discard(self.sha(script))
+
+    async def evalsha(self, async_redis_client, script: str, numkeys: int, *keys_and_args):
+        """EVALSHA the script, loading it first if needed and reloading it once if Redis no longer has it."""
+        sha = await self.load(async_redis_client, script)
+        try:
+            return await async_redis_client.evalsha(sha, numkeys, *keys_and_args)
+        except NoScriptError:
+            self.forget(async_redis_client, script)
+            sha = await self.load(async_redis_client, script)
+            return await async_redis_client.evalsha(sha, numkeys, *keys_and_args)
+
+
+# One registry for the whole process, every limiter instance shares it
+SCRIPT_REGISTRY = LuaScriptRegistry()
@@ -47,11 +47,100 @@ def get_validated_positive_int(var_name):
     except ValueError:
         raise ValueError(f"Choose a sensical integer value > 0 for {var_name}, or do not specify it. You set it to: {val}")
 
+def get_validated_rate_limits(var_name):
+    """Parse "limit:window,limit:window,..." (ex. "500:10,30000:600") into [(limit, window in seconds), ...]."""
+    val = os.getenv(var_name)
+    if val is None:
+        return None
+    limits = []
+    for pair in val.split(","):
+        limit, _, window = pair.strip().partition(":")
+        if not (limit.isdigit() and window.isdigit()) or int(limit) <= 0 or int(window) <= 0:
+            raise ValueError(f"{var_name} must be comma separated limit:window pairs of integers > 0, ex. 500:10,30000:600. You set it to: {val}")
+        limits.append((int(limit), int(window)))
+    if len({window for _, window in limits}) != len(limits):
+        raise ValueError(f"{var_name} cannot have two limits for the same window. You set it to: {val}")
+    return limits
+
+def get_validated_shares(var_name):
+    """Parse "tenant:weight,tenant:weight,..." (ex. "MATCH-V5:3,LEAGUE-V4:1,default:1") into {tenant: weight}."""
+    val = os.getenv(var_name)
+    if val is None:
+        return None
+    shares = {}
+    for pair in val.split(","):
+        tenant, _, weight = pair.strip().rpartition(":")
+        if not tenant or not weight.isdigit() or int(weight) <= 0 or tenant in shares:
+            raise ValueError(f"{var_name} must be comma separated tenant:weight pairs with distinct tenants and integer weights > 0, ex. MATCH-V5:3,default:1. You set it to: {val}")
+        shares[tenant] = int(weight)
+    return shares
+
 # Assign validated values (or None)
 ND_CUSTOM_SECONDS_LIMIT = get_validated_positive_int("ND_CUSTOM_SECONDS_LIMIT")
 ND_CUSTOM_SECONDS_WINDOW = get_validated_positive_int("ND_CUSTOM_SECONDS_WINDOW")
 ND_CUSTOM_MINUTES_LIMIT = get_validated_positive_int("ND_CUSTOM_MINUTES_LIMIT")
 ND_CUSTOM_MINUTES_WINDOW = get_validated_positive_int("ND_CUSTOM_MINUTES_WINDOW")
 
-if (ND_CUSTOM_SECONDS_LIMIT or ND_CUSTOM_SECONDS_WINDOW or ND_CUSTOM_MINUTES_LIMIT or ND_CUSTOM_MINUTES_WINDOW) and not ND_PRODUCTION:
-    raise ValueError("Only Production API Keys have custom limits. Either set ND_PRODUCTION to 1 or remove all ND_CUSTOM variables.")
\ No newline at end of file
+# Any number of application windows, replaces the ND_CUSTOM_SECONDS/MINUTES pairs. ex. ND_CUSTOM_APPLICATION_LIMITS=500:10,30000:600
+ND_CUSTOM_APPLICATION_LIMITS = get_validated_rate_limits("ND_CUSTOM_APPLICATION_LIMITS")
+
+if (ND_CUSTOM_SECONDS_LIMIT or ND_CUSTOM_SECONDS_WINDOW or ND_CUSTOM_MINUTES_LIMIT or ND_CUSTOM_MINUTES_WINDOW or ND_CUSTOM_APPLICATION_LIMITS) and not ND_PRODUCTION:
+    raise ValueError("Only Production API Keys have custom limits. Either set ND_PRODUCTION to 1 or remove all ND_CUSTOM variables.")
+
+if ND_CUSTOM_APPLICATION_LIMITS and (ND_CUSTOM_SECONDS_LIMIT or ND_CUSTOM_SECONDS_WINDOW or ND_CUSTOM_MINUTES_LIMIT or ND_CUSTOM_MINUTES_WINDOW):
+    raise ValueError("Set either ND_CUSTOM_APPLICATION_LIMITS or the ND_CUSTOM_SECONDS/MINUTES variables, not both.")
+
+# How windows are counted. "fixed" (default) starts a window on its first request, like Riot does.
+# "sliding" counts every tenth of a window that overlaps the window ending now, so no window of any alignment exceeds the limit.
+# "gcra" paces requests window/limit apart with no burst, from one theoretical arrival time per window.
+RATE_LIMIT_ALGORITHMS = ("fixed", "sliding", "gcra")
+ND_RATE_LIMIT_ALGORITHM = os.getenv("ND_RATE_LIMIT_ALGORITHM", "fixed").lower()
+if ND_RATE_LIMIT_ALGORITHM not in RATE_LIMIT_ALGORITHMS:
+    raise ValueError(f"ND_RATE_LIMIT_ALGORITHM must be one of {', '.join(RATE_LIMIT_ALGORITHMS)}. You set it to: {ND_RATE_LIMIT_ALGORITHM}")
+
+# Optional token leasing. ND_LEASE_SIZE is the most tokens one Redis round trip may reserve for this process, unset disables leasing.
+# ND_LEASE_TTL_MS caps how long reserved tokens are handed out locally, i.e. how late blocking keys written by other processes are noticed.
+ND_LEASE_SIZE = get_validated_positive_int("ND_LEASE_SIZE")
+ND_LEASE_TTL_MS = get_validated_positive_int("ND_LEASE_TTL_MS") or 1000
+
+# Optional caps on the requests awaiting Riot's response at once, across every process, per router and per method of a router.
+# Every request holds a slot for at most ND_IN_FLIGHT_LEASE_MS, so the slots of a worker that crashed mid request free themselves.
+ND_MAX_IN_FLIGHT_PER_ROUTER = get_validated_positive_int("ND_MAX_IN_FLIGHT_PER_ROUTER")
+ND_MAX_IN_FLIGHT_PER_METHOD = get_validated_positive_int("ND_MAX_IN_FLIGHT_PER_METHOD")
+ND_IN_FLIGHT_LEASE_MS = get_validated_positive_int("ND_IN_FLIGHT_LEASE_MS") or 30000
+
+# Fleet heartbeats (FleetHeartbeat). Every worker renews its membership this often and is dropped after missing FLEET_MISSED_HEARTBEATS in a row.
+ND_FLEET_HEARTBEAT_MS = get_validated_positive_int("ND_FLEET_HEARTBEAT_MS") or 1000
+FLEET_MISSED_HEARTBEATS = 3
+
+# Weighted shares of the application limit per tenant (a Riot service like MATCH-V5, or the tenant= a caller passes).
+# Every tenant is guaranteed its weight's share of each application window and borrows what idle tenants leave unused.
+# Tenants that are not listed share the "default" weight (1 unless listed). Unset: one pool for everyone.
+ND_APPLICATION_SHARES = get_validated_shares("ND_APPLICATION_SHARES")
+
+# Priority classes. "batch" requests leave ND_INTERACTIVE_RESERVE (a share, default 0.1) of every application and method
+# limit to "interactive" ones, so backfills soak up the leftover budget without starving user facing lookups.
+PRIORITY_CLASSES = ("interactive", "batch")
+ND_INTERACTIVE_RESERVE = os.getenv("ND_INTERACTIVE_RESERVE", "0.1")
+try:
+    ND_INTERACTIVE_RESERVE = float(ND_INTERACTIVE_RESERVE)
+except ValueError:
+    raise ValueError(f"ND_INTERACTIVE_RESERVE must be a number from 0 up to (not including) 1. You set it to: {ND_INTERACTIVE_RESERVE}")
+if not 0 <= ND_INTERACTIVE_RESERVE < 1:
+    raise ValueError(f"ND_INTERACTIVE_RESERVE must be a number from 0 up to (not including) 1. You set it to: {ND_INTERACTIVE_RESERVE}")
+
+# Adaptive headroom (see AdaptiveHeadroom). The most of every application and method limit held back after leaked 429s,
+# drift against Riot's counts and requests in flight, as a share. Default 0 disables it and runs at the full limit.
+ND_MAX_HEADROOM = os.getenv("ND_MAX_HEADROOM", "0")
+try:
+    ND_MAX_HEADROOM = float(ND_MAX_HEADROOM)
+except ValueError:
+    raise ValueError(f"ND_MAX_HEADROOM must be a number from 0 up to (not including) 1. You set it to: {ND_MAX_HEADROOM}")
+if not 0 <= ND_MAX_HEADROOM < 1:
+    raise ValueError(f"ND_MAX_HEADROOM must be a number from 0 up to (not including) 1. You set it to: {ND_MAX_HEADROOM}")
+
+# Scripts issued in the same event loop tick (ex. an asyncio.gather of requests) share one Redis pipeline. 0 sends each on its own.
+ND_AUTO_PIPELINE = os.getenv("ND_AUTO_PIPELINE", "1")
+if ND_AUTO_PIPELINE not in ("1", "0"):
+    raise ValueError(f"ND_AUTO_PIPELINE must be 0 or 1. You set it to {ND_AUTO_PIPELINE}.")
+ND_AUTO_PIPELINE = int(ND_AUTO_PIPELINE)
@@ -0,0 +1,58 @@
+import os
+
+# new_destiny.settings.config requires these at import time, the tests never reach Redis or Riot
+os.environ.setdefault("ND_RIOT_API_KEY", "RGAPI-test")
+os.environ.setdefault("ND_REDIS_URL", "localhost")
+os.environ.setdefault("ND_REDIS_PORT", "6379")
+os.environ.setdefault("ND_DEBUG", "0")
+os.environ.setdefault("ND_PRODUCTION", "0")
+
+import time
+import pytest
+from new_destiny import rate_limiter
+from new_destiny.blocking_cache import BLOCKING_CACHE
+from new_destiny.fleet import FLEET
+from new_destiny.rate_limit_discovery import DISCOVERED_RATE_LIMITS
+from new_destiny.headroom import AdaptiveHeadroom
+from .helpers import Clock, ClockedBackend, ClockedRedisBackend, ClockedSharedMemoryBackend
+
+BACKENDS = ["memory", "shared_memory", "redis"]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch, tmp_path):
+    """
+    Every backend on a clock the test moves by hand. Each test runs against the Lua scripts (on fakeredis)
+    and their Python twins alike, so a change to one side of a pair fails until the other matches it.
+    """
+    clock = Clock()
+    if request.param == "redis":
+        monkeypatch.setattr(time, "time", clock.time)
+        yield ClockedRedisBackend(clock)
+    elif request.param == "shared_memory":
+        backend = ClockedSharedMemoryBackend(str(tmp_path / "new_destiny"), clock)
+        yield backend
+        backend.close()
+    else:
+        yield ClockedBackend(clock)
+
+
+@pytest.fixture
+def headroom(monkeypatch) -> AdaptiveHeadroom:
+    """A fresh controller in place of the process wide HEADROOM, enabled with a 20% cap."""
+    controller = AdaptiveHeadroom(max_headroom=0.2)
+    monkeypatch.setattr(rate_limiter, "HEADROOM", controller)
+    return controller
+
+
+@pytest.fixture(autouse=True)
+def reset_process_state(monkeypatch):
+    """Blocking keys, cached limiters, drift, discovered limits, headroom and the fleet are process wide, no test may see another's."""
+    monkeypatch.setattr(rate_limiter, "_rate_limit_drift", {})
+    monkeypatch.setattr(DISCOVERED_RATE_LIMITS, "_limits", {})
+    monkeypatch.setattr(DISCOVERED_RATE_LIMITS, "_loaded", set())
+    monkeypatch.setattr(rate_limiter, "HEADROOM", AdaptiveHeadroom())
+    yield
+    BLOCKING_CACHE.clear()
+    rate_limiter.invalidate_admission_rate_limiters(None)
+    FLEET.reset()
@@ -0,0 +1,61 @@
+from fakeredis import FakeAsyncRedis, FakeServer
+from new_destiny.rate_limit_backends import InMemoryBackend, RedisBackend, SharedMemoryBackend
+
+SUMMONER_URL = "https://na1.api.riotgames.com/lol/summoner/v4/summoners/by-puuid/abc"
+LEAGUE_URL = "https://na1.api.riotgames.com/lol/league/v4/entries/by-puuid/abc"
+ALGORITHMS = ["fixed", "sliding", "gcra"]
+
+# Where every clocked backend starts, Unix time in milliseconds (Redis' TIME and key expiry are wall clock)
+START_MS = 1_700_000_000_000
+
+
+class Clock:
+    """Milliseconds the test moves by hand, so windows roll over exactly when told to."""
+    def __init__(self, now: int = START_MS):
+        self.now = now
+
+    def time(self) -> float:
+        """Stands in for time.time() while a ClockedRedisBackend runs."""
+        return self.now / 1000
+
+
+class Clocked:
+    """The clock every test backend shares, see the backend fixture."""
+    clock: Clock
+
+    @property
+    def now(self) -> int:
+        return self.clock.now
+
+    def advance(self, ms: int):
+        self.clock.now += ms
+
+
+class ClockedBackend(Clocked, InMemoryBackend):
+    """InMemoryBackend on a Clock."""
+    def __init__(self, clock: Clock | None = None):
+        super().__init__()
+        self.clock = clock or Clock()
+
+    def _now(self) -> int:
+        return self.clock.now
+
+
+class ClockedSharedMemoryBackend(Clocked, SharedMemoryBackend):
+    """SharedMemoryBackend on a Clock."""
+    def __init__(self, path: str, clock: Clock | None = None):
+        super().__init__(path)
+        self.clock = clock or Clock()
+
+    def _now(self) -> int:
+        return self.clock.now
+
+
+class ClockedRedisBackend(Clocked, RedisBackend):
+    """
+    RedisBackend on a fakeredis server, running the very Lua scripts production runs. fakeredis reads time.time()
+    for TIME and key expiry, which the backend fixture points at the Clock.
+    """
+    def __init__(self, clock: Clock | None = None, auto_pipeline: bool = True):
+        super().__init__(FakeAsyncRedis(server=FakeServer(), decode_responses=True), auto_pipeline)
+        self.clock = clock or Clock()
@@ -0,0 +1,55 @@
+import json
+import time
+import pytest
+from new_destiny.block_events import decode_block_event, encode_block_event, remaining_ms
+from new_destiny.blocking_cache import BLOCKING_CACHE
+from new_destiny.rate_limiter import AdmissionRateLimiter, apply_block_event
+from .helpers import SUMMONER_URL
+
+EVENT = {"tier": "method", "subdomain": "na1", "method": "get_summoner", "key": "nd_method_block", "deadline_ms": 1_700_000_000_000}
+
+
+def test_encoded_events_decode_to_themselves():
+    event = decode_block_event(encode_block_event("application", "na1", None, "nd_application_block", 2000))
+    assert {key: event[key] for key in ("tier", "subdomain", "method", "key")} == {
+        "tier": "application",
+        "subdomain": "na1",
+        "method": None,
+        "key": "nd_application_block",
+    }
+    assert 0 < remaining_ms(event) <= 2000
+    assert decode_block_event(json.dumps(EVENT).encode()) == EVENT
+
+
+@pytest.mark.parametrize("message", [
+    "not json",
+    json.dumps([EVENT]),
+    json.dumps({**EVENT, "tier": "region"}),
+    json.dumps({**EVENT, "subdomain": 1}),
+    json.dumps({**EVENT, "key": None}),
+    json.dumps({**EVENT, "method": ["get_summoner"]}),
+    json.dumps({**EVENT, "deadline_ms": "1700000000000"}),
+    json.dumps({**EVENT, "deadline_ms": True}),
+    json.dumps({key: value for key, value in EVENT.items() if key != "deadline_ms"}),
+])
+def test_malformed_messages_are_not_events(message):
+    assert decode_block_event(message) is None
+
+
+@pytest.mark.asyncio
+async def test_another_process_block_is_answered_locally(backend):
+    limiter = AdmissionRateLimiter(SUMMONER_URL, backend, application_limits=[(20, 1)], method_limits=[(10_000, 10)])
+    event = {
+        "tier": "application",
+        "subdomain": "na1",
+        "method": None,
+        "key": limiter.application_rate_limiter.blocking_key,
+        "deadline_ms": int(time.time() * 1000) + 5000,
+    }
+    apply_block_event(event, backend.lease_scope)
+    verdict = await limiter.admit()
+    assert (verdict["allowed"], verdict["tier"], verdict["reason"]) == (False, "application", "blocking_key")
+    assert 0 < verdict["retry_after_ms"] <= 5000
+    # Events whose block already ended are dropped
+    apply_block_event({**event, "key": limiter.method_rate_limiter.blocking_key, "deadline_ms": 0}, backend.lease_scope)
+    assert BLOCKING_CACHE.check(backend.lease_scope, [limiter.method_rate_limiter.blocking_key]) == (-1, 0)
@@ -0,0 +1,76 @@
+import pytest
+from new_destiny.headroom import AdaptiveHeadroom
+from new_destiny.rate_limiter import AdmissionRateLimiter, priority_reserve
+from .helpers import SUMMONER_URL
+
+
+def test_leaks_grow_the_margin_fast_up_to_the_cap():
+    headroom = AdaptiveHeadroom(max_headroom=0.3)
+    margins = []
+    for _ in range(4):
+        headroom.leaked("na1")
+        margins.append(headroom.state("na1")["margin"])
+    assert margins == pytest.approx([0.05, 0.1, 0.2, 0.3])
+
+
+def test_drift_adds_its_share_of_the_limit():
+    headroom = AdaptiveHeadroom(max_headroom=0.3)
+    headroom.drifted("na1", 2, 20)
+    assert headroom.state("na1")["margin"] == pytest.approx(0.1)
+    headroom.drifted("na1", 20, 20)
+    assert headroom.state("na1")["margin"] == pytest.approx(0.3)
+
+
+def test_calm_responses_give_the_margin_back_slowly():
+    headroom = AdaptiveHeadroom(max_headroom=0.3)
+    headroom.leaked("na1")
+    for _ in range(5):
+        headroom.calmed("na1")
+    assert headroom.state("na1")["margin"] == pytest.approx(0.05 - 5 * AdaptiveHeadroom.CALM_STEP)
+    for _ in range(100):
+        headroom.calmed("na1")
+    assert headroom.state("na1")["margin"] == 0
+
+
+def test_routing_values_are_independent():
+    headroom = AdaptiveHeadroom(max_headroom=0.3)
+    headroom.leaked("na1")
+    assert headroom.headroom("euw1", 20, 1000) == 0
+    assert headroom.headroom("na1", 20, 1000) == pytest.approx(0.05)
+
+
+def test_requests_in_flight_are_a_floor():
+    headroom = AdaptiveHeadroom(max_headroom=0.3)
+    for _ in range(4):
+        headroom.started("na1")
+    headroom.finished("na1", 500)
+    assert headroom.state("na1")["in_flight"] == 3
+    # 3 in flight that may each spill half of them into the next 1 second window, out of a limit of 20
+    assert headroom.headroom("na1", 20, 1000) == pytest.approx(3 * 0.5 / 20)
+    assert headroom.state("na1")["headroom"] == pytest.approx(3 * 0.5 / 20)
+
+
+def test_latency_is_a_moving_average():
+    headroom = AdaptiveHeadroom()
+    headroom.started("na1")
+    headroom.finished("na1", 100)
+    headroom.started("na1")
+    headroom.finished("na1", 600)
+    assert headroom.state("na1")["latency_ms"] == pytest.approx(100 + AdaptiveHeadroom.LATENCY_WEIGHT * 500)
+
+
+def test_disabled_headroom_holds_nothing_back():
+    headroom = AdaptiveHeadroom(max_headroom=0)
+    headroom.leaked("na1")
+    headroom.started("na1")
+    headroom.finished("na1", 1000)
+    assert not headroom.enabled
+    assert headroom.headroom("na1", 20, 1000) == 0
+
+
+def test_headroom_applies_to_what_the_priority_class_may_use(backend, headroom):
+    headroom.leaked("na1")
+    headroom.leaked("na1")
+    batch = AdmissionRateLimiter(SUMMONER_URL, backend, priority="batch", application_limits=[(20, 1)], method_limits=[(10_000, 10)])
+    reserve = priority_reserve("batch")
+    assert batch.effective_reserve() == pytest.approx(reserve + 0.1 * (1 - reserve))
@@ -0,0 +1,322 @@
+import asyncio
+import os
+import pytest
+from fakeredis import FakeAsyncRedis, FakeServer
+from new_destiny.rate_limit_backends import RedisBackend, SharedMemoryBackend, get_rate_limit_backend
+from new_destiny.rate_limiter import AdmissionRateLimiter
+from redis.exceptions import ResponseError
+from .helpers import ALGORITHMS, SUMMONER_URL, ClockedBackend
+
+
+def riot_window_peak(times: list[int], window: int) -> int:
+    """Most requests Riot counts in one window, its windows start with the first request after the last one ended."""
+    peak = count = 0
+    start = None
+    for t in times:
+        if start is None or t >= start + window:
+            start, count = t, 0
+        count += 1
+        peak = max(peak, count)
+    return peak
+
+
+def any_window_peak(times: list[int], window: int) -> int:
+    """Most requests in any window, wherever it starts."""
+    peak = first = 0
+    for last, t in enumerate(times):
+        while times[first] <= t - window:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+
+
+async def admit(backend, algorithm: str, limit: int = 20, window: int = 1000, requested: int = 1, reserve: float = 0) -> list:
+    """One ADMISSION_SCRIPT call over a blocking key and one window, ms windows like the limiters pass them."""
+    return await backend.admit(["block", "window"], [1, algorithm, limit, window, requested, 0, reserve])
+
+
+async def count_of(backend, algorithm: str, limit: int = 20, window: int = 1000) -> int:
+    """The window's count, as RECONCILE_SCRIPT reads it (a Riot count of 0 never changes it)."""
+    return (await backend.reconcile(["window"], [algorithm, limit, window, 0]))[0]
+
+
+###### Riot's windows ######
+
+@pytest.mark.parametrize("limits", [[(20, 1)], [(20, 1), (100, 120)]])
+@pytest.mark.parametrize("offset", [0, 37, 480, 950, 999])
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.asyncio
+async def test_never_admits_more_than_riot_counts_per_window(backend, algorithm, offset, limits):
+    limiter = AdmissionRateLimiter(SUMMONER_URL, backend, algorithm, application_limits=limits, method_limits=[(10_000, 10)])
+    backend.advance(offset)
+    times = []
+    end = backend.now + 5000
+    while backend.now < end:
+        verdict = await limiter.admit()
+        if verdict["allowed"]:
+            times.append(backend.now)
+            backend.advance(1)
+        else:
+            # Retrying the moment the limiter says a request fits is the hardest test of its windows
+            backend.advance(verdict["retry_after_ms"])
+
+    for limit, window in limits:
+        assert riot_window_peak(times, window * 1000) <= limit
+    if algorithm != "fixed":
+        # Neither counts the boundary burst a fixed window allows, not even in windows Riot does not use
+        assert any_window_peak(times, 1000) <= 20
+    if len(limits) == 1:
+        assert len(times) >= 80  # and still uses most of the limit
+
+
+###### Admission ######
+
+@pytest.mark.asyncio
+async def test_fixed_window_starts_with_its_first_request(backend):
+    for _ in range(20):
+        assert (await admit(backend, "fixed"))[0] == 1
+    backend.advance(999)
+    allowed, retry_after, blocked_index, reason, *_ = await admit(backend, "fixed")
+    assert (allowed, retry_after, blocked_index, reason) == (0, 1, 2, "limit")
+    backend.advance(1)
+    assert (await admit(backend, "fixed"))[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_blocking_key_is_checked_first(backend):
+    await backend.set_block("block", 500)
+    assert (await admit(backend, "fixed"))[:4] == [0, 500, 1, "blocking_key"]
+    assert await count_of(backend, "fixed") == 0
+
+
+@pytest.mark.asyncio
+async def test_sliding_window_waits_for_its_oldest_bucket(backend):
+    for _ in range(20):
+        assert (await admit(backend, "sliding"))[0] == 1
+    backend.advance(500)
+    allowed, retry_after, *_ = await admit(backend, "sliding")
+    # Buckets are window / 10 wide and counted until they no longer overlap the window
+    assert (allowed, retry_after) == (0, 600)
+    backend.advance(600)
+    assert (await admit(backend, "sliding"))[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_gcra_paces_requests_without_a_burst(backend):
+    assert (await admit(backend, "gcra"))[0] == 1
+    allowed, retry_after, *_ = await admit(backend, "gcra")
+    assert (allowed, retry_after) == (0, 50)
+    backend.advance(50)
+    assert (await admit(backend, "gcra"))[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_requested_is_granted_up_to_the_room_left(backend):
+    allowed, retry_after, _, _, granted, lease_ttl, count, stamp = await admit(backend, "fixed", requested=30)
+    assert (allowed, granted, count, retry_after, lease_ttl) == (1, 20, 20, 1000, 1000)
+    assert stamp == str(backend.now + 1000)
+    # GCRA has room for one request at a time
+    assert (await admit(backend, "gcra", requested=30))[4] == 1
+
+
+@pytest.mark.parametrize("algorithm", ["fixed", "sliding"])
+@pytest.mark.asyncio
+async def test_reserve_is_held_back(backend, algorithm):
+    admitted = 0
+    while (await admit(backend, algorithm, reserve=0.1))[0] == 1:
+        admitted += 1
+    assert admitted == 18
+    assert (await admit(backend, algorithm))[0] == 1
+
+
+@pytest.mark.asyncio
+async def test_gcra_reserve_stretches_the_interval(backend):
+    assert (await admit(backend, "gcra", reserve=0.1))[0] == 1
+    backend.advance(50)
+    assert (await admit(backend, "gcra", reserve=0.1))[0] == 0
+    backend.advance(6)  # 1000 / 18 ms apart
+    assert (await admit(backend, "gcra", reserve=0.1))[0] == 1
+
+
+###### Blocking keys ######
+
+@pytest.mark.asyncio
+async def test_blocking_keys_are_only_ever_extended(backend):
+    assert tuple(await backend.extend_block("block", 1000)) == (0, 0)
+    backend.advance(400)
+    assert tuple(await backend.extend_block("block", 300)) == (1, 600)
+    assert await backend.block_ttl("block") == 600
+    assert tuple(await backend.extend_block("block", 2000)) == (1, 600)
+    assert await backend.block_ttl("block") == 2000
+    assert await backend.set_block("block", 5000) == 2000
+    backend.advance(2001)
+    assert await backend.block_ttl("block") == -2
+
+
+###### Refunds ######
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.asyncio
+async def test_refund_returns_tokens_to_their_window(backend, algorithm):
+    await admit(backend, algorithm)
+    backend.advance(100)
+    stamp = (await admit(backend, algorithm))[-1]
+    await backend.refund(["window"], [1, algorithm, 20, 1000, stamp])
+    assert await count_of(backend, algorithm) == 1
+    if algorithm == "gcra":
+        # The schedule is pulled back too, the next request does not wait for the refunded one
+        assert (await admit(backend, algorithm))[0] == 1
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.asyncio
+async def test_late_refund_never_lowers_a_newer_window(backend, algorithm):
+    stamp = (await admit(backend, algorithm))[-1]
+    backend.advance(1500)
+    await admit(backend, algorithm)
+    backend.advance(100)
+    await admit(backend, algorithm)
+    await backend.refund(["window"], [1, algorithm, 20, 1000, stamp])
+    assert await count_of(backend, algorithm) == 2
+
+
+@pytest.mark.asyncio
+async def test_refund_skips_windows_without_a_stamp(backend):
+    await admit(backend, "fixed")
+    await backend.refund(["window"], [1, "fixed", 20, 1000, ""])
+    assert await count_of(backend, "fixed") == 1
+
+
+###### Reconciliation ######
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.asyncio
+async def test_reconcile_only_ever_raises_counts(backend, algorithm):
+    for _ in range(3):
+        await admit(backend, algorithm)
+        backend.advance(50)
+    # Returns the counts as they were, before Riot's were applied
+    assert await backend.reconcile(["window"], [algorithm, 20, 1000, 10]) == [3]
+    assert await backend.reconcile(["window"], [algorithm, 20, 1000, 2]) == [10]
+    assert await count_of(backend, algorithm) == 10
+
+
+@pytest.mark.asyncio
+async def test_reconcile_pushes_the_gcra_schedule_back(backend):
+    await admit(backend, "gcra")
+    backend.advance(50)
+    await backend.reconcile(["window"], ["gcra", 20, 1000, 5])
+    # 4 requests Riot counted that we did not, each one interval
+    allowed, retry_after, *_ = await admit(backend, "gcra")
+    assert (allowed, retry_after) == (0, 200)
+
+
+###### Backends ######
+
+def test_backends_are_used_as_is_and_clients_wrapped_once():
+    backend = ClockedBackend()
+    assert get_rate_limit_backend(backend) is backend
+    client = FakeAsyncRedis(server=FakeServer(), decode_responses=True)
+    wrapped = get_rate_limit_backend(client)
+    assert isinstance(wrapped, RedisBackend) and wrapped.redis is client
+    assert get_rate_limit_backend(client) is wrapped
+
+
+@pytest.mark.asyncio
+async def test_shared_memory_backends_on_one_path_share_their_windows(tmp_path):
+    path = str(tmp_path / "new_destiny")
+    first, second = SharedMemoryBackend(path), SharedMemoryBackend(path)
+    try:
+        for _ in range(15):
+            assert (await admit(first, "fixed"))[0] == 1
+        admitted = 0
+        while (await admit(second, "fixed"))[0] == 1:
+            admitted += 1
+        assert admitted == 5
+        with pytest.raises(ValueError):
+            SharedMemoryBackend(path, slots=16)
+    finally:
+        first.close()
+        second.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_memory_in_flight_slots_live_in_the_table(tmp_path):
+    path = str(tmp_path / "new_destiny")
+    first, second = SharedMemoryBackend(path), SharedMemoryBackend(path)
+    try:
+        assert await first.acquire_slots(["router", "method"], ["a", 5000, 2, 1]) == [1, 0, 0]
+        assert await second.acquire_slots(["router", "method"], ["b", 5000, 2, 1]) == [0, 2, 1]
+        assert await second.acquire_slots(["router"], ["b", 5000, 2]) == [1, 0, 0]
+        assert await first.acquire_slots(["router"], ["c", 5000, 2]) == [0, 1, 2]
+        await second.release_slots(["router", "method"], "a")
+        assert await first.acquire_slots(["router", "method"], ["c", 5000, 2, 1]) == [1, 0, 0]
+        # Releasing a token twice, or one that never got a slot, frees nothing
+        await first.release_slots(["router", "method"], "a")
+        await first.release_slots(["router"], "d")
+        assert await first.acquire_slots(["router"], ["d", 5000, 2]) == [0, 1, 2]
+        assert not os.path.exists(first.hashes_path)
+    finally:
+        first.close()
+        second.close()
+
+
+###### Auto pipelining ######
+
+def counting_pipelines(monkeypatch, backend: RedisBackend) -> list[int]:
+    """Records the size of every pipeline the backend sends."""
+    sizes = []
+    execute = backend._execute
+
+    async def counting_execute(batch):
+        sizes.append(len(batch))
+        return await execute(batch)
+
+    monkeypatch.setattr(backend, "_execute", counting_execute)
+    return sizes
+
+
+@pytest.mark.asyncio
+async def test_scripts_of_one_tick_share_a_pipeline(monkeypatch):
+    backend = RedisBackend(FakeAsyncRedis(server=FakeServer(), decode_responses=True), auto_pipeline=True)
+    sizes = counting_pipelines(monkeypatch, backend)
+    results = await asyncio.gather(*(admit(backend, "fixed") for _ in range(25)))
+    assert sizes == [25]
+    # Every script still ran atomically on its own and every caller got its own result
+    assert [result[0] for result in results] == [1] * 20 + [0] * 5
+    assert sorted(result[6] for result in results[:20]) == list(range(1, 21))
+
+
+@pytest.mark.asyncio
+async def test_pipelined_scripts_fail_on_their_own():
+    backend = RedisBackend(FakeAsyncRedis(server=FakeServer(), decode_responses=True), auto_pipeline=True)
+    await backend.redis.hset("broken", "field", "value")
+    results = await asyncio.gather(
+        backend.admit(["block", "broken"], [1, "fixed", 20, 1000, 1, 0, 0]),
+        admit(backend, "fixed"),
+        return_exceptions=True,
+    )
+    assert isinstance(results[0], ResponseError)
+    assert results[1][0] == 1
+
+
+@pytest.mark.asyncio
+async def test_pipelines_reload_scripts_redis_lost(monkeypatch):
+    backend = RedisBackend(FakeAsyncRedis(server=FakeServer(), decode_responses=True), auto_pipeline=True)
+    await backend.initialize()
+    await backend.redis.script_flush()  # Redis restarted or failed over
+    sizes = counting_pipelines(monkeypatch, backend)
+    results = await asyncio.gather(admit(backend, "fixed"), admit(backend, "fixed"), backend.reconcile(["window"], ["fixed", 20, 1000, 0]))
+    # Every script came back NOSCRIPT, each is loaded again and the pipeline sent once more
+    assert sizes == [3, 3]
+    assert [results[0][0], results[1][0], results[2]] == [1, 1, [2]]
+
+
+@pytest.mark.asyncio
+async def test_without_auto_pipelining_every_script_is_its_own_round_trip(monkeypatch):
+    backend = RedisBackend(FakeAsyncRedis(server=FakeServer(), decode_responses=True), auto_pipeline=False)
+    sizes = counting_pipelines(monkeypatch, backend)
+    await asyncio.gather(*(admit(backend, "fixed") for _ in range(3)))
+    assert sizes == []
+    assert await count_of(backend, "fixed") == 3
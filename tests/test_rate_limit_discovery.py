@@ -0,0 +1,35 @@
+import pytest
+from new_destiny.rate_limit_discovery import DISCOVERED_RATE_LIMITS, RateLimitDiscovery
+from new_destiny.rate_limiter import get_admission_rate_limiter, load_discovered_rate_limits
+from .helpers import SUMMONER_URL
+
+METHOD = "/lol/summoner/v4/summoners/by-puuid"
+
+
+@pytest.mark.asyncio
+async def test_reported_limits_replace_the_table_and_rebuild_the_route(backend):
+    limiter = get_admission_rate_limiter(SUMMONER_URL)
+    assert limiter.method_limits == {60: 2000}
+    assert await limiter.discover_limits({"x-method-rate-limit": "1000:600,100:10"}, backend)
+    rebuilt = get_admission_rate_limiter(SUMMONER_URL)
+    assert rebuilt is not limiter
+    assert rebuilt.method_limits == {10: 100, 600: 1000}
+    # Limits Riot keeps reporting change nothing
+    assert not await rebuilt.discover_limits({"x-method-rate-limit": "100:10,1000:600"}, backend)
+    assert not await rebuilt.discover_limits({}, backend)
+    assert get_admission_rate_limiter(SUMMONER_URL) is rebuilt
+
+
+@pytest.mark.asyncio
+async def test_discovered_limits_are_shared_with_other_processes(backend):
+    other_process = RateLimitDiscovery()
+    await other_process.observe("na1", METHOD, {10: 100}, backend)
+    limiter = get_admission_rate_limiter(SUMMONER_URL)
+    await load_discovered_rate_limits(SUMMONER_URL, backend)
+    assert DISCOVERED_RATE_LIMITS.get("na1", METHOD) == {10: 100}
+    assert get_admission_rate_limiter(SUMMONER_URL) is not limiter
+    assert get_admission_rate_limiter(SUMMONER_URL).method_limits == {10: 100}
+    # Loaded once per process and router
+    await other_process.observe("na1", METHOD, {10: 200}, backend)
+    await load_discovered_rate_limits(SUMMONER_URL, backend)
+    assert DISCOVERED_RATE_LIMITS.get("na1", METHOD) == {10: 100}
@@ -0,0 +1,24 @@
+import pytest
+from new_destiny.rate_limit_helpers import resolve_riot_route
+
+
+def test_routes_resolve_to_their_method_and_limits():
+    route = resolve_riot_route("https://na1.api.riotgames.com/lol/league/v4/entries/by-puuid/abc")
+    assert (route["subdomain"], route["service"], route["method"]) == ("na1", "LEAGUE-V4", "/lol/league/v4/entries/by-puuid")
+    assert (route["seconds"], route["minutes"]) == ({"limit": 20000, "window": 10}, {"limit": 1200000, "window": 600})
+
+
+def test_path_parameters_and_query_strings_do_not_change_the_method():
+    route = resolve_riot_route("https://americas.api.riotgames.com/lol/match/v5/matches/NA1_123/timeline?x=1")
+    assert (route["subdomain"], route["service"], route["method"]) == ("americas", "MATCH-V5", "/lol/match/v5/matches/{matchId}/timeline")
+    # The same URL is resolved once
+    assert resolve_riot_route("https://americas.api.riotgames.com/lol/match/v5/matches/NA1_123/timeline?x=1") is route
+
+
+@pytest.mark.parametrize("url, error", [
+    ("https://na1.api.riotgames.com/lol/nope/v1/x", TypeError),
+    ("not a url", ValueError),
+])
+def test_unknown_routes_raise(url, error):
+    with pytest.raises(error):
+        resolve_riot_route(url)
@@ -0,0 +1,560 @@
+import asyncio
+import os
+import pytest
+from new_destiny.exceptions import ApplicationRateLimitExceeded, InFlightLimitExceeded, MethodRateLimitExceeded
+from new_destiny.fleet import FLEET, FLEET_KEY
+from new_destiny.rate_limiter import (
+    AdmissionRateLimiter,
+    FleetHeartbeat,
+    InFlightLimiter,
+    get_admission_rate_limiter,
+    get_rate_limit_drift,
+    invalidate_admission_rate_limiters,
+    priority_reserve,
+)
+from .helpers import ALGORITHMS, LEAGUE_URL, SUMMONER_URL
+
+MATCH_TIMELINE_URL = "https://americas.api.riotgames.com/lol/match/v5/matches/NA1_123/timeline"
+
+
+def build(backend, algorithm: str = "fixed", **kwargs) -> AdmissionRateLimiter:
+    """A limiter with one 20 requests per second application window and a method window that never gets in the way."""
+    kwargs.setdefault("application_limits", [(20, 1)])
+    kwargs.setdefault("method_limits", [(10_000, 10)])
+    kwargs.setdefault("shares", {})
+    return AdmissionRateLimiter(SUMMONER_URL, backend, algorithm, **kwargs)
+
+
+async def window_count(backend, limiter: AdmissionRateLimiter, index: int = 0) -> int:
+    """Count of one of the limiter's windows, as RECONCILE_SCRIPT reads it (a Riot count of 0 never changes it)."""
+    _, _, key, limit, window = limiter.windows[index]
+    return (await backend.reconcile([key], [limiter.window_algorithms[index], limit, window * 1000, 0]))[0]
+
+
+async def admit_all(limiter: AdmissionRateLimiter, backend=None) -> int:
+    """Admit until refused, returns how many were admitted."""
+    admitted = 0
+    while (await limiter.admit(backend))["allowed"]:
+        admitted += 1
+    return admitted
+
+
+@pytest.fixture
+def sleeps(backend, monkeypatch) -> list[float]:
+    """asyncio.sleep moves the backend's clock instead of waiting, returns every sleep."""
+    sleep = asyncio.sleep
+    slept = []
+
+    async def advance(seconds, result=None):
+        slept.append(seconds)
+        backend.advance(round(seconds * 1000))
+        return await sleep(0, result)
+
+    monkeypatch.setattr(asyncio, "sleep", advance)
+    return slept
+
+
+###### Admission ######
+
+@pytest.mark.asyncio
+async def test_every_tier_is_checked_before_anything_is_counted(backend):
+    limiter = build(backend, method_limits=[(5, 10)])
+    for _ in range(5):
+        assert await limiter.check_and_increment()
+    with pytest.raises(MethodRateLimitExceeded) as exc_info:
+        await limiter.check_and_increment()
+    assert exc_info.value.retry_after_ms == 10_000
+    # The application window was not incremented for the request the method window refused
+    assert await window_count(backend, limiter) == 5
+
+
+@pytest.mark.asyncio
+async def test_service_block_refuses_without_counting(backend):
+    limiter = build(backend)
+    await backend.set_block(limiter.service_rate_limiter.service_key, 2000)
+    verdict = await limiter.admit()
+    assert (verdict["allowed"], verdict["tier"], verdict["reason"], verdict["retry_after_ms"]) == (False, "service", "blocking_key", 2000)
+    assert await window_count(backend, limiter) == 0
+
+
+@pytest.mark.asyncio
+async def test_known_blocking_keys_are_answered_without_a_round_trip(backend, monkeypatch):
+    limiter = build(backend)
+    await backend.set_block(limiter.method_rate_limiter.blocking_key, 3000)
+    assert (await limiter.admit())["reason"] == "blocking_key"
+    round_trips = 0
+    admit = backend.admit
+
+    async def counting_admit(*args):
+        nonlocal round_trips
+        round_trips += 1
+        return await admit(*args)
+
+    monkeypatch.setattr(backend, "admit", counting_admit)
+    verdict = await limiter.admit()
+    assert (verdict["allowed"], verdict["tier"], verdict["reason"]) == (False, "method", "blocking_key")
+    assert 0 < verdict["retry_after_ms"] <= 3000
+    assert round_trips == 0
+
+
+@pytest.mark.asyncio
+async def test_many_reserves_what_every_window_has_room_for(backend):
+    limiter = build(backend, method_limits=[(12, 10)])
+    for _ in range(5):
+        await limiter.check_and_increment()
+    # The method window has room for 7, the rest waits for it to roll over
+    reservation = await limiter.check_and_increment_many(10)
+    assert (reservation["requested"], reservation["granted"], reservation["retry_after_ms"]) == (10, 7, 10_000)
+    assert len(reservation["stamps"]) == 2
+    assert await window_count(backend, limiter) == 12
+    with pytest.raises(MethodRateLimitExceeded):
+        await limiter.check_and_increment_many(10)
+
+
+@pytest.mark.asyncio
+async def test_every_window_of_a_tier_is_enforced(backend):
+    limiter = build(backend, application_limits=[(8, 10), (5, 1), (12, 120)])
+    assert [window_type for _, window_type, _, _, _ in limiter.windows][:3] == ["seconds", "10_seconds", "minutes"]
+    for _ in range(5):
+        await limiter.check_and_increment()
+    verdict = await limiter.admit()
+    assert (verdict["tier"], verdict["reason"], verdict["retry_after_ms"]) == ("application", "seconds", 1000)
+    backend.advance(1000)
+    for _ in range(3):
+        await limiter.check_and_increment()
+    with pytest.raises(ApplicationRateLimitExceeded) as exc_info:
+        await limiter.check_and_increment()
+    assert exc_info.value.retry_after_ms == 9000
+    assert [(window["window"], window["count"]) for window in exc_info.value.windows] == [(1, 3), (10, 8), (120, 8)]
+
+
+@pytest.mark.asyncio
+async def test_batch_priority_leaves_the_reserve_to_interactive(backend):
+    batch = build(backend, priority="batch")
+    interactive = build(backend)
+    reserved = int(20 * priority_reserve("batch"))
+    assert await admit_all(batch) == 20 - reserved
+    assert await admit_all(interactive) == reserved
+
+
+###### Waiting for a slot ######
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_the_next_slot(backend, sleeps):
+    limiter = build(backend)
+    for _ in range(20):
+        await limiter.check_and_increment()
+    assert await limiter.acquire(timeout=5)
+    assert sleeps == [1.0]
+    assert await window_count(backend, limiter) == 1
+
+
+@pytest.mark.asyncio
+async def test_acquire_raises_when_the_next_slot_opens_after_the_timeout(backend, sleeps):
+    limiter = build(backend)
+    for _ in range(20):
+        await limiter.check_and_increment()
+    with pytest.raises(ApplicationRateLimitExceeded) as exc_info:
+        await limiter.acquire(timeout=0.5)
+    assert exc_info.value.retry_after_ms == 1000
+    assert sleeps == []
+
+
+@pytest.mark.asyncio
+async def test_waiters_still_in_line_at_the_timeout_raise_the_rate_limit(backend, monkeypatch):
+    limiter = build(backend, application_limits=[(1, 1)])
+    await limiter.check_and_increment()
+    parked = asyncio.Event()
+
+    async def park(seconds, result=None):
+        parked.set()
+        await asyncio.Event().wait()
+
+    # The head of the line never wakes up, the next caller runs out of time waiting behind it
+    monkeypatch.setattr(asyncio, "sleep", park)
+    head = asyncio.create_task(limiter.acquire())
+    await parked.wait()
+    with pytest.raises(ApplicationRateLimitExceeded) as exc_info:
+        await limiter.acquire(timeout=0.01)
+    assert exc_info.value.retry_after_ms == 1000
+    head.cancel()
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_admitted_in_the_order_they_came(backend, sleeps):
+    limiter = build(backend, application_limits=[(1, 1)])
+    await limiter.check_and_increment()
+    admitted = []
+
+    async def wait(name: str):
+        await limiter.acquire(timeout=10)
+        admitted.append(name)
+
+    await asyncio.gather(*(wait(name) for name in "abc"))
+    assert admitted == ["a", "b", "c"]
+    # Only the head of the line asked for a slot, once per second
+    assert sleeps == [1.0, 1.0, 1.0]
+
+
+###### Cached limiters ######
+
+def test_limiters_are_built_once_per_route_and_priority():
+    limiter = get_admission_rate_limiter(SUMMONER_URL)
+    assert get_admission_rate_limiter(SUMMONER_URL.replace("abc", "xyz")) is limiter
+    assert get_admission_rate_limiter(SUMMONER_URL, priority="batch") is not limiter
+    assert get_admission_rate_limiter(LEAGUE_URL) is not limiter
+    invalidate_admission_rate_limiters("na1", limiter.method)
+    assert get_admission_rate_limiter(SUMMONER_URL) is not limiter
+
+
+###### Redis Cluster ######
+
+def hash_tag(key: str) -> str:
+    """What Redis Cluster hashes a key by, from its first { to the next }."""
+    start = key.index("{")
+    return key[start:key.index("}", start) + 1]
+
+
+@pytest.mark.parametrize("url, router", [(SUMMONER_URL, "{na1}"), (MATCH_TIMELINE_URL, "{americas}")])
+def test_keys_of_one_script_share_their_routers_hash_slot(url, router):
+    FLEET.update(["this-worker", "other-worker"])
+    limiter = AdmissionRateLimiter(url, None, shares={"SUMMONER-V4": 3, "MATCH-V5": 1})
+    assert limiter.shares and limiter.fleet
+    in_flight = InFlightLimiter(url, None, router_limit=10, method_limit=5)
+    # Method names such as /lol/match/v5/matches/{matchId}/timeline come after the tag, never in place of it
+    for key in [*limiter.admission_keys, *limiter.window_keys, *in_flight.keys]:
+        assert hash_tag(key) == router
+
+
+###### Leases ######
+
+@pytest.mark.asyncio
+async def test_lease_hands_out_admissions_locally(backend):
+    limiter = build(backend, lease_size=8)
+    round_trips = 0
+    admit = limiter.admit
+
+    async def counting_admit(*args):
+        nonlocal round_trips
+        round_trips += 1
+        return await admit(*args)
+
+    limiter.admit = counting_admit
+    for _ in range(20):
+        assert await limiter.check_and_increment()
+    with pytest.raises(ApplicationRateLimitExceeded):
+        await limiter.check_and_increment()
+    assert round_trips < 20
+
+
+@pytest.mark.asyncio
+async def test_expired_lease_refunds_what_it_did_not_hand_out(backend):
+    limiter = build(backend, lease_size=8)
+    await limiter.check_and_increment()  # The first lease is a single request, the next one sized to the room left
+    await limiter.check_and_increment()
+    lease = limiter.leases[backend.lease_scope]
+    assert lease.remaining > 0
+    assert await window_count(backend, limiter) == 2 + lease.remaining
+
+    limiter.expire_lease(backend.lease_scope, lease, backend)
+    await asyncio.sleep(0)
+    assert backend.lease_scope not in limiter.leases
+    assert await window_count(backend, limiter) == 2
+
+
+###### Rollback ######
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.asyncio
+async def test_rollback_gives_the_tokens_back(backend, algorithm):
+    limiter = build(backend, algorithm)
+    handle = await limiter.admit_request()
+    assert await window_count(backend, limiter) == 1
+    assert await handle.rollback()
+    assert await window_count(backend, limiter) == 0
+    # Settled once, a second rollback gives nothing back
+    assert not await handle.rollback()
+    if algorithm == "gcra":
+        assert (await limiter.admit())["allowed"]  # The refunded request no longer paces the next one
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.asyncio
+async def test_late_rollback_never_lowers_a_newer_window(backend, algorithm):
+    limiter = build(backend, algorithm)
+    handle = await limiter.admit_request()
+    backend.advance(1500)  # Every window (and sliding bucket) the request was counted in rolled over
+    verdict = await limiter.admit()
+    while verdict["allowed"]:
+        verdict = await limiter.admit()
+    assert await handle.rollback()
+    assert await window_count(backend, limiter) == verdict["counts"][0]
+    assert not (await limiter.admit())["allowed"]
+
+
+@pytest.mark.asyncio
+async def test_committed_request_is_not_rolled_back(backend):
+    limiter = build(backend)
+    handle = await limiter.admit_request()
+    handle.commit()
+    assert not await handle.rollback()
+    assert await window_count(backend, limiter) == 1
+
+
+@pytest.mark.asyncio
+async def test_rollback_returns_leased_tokens_to_their_lease(backend):
+    limiter = build(backend, lease_size=8)
+    await limiter.check_and_increment()
+    handle = await limiter.admit_request()
+    lease = limiter.leases[backend.lease_scope]
+    remaining = lease.remaining
+    counted = await window_count(backend, limiter)
+    await handle.rollback()
+    assert lease.remaining == remaining + 1
+    assert await window_count(backend, limiter) == counted  # Refunded in the window once the lease expires
+
+
+###### Calibration ######
+
+@pytest.mark.asyncio
+async def test_calibrate_raises_windows_behind_riot_and_records_their_drift(backend):
+    limiter = build(backend, application_limits=[(20, 1), (100, 120)], method_limits=[(50, 10)])
+    for _ in range(2):
+        await limiter.check_and_increment()
+    await limiter.calibrate({
+        "x-app-rate-limit-count": "7:1,9:120",
+        "x-method-rate-limit-count": "2:10",
+    })
+    assert [await window_count(backend, limiter, index) for index in range(3)] == [7, 9, 2]
+    assert get_rate_limit_drift() == {
+        ("na1", "application", None, 1): {"samples": 1, "last": 5, "max": 5, "total": 5},
+        ("na1", "application", None, 120): {"samples": 1, "last": 7, "max": 7, "total": 7},
+    }
+
+
+@pytest.mark.asyncio
+async def test_calibrate_does_not_mistake_concurrent_admissions_for_drift(backend):
+    limiter = build(backend)
+    for _ in range(5):
+        await limiter.check_and_increment()
+    # Riot answered before the last requests reached it
+    await limiter.calibrate({"x-app-rate-limit-count": "3:1"})
+    assert await window_count(backend, limiter) == 5
+    assert get_rate_limit_drift() == {}
+
+
+@pytest.mark.asyncio
+async def test_calibrate_skips_the_round_trip_while_riot_counts_no_more_than_the_admission(backend, monkeypatch):
+    limiter = build(backend)
+    handle = await limiter.admit_request()
+    for _ in range(2):
+        await limiter.check_and_increment()
+    assert handle.counts == [1, 1]
+    round_trips = 0
+    reconcile = backend.reconcile
+
+    async def counting_reconcile(*args):
+        nonlocal round_trips
+        round_trips += 1
+        return await reconcile(*args)
+
+    monkeypatch.setattr(backend, "reconcile", counting_reconcile)
+    await limiter.calibrate({"x-app-rate-limit-count": "1:1", "x-method-rate-limit-count": "1:10"}, backend, handle.counts)
+    assert round_trips == 0
+    # Riot counted more than there were when the request was admitted, maybe more than there are now
+    await limiter.calibrate({"x-app-rate-limit-count": "4:1", "x-method-rate-limit-count": "1:10"}, backend, handle.counts)
+    assert round_trips == 1
+    assert get_rate_limit_drift() == {("na1", "application", None, 1): {"samples": 1, "last": 1, "max": 1, "total": 1}}
+
+
+@pytest.mark.asyncio
+async def test_calibrate_feeds_the_adaptive_headroom(backend, headroom):
+    limiter = build(backend)
+    await limiter.check_and_increment()
+    await limiter.calibrate({"x-app-rate-limit-count": "3:1"})
+    assert headroom.state("na1")["margin"] == pytest.approx(2 / 20)
+    # Holding back a tenth of the window
+    assert await admit_all(limiter) == 18 - 3
+
+    await limiter.calibrate({"x-app-rate-limit-count": "1:1"})
+    assert headroom.state("na1")["margin"] == pytest.approx(2 / 20 - headroom.CALM_STEP)
+    # Responses without count headers say nothing either way
+    await limiter.calibrate({})
+    assert headroom.state("na1")["margin"] == pytest.approx(2 / 20 - headroom.CALM_STEP)
+
+
+###### Tenant shares ######
+
+@pytest.mark.asyncio
+async def test_idle_tenants_shares_can_be_borrowed(backend):
+    other = build(backend, shares={"SUMMONER-V4": 3}, tenant="other")
+    assert other.tenant == "default"
+    assert await admit_all(other) == 20
+
+
+@pytest.mark.asyncio
+async def test_active_tenants_keep_their_guaranteed_share(backend):
+    shares = {"SUMMONER-V4": 3}
+    summoner = build(backend, shares=shares)
+    other = build(backend, shares=shares, tenant="other")
+    assert summoner.tenant == "SUMMONER-V4"
+    for _ in range(2):
+        assert (await summoner.admit())["allowed"]
+    # 15 of 20 are guaranteed to the summoner tenant, which has 13 of them left
+    assert await admit_all(other) == 5
+    verdict = await other.admit()
+    assert (verdict["tier"], verdict["reason"]) == ("application", "share")
+    assert await admit_all(summoner) == 13
+
+
+@pytest.mark.asyncio
+async def test_refund_only_returns_the_tenants_own_share(backend):
+    shares = {"SUMMONER-V4": 3}
+    summoner = build(backend, shares=shares)
+    other = build(backend, shares=shares, tenant="other")
+    for _ in range(3):
+        await other.admit()
+    await summoner.refund(1, (await summoner.admit_one())["stamps"])
+    share_keys = {tenant: key for tenant, _, key, _, _, _ in summoner.shares}
+    assert await backend.reconcile(
+        [share_keys["SUMMONER-V4"], share_keys["default"]],
+        ["fixed", 15, 1000, 0, "fixed", 5, 1000, 0],
+    ) == [0, 3]
+
+
+###### Fleet ######
+
+@pytest.mark.asyncio
+async def test_heartbeats_expire_with_their_workers(backend):
+    assert await backend.heartbeat(FLEET_KEY, "first", 1000) == ["first"]
+    backend.advance(500)
+    assert await backend.heartbeat(FLEET_KEY, "second", 1000) == ["first", "second"]
+    backend.advance(600)
+    assert await backend.heartbeat(FLEET_KEY, "second", 1000) == ["second"]
+    assert await backend.heartbeat(FLEET_KEY, "second", 0) == []
+
+
+def as_worker(monkeypatch, worker_id: str):
+    """Limiters built from now on are this process's as the given worker of the fleet."""
+    monkeypatch.setattr(FLEET, "_pid", os.getpid())
+    monkeypatch.setattr(FLEET, "_worker_id", worker_id)
+
+
+def test_fleet_shares_add_up_to_the_limit():
+    FLEET.update(["c-worker", "a-worker", "b-worker"])
+    assert FLEET.shares(20) == {"a-worker": 7, "b-worker": 7, "c-worker": 6}
+    assert FLEET.shares(2) == {"a-worker": 1, "b-worker": 1, "c-worker": 0}
+
+
+@pytest.mark.asyncio
+async def test_idle_workers_shares_can_be_borrowed(backend):
+    await backend.heartbeat(FLEET_KEY, "other-worker", 60_000)
+    await FleetHeartbeat(backend).beat()
+    assert FLEET.size == 2
+
+    limiter = build(backend)
+    assert limiter.fleet
+    assert await admit_all(limiter) == 20
+
+
+@pytest.mark.asyncio
+async def test_active_workers_keep_their_guaranteed_share(backend, monkeypatch):
+    FLEET.update(["a-worker", "b-worker"])
+    as_worker(monkeypatch, "a-worker")
+    this = build(backend, application_limits=[(21, 1)])
+    as_worker(monkeypatch, "b-worker")
+    other = build(backend, application_limits=[(21, 1)])
+    assert [(worker, guaranteed) for worker, _, _, _, guaranteed, _, _ in this.fleet] == [
+        ("a-worker", 11), ("b-worker", 10), ("a-worker", 5000), ("b-worker", 5000),
+    ]
+
+    for _ in range(2):
+        assert (await other.admit())["allowed"]
+    # 10 of 21 are guaranteed to the other worker, which has 8 of them left
+    assert await admit_all(this) == 11
+    verdict = await this.admit()
+    assert (verdict["tier"], verdict["reason"]) == ("application", "fleet")
+    assert await admit_all(other) == 8
+
+
+@pytest.mark.asyncio
+async def test_refund_only_returns_the_workers_own_count(backend, monkeypatch):
+    FLEET.update(["a-worker", "b-worker"])
+    as_worker(monkeypatch, "a-worker")
+    this = build(backend)
+    as_worker(monkeypatch, "b-worker")
+    other = build(backend)
+    for _ in range(3):
+        await other.admit()
+    await this.refund(1, (await this.admit_one())["stamps"])
+    worker_keys = {worker: key for worker, tier, _, key, _, _, _ in this.fleet if tier == "application"}
+    assert await backend.reconcile(
+        [worker_keys["a-worker"], worker_keys["b-worker"]],
+        ["fixed", 10, 1000, 0, "fixed", 10, 1000, 0],
+    ) == [0, 3]
+
+
+@pytest.mark.asyncio
+async def test_cached_limiters_are_rebuilt_when_the_fleet_changes(backend):
+    heartbeat = FleetHeartbeat(backend)
+    await heartbeat.beat()
+    limiter = get_admission_rate_limiter(SUMMONER_URL)
+    assert not limiter.fleet
+
+    await backend.heartbeat(FLEET_KEY, "other-worker", 60_000)
+    await heartbeat.beat()
+    rebuilt = get_admission_rate_limiter(SUMMONER_URL)
+    assert rebuilt is not limiter and rebuilt.fleet
+
+    await backend.heartbeat(FLEET_KEY, "other-worker", 0)
+    await heartbeat.beat()
+    assert FLEET.size == 1
+    assert not get_admission_rate_limiter(SUMMONER_URL).fleet
+
+
+###### In flight caps ######
+
+@pytest.mark.asyncio
+async def test_in_flight_router_cap(backend):
+    limiter = InFlightLimiter(SUMMONER_URL, backend, router_limit=2)
+    first = await limiter.acquire()
+    await limiter.acquire()
+    with pytest.raises(InFlightLimitExceeded) as exc_info:
+        await limiter.acquire()
+    assert (exc_info.value.scope, exc_info.value.in_flight, exc_info.value.retry_after_ms) == ("router", 2, InFlightLimiter.RETRY_AFTER_MS)
+    # Other methods of the router share its cap
+    with pytest.raises(InFlightLimitExceeded):
+        await InFlightLimiter(LEAGUE_URL, backend, router_limit=2).acquire()
+    await limiter.release(first)
+    assert await limiter.acquire() is not None
+
+
+@pytest.mark.asyncio
+async def test_in_flight_method_cap(backend):
+    summoner = InFlightLimiter(SUMMONER_URL, backend, router_limit=10, method_limit=1)
+    await summoner.acquire()
+    with pytest.raises(InFlightLimitExceeded) as exc_info:
+        await summoner.acquire()
+    assert exc_info.value.scope == "method"
+    assert await InFlightLimiter(LEAGUE_URL, backend, router_limit=10, method_limit=1).acquire() is not None
+
+
+@pytest.mark.asyncio
+async def test_in_flight_slots_of_crashed_workers_free_themselves(backend):
+    limiter = InFlightLimiter(SUMMONER_URL, backend, router_limit=1, lease_ms=5000)
+    await limiter.acquire()  # Never released
+    with pytest.raises(InFlightLimitExceeded):
+        await limiter.acquire()
+    backend.advance(5000)
+    assert await limiter.acquire() is not None
+
+
+@pytest.mark.asyncio
+async def test_in_flight_waiters_get_the_next_free_slot(backend):
+    limiter = InFlightLimiter(SUMMONER_URL, backend, router_limit=1)
+    token = await limiter.acquire()
+    waiter = asyncio.create_task(limiter.acquire(wait=True, timeout=1))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    await limiter.release(token)
+    assert await waiter is not None
@@ -0,0 +1,70 @@
+import asyncio
+import httpx
+import pytest
+from redis.exceptions import RedisError
+from new_destiny import riot_get_request
+from new_destiny.headroom import AdaptiveHeadroom
+from new_destiny.rate_limiter import InFlightLimiter, get_admission_rate_limiter
+from new_destiny.riot_get_request import perform_riot_request
+from new_destiny.riot_get_request_with_retry import riot_request_with_retry
+from .helpers import SUMMONER_URL
+
+
+def riot(status: int = 200, headers: dict | None = None, body=None) -> httpx.AsyncClient:
+    """An httpx client that answers every GET like Riot would, without leaving the process."""
+    return httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(status, headers=headers, json=body)))
+
+
+@pytest.fixture(autouse=True)
+def headroom(monkeypatch):
+    monkeypatch.setattr(riot_get_request, "HEADROOM", AdaptiveHeadroom())
+
+
+@pytest.mark.asyncio
+async def test_response_is_returned_when_calibration_fails(backend, monkeypatch):
+    async def unreachable(*args):
+        raise RedisError("Connection refused")
+
+    monkeypatch.setattr(backend, "reconcile", unreachable)
+    monkeypatch.setattr(backend, "set_hash_field", unreachable)
+    headers = {"x-app-rate-limit-count": "5:1,5:120", "x-method-rate-limit": "100:10"}
+    async with riot(headers=headers, body={"puuid": "abc"}) as client:
+        assert await perform_riot_request(SUMMONER_URL, client, backend) == {"puuid": "abc"}
+
+
+@pytest.mark.asyncio
+async def test_one_timeout_covers_the_admission_and_the_in_flight_slot(backend, monkeypatch):
+    limiter = get_admission_rate_limiter(SUMMONER_URL)
+    admit_request = limiter.admit_request
+
+    async def slow_admit_request(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await admit_request(*args, **kwargs)
+
+    timeouts = []
+    send = riot_get_request._send_riot_request
+
+    async def recording_send(*args, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        return await send(*args, timeout=timeout, **kwargs)
+
+    monkeypatch.setattr(limiter, "admit_request", slow_admit_request)
+    monkeypatch.setattr(riot_get_request, "_send_riot_request", recording_send)
+    async with riot(body={}) as client:
+        await perform_riot_request(SUMMONER_URL, client, backend, wait=True, timeout=1)
+    # What the admission took is no longer left for the slot
+    assert timeouts[0] <= 0.95
+
+
+@pytest.mark.asyncio
+async def test_retries_wait_for_an_in_flight_slot_instead_of_using_up_their_attempts(backend, monkeypatch):
+    limiter = get_admission_rate_limiter(SUMMONER_URL)
+    monkeypatch.setattr(limiter, "in_flight_limiter", InFlightLimiter(SUMMONER_URL, None, router_limit=1))
+    token = await limiter.in_flight_limiter.acquire(async_redis_client=backend)
+    async with riot(body={"puuid": "abc"}) as client:
+        request = asyncio.create_task(riot_request_with_retry(riot_endpoint=SUMMONER_URL, client=client, async_redis_client=backend))
+        # Far longer than 3 attempts polling every InFlightLimiter.RETRY_AFTER_MS
+        await asyncio.sleep(0.2)
+        assert not request.done()
+        await limiter.in_flight_limiter.release(token, backend)
+        assert await request == {"puuid": "abc"}
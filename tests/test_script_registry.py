@@ -0,0 +1,48 @@
+import pytest
+from fakeredis import FakeAsyncRedis, FakeServer
+from new_destiny.rate_limit_backends import ADMISSION_SCRIPT, RedisBackend
+from new_destiny.script_registry import SCRIPT_REGISTRY, LuaScriptRegistry
+
+SCRIPT = "return ARGV[1]"
+
+
+class CountingRedis(FakeAsyncRedis):
+    """Counts the SCRIPT LOAD round trips."""
+    script_loads = 0
+
+    async def script_load(self, script):
+        self.script_loads += 1
+        return await super().script_load(script)
+
+
+@pytest.mark.asyncio
+async def test_scripts_are_loaded_once_per_connection_pool():
+    registry = LuaScriptRegistry()
+    server = FakeServer()
+    client = CountingRedis(server=server, decode_responses=True)
+    for value in ("a", "b", "c"):
+        assert await registry.evalsha(client, SCRIPT, 0, value) == value
+    assert client.script_loads == 1
+    # Another pool is another server as far as the registry knows
+    other = CountingRedis(server=server, decode_responses=True)
+    assert await registry.evalsha(other, SCRIPT, 0, "d") == "d"
+    assert other.script_loads == 1
+
+
+@pytest.mark.asyncio
+async def test_noscript_reloads_and_retries_once():
+    registry = LuaScriptRegistry()
+    client = CountingRedis(server=FakeServer(), decode_responses=True)
+    await registry.evalsha(client, SCRIPT, 0, "a")
+    await client.script_flush()  # Redis restarted or failed over
+    assert await registry.evalsha(client, SCRIPT, 0, "b") == "b"
+    assert client.script_loads == 2
+
+
+@pytest.mark.asyncio
+async def test_admission_survives_a_flushed_script_cache():
+    backend = RedisBackend(FakeAsyncRedis(server=FakeServer(), decode_responses=True), auto_pipeline=False)
+    await backend.initialize()
+    await backend.redis.script_flush()
+    assert (await backend.admit(["block", "window"], [1, "fixed", 20, 1000, 1, 0, 0]))[0] == 1
+    assert await backend.redis.script_exists(SCRIPT_REGISTRY.sha(ADMISSION_SCRIPT)) == [True]